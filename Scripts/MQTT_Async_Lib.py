@@ -0,0 +1,182 @@
+#!/usr/bin/python           # Asyncio mode for the instrument server
+
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import MQTT_Instrument_Lib
+from MQTT_Instrument_Lib import ChannelRows, ModbusSpans, ChannelSpan, SpanReads, SpanData, StoreSpan, SpanRejected, DecodeModbusBlocks, DecodeModbusValue, TimedRows, CommIssue, ObserveRequest, PublishData, AcquisitionStamp, StampRows, ChannelResult, Metrics
+
+#---------------- Async connection pool --------------------------
+#pymodbus's async client holds a lock around each transaction, so one client has one request on the wire at a time.
+#AsyncConnections clients to the same gateway give that many transactions in flight; requests take whichever is idle
+class AsyncModbusPool:
+    def __init__(self, InstrConfig):
+        self.InstrConfig = InstrConfig
+        self.Size = int(InstrConfig['EquipmentTags'].get('AsyncConnections', 2))
+        self.Timeout = float(InstrConfig['EquipmentTags'].get('RequestTimeout', 5))
+        self.Clients = []
+        self.Idle = None
+
+    async def Connect(self):
+        from pymodbus.client import AsyncModbusTcpClient  #expensive library, don't load unless you need it
+        self.Idle = asyncio.Queue()
+        for Number in range(self.Size):
+            Client = AsyncModbusTcpClient(self.InstrConfig['EquipmentTags']['Connection']['IP'], port=self.InstrConfig['EquipmentTags']['PortNum'], timeout=self.Timeout)
+            await Client.connect()
+            self.Clients.append(Client)
+            self.Idle.put_nowait(Client)
+
+    async def Call(self, Method, *args, **kwargs):
+        Client = await self.Idle.get()
+        try:
+            return await getattr(Client, Method)(*args, **kwargs)
+        finally:
+            self.Idle.put_nowait(Client)
+
+    def Close(self):
+        for Client in self.Clients:
+            Client.close()
+
+#the sync drivers (writes, ModbusTcpR) run in worker threads and reach the pool through this - same method names as
+#the pymodbus sync client, each call waits at most RequestTimeout and is cancelled on the loop if it takes longer
+class SyncBridge:
+    def __init__(self, Pool, loop):
+        self.Pool = Pool
+        self.loop = loop
+
+    def __getattr__(self, Method):
+        def Call(*args, **kwargs):
+            Future = asyncio.run_coroutine_threadsafe(self.Pool.Call(Method, *args, **kwargs), self.loop)
+            try:
+                return Future.result(self.Pool.Timeout)
+            except Exception:
+                Future.cancel()
+                raise
+        return Call
+
+#---------------- Async drivers --------------------------
+#returns the registers (or bits), how long the read took and its acquisition stamp
+async def ReadSpanAsync(Pool, Span):
+    SpanStart = time.perf_counter()
+    Data = SpanData(Span, await Pool.Call(SpanReads[Span.Type], Span.Start, Span.End - Span.Start, Span.Unit))
+    Stamp = AcquisitionStamp()
+    return Data, Stamp[1] - SpanStart, Stamp
+
+#same results as ModbusTcpGenericR, but every span (and every channel read outside a span) is issued at once, so
+#spans for different units and channels overlap on the pool instead of waiting for each other
+async def ModbusTcpGenericRAsync(RequestDetails, InstrConfig, Pool, client):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    Rows = ChannelRows(RequestDetails, InstrConfig)
+    ReturnData = {EquipmentName:{}}
+    Unit = int(InstrConfig['EquipmentTags']['Connection']['Unit'])
+    Spans = ModbusSpans(Rows, InstrConfig, 'Tcp', lambda Fields: Unit)
+    Reading = [(Position, Span) for Position, Span in enumerate(Spans) if not Span.Failed]
+    Results = await asyncio.gather(*[ReadSpanAsync(Pool, Span) for Position, Span in Reading], return_exceptions=True)
+    SpanValues = {}
+    Blocks = {}
+    for (Position, Span), Result in zip(Reading, Results):
+        if isinstance(Result, BaseException):
+            if Span.Failed:
+                CommIssue(client, InstrConfig, SpanRejected(Span, Result))
+            continue
+        Metrics.Observe('instrument_span_seconds', Result[1], {'equipment': EquipmentName, 'type': Span.Type})
+        StampRows(Rows, [Index for Index, Offset, Width in Span.Members], Result[2])
+        StoreSpan(Span, Position, Result[0], SpanValues, Blocks)
+    #channels outside a span or in a span that failed, one read each but all in flight together
+    Missing = [Index for Index in range(len(Rows)) if Index not in SpanValues]
+    Singles = [ChannelSpan(Rows[Index], Unit) for Index in Missing]
+    Results = await asyncio.gather(*[ReadSpanAsync(Pool, Span) for Span in Singles], return_exceptions=True)
+    Errors = {}
+    for Index, Span, Result in zip(Missing, Singles, Results):
+        if isinstance(Result, BaseException):
+            Errors[Index] = Result
+        else:
+            Rows[Index].Acquired(Result[2])
+            Single = {}
+            StoreSpan(Span, 0, Result[0], Single, None)
+            SpanValues[Index] = Single[0]
+    Decoded = DecodeModbusBlocks(Rows, Spans, Blocks, InstrConfig)
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):
+        try:
+            if Index in Errors:
+                raise Errors[Index]
+            FValue = Decoded[Index] if Index in Decoded else DecodeModbusValue(row, SpanValues[Index], InstrConfig)
+            ReturnData[EquipmentName][row['Tagnum']]=ChannelResult(row, FValue)
+        except Exception as e:
+            Status = 'Issue with Updated modbus read' + str(e)
+            CommIssue(client, InstrConfig, Status)
+    return ReturnData
+
+AsyncDrivers = {'ModbusTcpGenericR': ModbusTcpGenericRAsync}
+
+#communications the pool can serve (the Modbus TCP family from InitializeInstrumentConnection)
+AsyncCommunications = ('ModbusTcp', 'SingleModbusTcp', 'DoubleModbusTcp', 'ModbusTcpKRBH', 'ModbusTcpGeneric')
+
+#---------------- Async instrument --------------------------
+#runs an event loop in its own thread. Submit is called from the paho callback and returns straight away; reads with an
+#async driver run on the loop under a RequestTimeout (cancelled when it runs out), everything else goes to the regular
+#driver in a worker thread with SyncBridge as its connection, which is waited on for RequestTimeout but can't be cancelled
+class AsyncInstrument:
+    def __init__(self, InstrConfig, client):
+        self.InstrConfig = InstrConfig
+        self.client = client
+        self.EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+        self.loop = asyncio.new_event_loop()
+        self.Thread = threading.Thread(target=self.loop.run_forever, name='Async-' + self.EquipmentName, daemon=True)
+        self.Thread.start()
+        self.Pool = AsyncModbusPool(InstrConfig)
+        asyncio.run_coroutine_threadsafe(self.Pool.Connect(), self.loop).result()
+        self.Bridge = SyncBridge(self.Pool, self.loop)
+        self.Executor = ThreadPoolExecutor(max_workers=self.Pool.Size, thread_name_prefix='Sync-' + self.EquipmentName)
+        self.Pending = set()
+
+    def Submit(self, Request, RequestTopic):
+        asyncio.run_coroutine_threadsafe(self.Handle(Request, RequestTopic), self.loop)
+
+    #blocking version of Submit, for the poll scheduler
+    def Run(self, Request, RequestTopic):
+        asyncio.run_coroutine_threadsafe(self.Handle(Request, RequestTopic), self.loop).result()
+
+    async def Handle(self, Request, RequestTopic):
+        Task = asyncio.current_task()
+        self.Pending.add(Task)
+        try:
+            RequestDetails = json.loads(Request)
+            FunctionName = self.InstrConfig['EquipmentTags']['Communication'] + RequestDetails['Read/Write']
+            if FunctionName not in AsyncDrivers:
+                #a worker thread can't be cancelled - the request stops waiting for it after RequestTimeout, but the driver
+                #keeps going until its current bridge call times out and may still publish late
+                try:
+                    await asyncio.wait_for(self.loop.run_in_executor(self.Executor, MQTT_Instrument_Lib.InstrumentSelect, Request, self.InstrConfig, self.Bridge, RequestTopic, self.client), self.Pool.Timeout)
+                except asyncio.TimeoutError:
+                    CommIssue(self.client, self.InstrConfig, 'Request timed out after ' + str(self.Pool.Timeout) + ' s, its worker thread is still running')
+                return
+            RequestStart = time.perf_counter()
+            try:
+                ReturnData = await asyncio.wait_for(AsyncDrivers[FunctionName](RequestDetails, self.InstrConfig, self.Pool, self.client), self.Pool.Timeout)
+            finally:
+                ObserveRequest(self.InstrConfig, FunctionName, RequestStart)
+            PublishData(self.client, self.InstrConfig, ReturnData)
+        except asyncio.TimeoutError:
+            CommIssue(self.client, self.InstrConfig, 'Request timed out after ' + str(self.Pool.Timeout) + ' s and was cancelled')
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            Status = '[Received bad message or instrument comms: ' + str(e) + ']'
+            print(Status)
+            self.client.publish("Relay/ServerIssue/" + self.EquipmentName, json.dumps(Status))
+        finally:
+            self.Pending.discard(Task)
+
+    #cancel whatever is still in flight and close the connections (used by the poison pill)
+    def Stop(self):
+        async def Shutdown():
+            for Task in list(self.Pending):
+                Task.cancel()
+            await asyncio.gather(*self.Pending, return_exceptions=True)
+            self.Pool.Close()
+        asyncio.run_coroutine_threadsafe(Shutdown(), self.loop).result(self.Pool.Timeout)
+        self.Executor.shutdown(wait=False)
+        self.loop.call_soon_threadsafe(self.loop.stop)
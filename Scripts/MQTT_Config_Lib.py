@@ -0,0 +1,26 @@
+#!/usr/bin/python           # System config loading shared by the instrument host and the database servers
+
+import json
+import os
+
+#---------------- Equipment configs --------------------------
+#the system config and the instrument config of every active equipment entry, keyed by EquipmentName.
+#Config paths are relative to SystemTags RootPath, or to the system config's own directory when that doesn't exist.
+#an instrument whose config won't load is reported and left out
+def LoadEquipmentConfigs(SystemConfigPath):
+    with open(SystemConfigPath, 'r') as jsonconfig:
+        SystemConfig = json.load(jsonconfig)
+    RootPath = SystemConfig.get('SystemTags', {}).get('RootPath', '')
+    if not os.path.isdir(RootPath):
+        RootPath = os.path.dirname(os.path.abspath(SystemConfigPath))
+    EquipmentConfigs = {}
+    for Name, Entry in SystemConfig.get('Equipment', {}).items():
+        if not Entry.get('Active', True):
+            continue
+        try:
+            with open(os.path.join(RootPath, Entry['Config']), 'r') as jsonconfig:
+                InstrConfig = json.load(jsonconfig)
+            EquipmentConfigs[InstrConfig['EquipmentTags']['EquipmentName']] = InstrConfig
+        except Exception as e:
+            print('[Error loading config for ' + Name + ': ' + str(e) + ']')
+    return SystemConfig, EquipmentConfigs
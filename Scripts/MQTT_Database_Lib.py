@@ -0,0 +1,1082 @@
+#!/usr/bin/python           # Helper library for MQTT_PostgreSQL_Server.py
+
+import numpy as np
+from io import StringIO, BytesIO
+from itertools import chain, repeat
+from datetime import datetime, timedelta, timezone
+import struct
+import csv
+import re
+import json
+import time
+import queue
+import threading
+import os
+import mmap
+import zlib
+import MQTT_Metrics_Lib
+import MQTT_Payload_Lib
+import MQTT_Config_Lib
+
+#the columns every buffered row carries, in the order they are written to the database
+DBColumns = ('time', 'equipment', 'tagnum', 'value')
+
+#-----------------------helper functions------------------
+#this is a special function to stream rows to postgres as direct writable CSV - it's referenced in the pandas docs
+def psql_insert_copy(cur, table_name, keys, data_iter):
+    s_buf = StringIO()
+    writer = csv.writer(s_buf)
+    writer.writerows(data_iter)
+    s_buf.seek(0)
+
+    columns = ', '.join('"{}"'.format(k) for k in keys)
+    sql = 'COPY {} ({}) FROM STDIN WITH CSV'.format(
+        table_name, columns)
+    cur.copy_expert(sql=sql, file=s_buf)
+
+#---------------- Binary COPY writer --------------------------
+#COPY FORMAT BINARY skips float-to-text formatting on our side and text parsing on the server side.
+#every value is packed straight into its wire representation, repeated strings (equipment, tagnum, time)
+#are encoded once per batch and reused
+PGCopyHeader = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCopyTrailer = struct.pack('>h', -1)
+PGNullField = struct.pack('>i', -1)
+PGEpoch = datetime(2000, 1, 1)
+PGEpochUTC = datetime(2000, 1, 1, tzinfo=timezone.utc)
+Float8Field = struct.Struct('>id')
+Float4Field = struct.Struct('>if')
+Int8Field = struct.Struct('>iq')
+Int4Field = struct.Struct('>ii')
+Int2Field = struct.Struct('>ih')
+LengthField = struct.Struct('>i')
+
+#column types we already looked up, keyed by (table, columns) -> (type oids, session time zone)
+CopyColumnCache = {}
+
+def SessionTimeZone(cur):
+    cur.execute('SHOW TimeZone')
+    TimeZoneName = cur.fetchone()[0]
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(TimeZoneName)
+    except Exception:
+        #fall back to the local zone of this machine, same as a naive datetime would be read
+        return datetime.now().astimezone().tzinfo
+
+def CopyColumnTypes(cur, table_name, keys):
+    CacheKey = (table_name, tuple(keys))
+    if CacheKey not in CopyColumnCache:
+        columns = ', '.join('"{}"'.format(k) for k in keys)
+        cur.execute('SELECT {} FROM {} LIMIT 0'.format(columns, table_name))
+        TypeOids = tuple(col[1] for col in cur.description)
+        CopyColumnCache[CacheKey] = (TypeOids, SessionTimeZone(cur))
+    return CopyColumnCache[CacheKey]
+
+#times are either text/datetime (naive ones read in the session time zone) or epoch ns acquisition stamps (TimeNs),
+#which are absolute and only need shifting to the postgres epoch
+UnixEpochUTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+PGEpochMicros = 946684800000000
+
+def EpochNsStamp(Value):
+    return UnixEpochUTC + timedelta(microseconds=Value // 1000)
+
+def EpochNsText(Value, Zone, WithZone):
+    Stamp = EpochNsStamp(Value)
+    return Stamp.isoformat() if WithZone else Stamp.astimezone(Zone).replace(tzinfo=None).isoformat()
+
+def TimestampMicros(Value, Zone, WithZone):
+    if type(Value) is int:
+        if WithZone:
+            return Value // 1000 - PGEpochMicros
+        Delta = EpochNsStamp(Value).astimezone(Zone).replace(tzinfo=None) - PGEpoch
+        return (Delta.days * 86400 + Delta.seconds) * 1000000 + Delta.microseconds
+    if isinstance(Value, datetime):
+        Stamp = Value
+    else:
+        Stamp = datetime.fromisoformat(str(Value))
+    if WithZone:
+        #naive timestamps are read in the session time zone, same as the server does with text input
+        if Stamp.tzinfo is None:
+            Stamp = Stamp.replace(tzinfo=Zone)
+        Delta = Stamp - PGEpochUTC
+    else:
+        if Stamp.tzinfo is not None:
+            Stamp = Stamp.astimezone(Zone).replace(tzinfo=None)
+        Delta = Stamp - PGEpoch
+    return (Delta.days * 86400 + Delta.seconds) * 1000000 + Delta.microseconds
+
+def EncodeText(Value):
+    Raw = str(Value).encode()
+    return LengthField.pack(len(Raw)) + Raw
+
+#one encoder per supported type oid - Memo marks columns with few distinct values worth caching per batch
+def BinaryEncoder(TypeOid, Zone):
+    if TypeOid == 701:      #float8
+        return (lambda v: Float8Field.pack(8, float(v))), False
+    elif TypeOid == 700:    #float4
+        return (lambda v: Float4Field.pack(4, float(v))), False
+    elif TypeOid == 20:     #int8
+        return (lambda v: Int8Field.pack(8, int(v))), False
+    elif TypeOid == 23:     #int4
+        return (lambda v: Int4Field.pack(4, int(v))), False
+    elif TypeOid == 21:     #int2
+        return (lambda v: Int2Field.pack(2, int(v))), False
+    elif TypeOid in (25, 1043, 19):   #text, varchar, name
+        return EncodeText, True
+    elif TypeOid == 1184:   #timestamptz
+        return (lambda v: Int8Field.pack(8, TimestampMicros(v, Zone, True))), True
+    elif TypeOid == 1114:   #timestamp
+        return (lambda v: Int8Field.pack(8, TimestampMicros(v, Zone, False))), True
+    return None, False
+
+def EncodeColumn(Values, Encoder, Memo):
+    if not Memo:
+        return [PGNullField if v is None else Encoder(v) for v in Values]
+    Cache = {}
+    Fields = []
+    for v in Values:
+        if v is None:
+            Fields.append(PGNullField)
+            continue
+        Field = Cache.get(v)
+        if Field is None:
+            Field = Cache[v] = Encoder(v)
+        Fields.append(Field)
+    return Fields
+
+#returns the complete COPY BINARY stream, or None when a column type can't be encoded here
+def BinaryCopyStream(TypeOids, Zone, Columns):
+    Encoded = []
+    for TypeOid, Values in zip(TypeOids, Columns):
+        Encoder, Memo = BinaryEncoder(TypeOid, Zone)
+        if Encoder is None:
+            return None
+        Encoded.append(EncodeColumn(Values, Encoder, Memo))
+    RowHeader = struct.pack('>h', len(Columns))
+    RowCount = len(Columns[0])
+    return b''.join((PGCopyHeader, b''.join(chain.from_iterable(zip(repeat(RowHeader, RowCount), *Encoded))), PGCopyTrailer))
+
+#COPY a set of equally long columns into table_name - binary when every column type is supported, CSV otherwise
+def CopyColumns(cur, table_name, keys, Columns, CopyFormat='Binary'):
+    if CopyFormat == 'Binary':
+        TypeOids, Zone = CopyColumnTypes(cur, table_name, keys)
+        try:
+            Stream = BinaryCopyStream(TypeOids, Zone, Columns)
+        except (ValueError, TypeError, OverflowError) as e:
+            print('[Binary COPY encoding failed, using CSV: ' + str(e) + ']')
+            Stream = None
+        if Stream is not None:
+            columns = ', '.join('"{}"'.format(k) for k in keys)
+            sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT BINARY)'.format(table_name, columns)
+            cur.copy_expert(sql=sql, file=BytesIO(Stream))
+            return
+    #CSV gets epoch ns times as text - the session's wall time for timestamp columns, like the binary encoder writes
+    if any(type(v) is int for Key, Column in zip(keys, Columns) if Key == 'time' for v in Column):
+        TypeOids, Zone = CopyColumnTypes(cur, table_name, keys)
+        Columns = [[EpochNsText(v, Zone, TypeOid != 1114) if type(v) is int else v for v in Column] if Key == 'time' else Column
+                   for Key, TypeOid, Column in zip(keys, TypeOids, Columns)]
+    psql_insert_copy(cur, table_name, keys, zip(*Columns))
+
+#---------------- Value normalization --------------------------
+#single pass over the buffered values producing a float64 array plus a null mask.
+#all-numeric batches (the usual case) convert in one numpy call; otherwise only string values go through the
+#sentinel lookup and the precompiled Red Lion timestamp pattern. sentinels match the old Series.replace list:
+#'NULL', '', ' ' and ISO 8601 timestamps are null, 'ON'/'true' are 1, 'OFF'/'false' are 0 (bools convert natively)
+NullValue = float('nan')
+SentinelValues = {'NULL': NullValue, 'OFF': 0.0, 'ON': 1.0, 'true': 1.0, 'false': 0.0, '': NullValue, ' ': NullValue}
+RedLionTimestamp = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}')
+
+def NormalizeString(Value):
+    Sentinel = SentinelValues.get(Value)
+    if Sentinel is not None:
+        return Sentinel
+    if RedLionTimestamp.match(Value):
+        return NullValue
+    try:
+        return float(Value)
+    except ValueError:
+        return NullValue
+
+#a JSON int can be arbitrarily large - one that won't fit a double is stored as null rather than failing the batch
+def NormalizeNumber(Value):
+    try:
+        return float(Value)
+    except OverflowError:
+        return NullValue
+
+def NormalizeValues(Values):
+    try:
+        Array = np.array(Values, dtype=np.float64)
+    except (ValueError, TypeError, OverflowError):
+        Array = np.array([NormalizeString(v) if type(v) is str else (NormalizeNumber(v) if isinstance(v, (int, float)) else (v if v is None else NullValue)) for v in Values], dtype=np.float64)
+    return Array, np.isnan(Array)
+
+#---------------- Ingest buffer --------------------------
+#append-only columnar buffer - each Relay/Data message is unpacked straight from the parsed JSON
+#into plain lists, so buffering costs O(rows) instead of re-concatenating a dataframe per message
+class IngestBuffer:
+    def __init__(self):
+        self.Clear()
+
+    def __len__(self):
+        return len(self.Time)
+
+    def Clear(self):
+        self.Time = []
+        self.KnownTimes = set()
+        self.Equipment = []
+        self.Tagnum = []
+        self.Value = []
+
+    #RequestDict is the decoded Relay/Data payload: {equipment: {tagnum: {'Value': x, 'Time': t, 'TimeNs': ns}}} -
+    #the epoch ns acquisition stamp is used when the instrument sent one
+    def AppendMessage(self, RequestDict):
+        for Equipment, Entries in RequestDict.items():
+            Tags = list(Entries)
+            #pull both columns before touching the buffer so a malformed entry throws out the whole message
+            Times = [Entry['TimeNs'] if 'TimeNs' in Entry else Entry['Time'] for Entry in map(Entries.__getitem__, Tags)]
+            for Time in Times:
+                self.CheckTime(Time)
+            Values = [Entries[Tag]['Value'] for Tag in Tags]
+            self.Time.extend(Times)
+            self.Equipment.extend([Equipment] * len(Tags))
+            self.Tagnum.extend(Tags)
+            self.Value.extend(Values)
+        return len(self.Time)
+
+    #times have to be epoch ns or ISO 8601 text - anything else would only fail later in the rollup/compression stages
+    #or the COPY, so it throws the message out here. each distinct text is parsed once per flush window
+    def CheckTime(self, Time):
+        if type(Time) is int or Time in self.KnownTimes:
+            return
+        if not isinstance(Time, str):
+            raise ValueError('bad Time ' + repr(Time))
+        try:
+            datetime.fromisoformat(Time)
+        except ValueError:
+            raise ValueError('bad Time ' + repr(Time))
+        self.KnownTimes.add(Time)
+
+    #columns already unpacked from a packed Relay/Data payload
+    def AppendColumns(self, Equipment, Times, Tagnums, Values):
+        self.Time.extend(Times)
+        self.Equipment.extend([Equipment] * len(Tagnums))
+        self.Tagnum.extend(Tagnums)
+        self.Value.extend(Values)
+        return len(self.Time)
+
+    def Columns(self):
+        return (self.Time, self.Equipment, self.Tagnum, self.Value)
+
+#the cleaned columns of everything in the buffer, ready for CopyColumns
+def BufferBatch(Buffer):
+    Times, Equipment, Tagnums, Values = Buffer.Columns()
+    Array, Nulls = NormalizeValues(Values)
+    ValueList = Array.tolist()
+    #nulls reach COPY as None so postgres stores NULL
+    for Index in np.flatnonzero(Nulls).tolist():
+        ValueList[Index] = None
+    return (Times, Equipment, Tagnums, ValueList)
+
+#write a list of (table, keys, columns) batches in one transaction
+#the router (if any) turns raw default-table batches into per-table, dictionary-encoded batches inside that transaction
+def WriteBatches(engine, Batches, CopyFormat='Binary', Router=None):
+    dbapi_conn = engine.raw_connection()
+    try:
+        try:
+            with dbapi_conn.cursor() as cur:
+                if Router is not None:
+                    Batches = Router.Route(cur, Batches)
+                for TableName, Keys, Columns in Batches:
+                    CopyColumns(cur, TableName, Keys, Columns, CopyFormat)
+            dbapi_conn.commit()
+        except Exception:
+            if Router is not None:
+                Router.Rollback()
+            raise
+        if Router is not None:
+            Router.Commit()
+    finally:
+        dbapi_conn.close()
+
+#---------------- Table routing and tag dictionary --------------------------
+#TableMode 'Default' keeps every row in DefaultTable with text equipment/tagnum columns.
+#'Equipment' routes rows into one table per equipment, 'Monthly' into one table per calendar month.
+#routed tables store (time, tagid, value) - tagid comes from a dictionary table mapping (equipment, tagnum)
+#to a small integer, and value is a typed double precision column.
+#tables are created on first use from NewTableVerbiage, HyperTableConversionVerbiage and IndexVerbiage,
+#where {table} is replaced by the routed table name
+RoutedColumns = ('time', 'tagid', 'value')
+DefaultNewTableVerbiage = 'CREATE TABLE IF NOT EXISTS {table} (time TIMESTAMPTZ NOT NULL, tagid INTEGER NOT NULL, value DOUBLE PRECISION)'
+DefaultIndexVerbiage = 'CREATE INDEX IF NOT EXISTS {table}_tagid_time_idx ON {table} (tagid, time DESC)'
+
+def TableIdentifier(Name):
+    return re.sub(r'[^a-z0-9_]', '_', Name.lower())[:63]
+
+def TypedValue(Value):
+    try:
+        return None if Value is None else float(Value)
+    except (ValueError, TypeError):
+        return None
+
+class TableRouter:
+    def __init__(self, Details):
+        self.Mode = Details.get('TableMode', 'Default')
+        self.DefaultTable = Details['DefaultTable']
+        self.DictionaryTable = TableIdentifier(Details.get('DictionaryTable', self.DefaultTable + '_tags'))
+        self.NewTableVerbiage = Details.get('NewTableVerbiage', '').strip() or DefaultNewTableVerbiage
+        self.HyperTableConversionVerbiage = Details.get('HyperTableConversionVerbiage', '').strip()
+        self.IndexVerbiage = Details.get('IndexVerbiage', '').strip() or DefaultIndexVerbiage
+        self.TableVerbiage = {}
+        self.MonthRange = (0, 0, None)
+        self.TagIds = {}
+        self.KnownTables = set()
+        #ids and tables from the transaction in flight, only trusted once it commits
+        self.PendingTagIds = {}
+        self.PendingTables = set()
+
+    def Commit(self):
+        self.TagIds.update(self.PendingTagIds)
+        self.KnownTables.update(self.PendingTables)
+        self.PendingTagIds = {}
+        self.PendingTables = set()
+
+    def Rollback(self):
+        self.PendingTagIds = {}
+        self.PendingTables = set()
+
+    def EnsureDictionary(self, cur):
+        if self.DictionaryTable in self.KnownTables or self.DictionaryTable in self.PendingTables:
+            return
+        cur.execute('CREATE TABLE IF NOT EXISTS {} (tagid SERIAL PRIMARY KEY, equipment TEXT NOT NULL, tagnum TEXT NOT NULL, UNIQUE (equipment, tagnum))'.format(self.DictionaryTable))
+        #warm the cache with everything already known so only new tags cost a round trip
+        cur.execute('SELECT equipment, tagnum, tagid FROM {}'.format(self.DictionaryTable))
+        for Equipment, Tagnum, TagId in cur.fetchall():
+            self.PendingTagIds[(Equipment, Tagnum)] = TagId
+        self.PendingTables.add(self.DictionaryTable)
+
+    def TagId(self, cur, Equipment, Tagnum):
+        Key = (Equipment, Tagnum)
+        TagId = self.TagIds.get(Key)
+        if TagId is None:
+            TagId = self.PendingTagIds.get(Key)
+        if TagId is None:
+            cur.execute('INSERT INTO {} (equipment, tagnum) VALUES (%s, %s) ON CONFLICT (equipment, tagnum) DO UPDATE SET tagnum = EXCLUDED.tagnum RETURNING tagid'.format(self.DictionaryTable), Key)
+            TagId = self.PendingTagIds[Key] = cur.fetchone()[0]
+        return TagId
+
+    #other writers (rollups) register the statements that create their tables here
+    def RegisterTable(self, TableName, Verbiage):
+        self.TableVerbiage[TableName] = Verbiage
+
+    def EnsureTable(self, cur, TableName, Verbiage=None):
+        if TableName in self.KnownTables or TableName in self.PendingTables:
+            return
+        if Verbiage is None:
+            Verbiage = (self.NewTableVerbiage, self.HyperTableConversionVerbiage, self.IndexVerbiage)
+        for Verbiage in Verbiage:
+            if Verbiage:
+                cur.execute(Verbiage.replace('{table}', TableName))
+        self.PendingTables.add(TableName)
+
+    def RoutedTable(self, Equipment, Time):
+        if self.Mode == 'Equipment':
+            return TableIdentifier(self.DefaultTable + '_' + Equipment)
+        return TableIdentifier(self.DefaultTable + '_' + self.Month(Time))
+
+    #'YYYY-MM' of a time - epoch ns stamps by this machine's local calendar, the month they fall in is kept
+    def Month(self, Time):
+        if type(Time) is not int:
+            return str(Time)[:7]
+        Start, End, Month = self.MonthRange
+        if not Start <= Time < End:
+            First = datetime.fromtimestamp(Time // 1000000000).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            Next = (First + timedelta(days=32)).replace(day=1)
+            Start, End, Month = self.MonthRange = (int(First.timestamp()) * 1000000000, int(Next.timestamp()) * 1000000000, First.strftime('%Y-%m'))
+        return Month
+
+    #rewrite raw (time, equipment, tagnum, value) batches for DefaultTable, anything else passes through untouched
+    def Route(self, cur, Batches):
+        Routed = {}
+        Others = []
+        for TableName, Keys, Columns in Batches:
+            if TableName in self.TableVerbiage:
+                self.EnsureTable(cur, TableName, self.TableVerbiage[TableName])
+            if self.Mode == 'Default' or TableName != self.DefaultTable or tuple(Keys) != DBColumns:
+                Others.append((TableName, Keys, Columns))
+                continue
+            self.EnsureDictionary(cur)
+            for Time, Equipment, Tagnum, Value in zip(*Columns):
+                Target = self.RoutedTable(Equipment, Time)
+                Rows = Routed.get(Target)
+                if Rows is None:
+                    self.EnsureTable(cur, Target)
+                    Rows = Routed[Target] = ([], [], [])
+                Rows[0].append(Time)
+                Rows[1].append(self.TagId(cur, Equipment, Tagnum))
+                Rows[2].append(TypedValue(Value))
+        return [(Target, RoutedColumns, Rows) for Target, Rows in Routed.items()] + Others
+
+#---------------- Compression stage --------------------------
+#optional per-tag compression before rows are written. settings come from the instrument configs listed in the
+#system config - a channel opts in with "Compression": {"Method": ..., "Deviation": ..., "Heartbeat": ...}
+#  Absolute     - store when the value moves more than Deviation from the last stored value
+#  Percent      - same, with Deviation as a percentage of the last stored value
+#  SwingingDoor - store only the points needed so a straight line between stored points stays within Deviation
+#                 of every dropped point
+#Heartbeat (seconds) forces a stored row at least that often. Non-numeric values always pass straight through.
+def LoadCompressionSettings(SystemConfigPath):
+    SystemConfig, EquipmentConfigs = MQTT_Config_Lib.LoadEquipmentConfigs(SystemConfigPath)
+    Settings = {}
+    for Equipment, InstrConfig in EquipmentConfigs.items():
+        for Tagnum, Channel in InstrConfig.get('Channels', {}).items():
+            Compression = Channel.get('Compression')
+            if Compression:
+                Settings[(Equipment, Tagnum)] = (Compression.get('Method', 'Absolute'), float(Compression.get('Deviation', 0)), float(Compression.get('Heartbeat', 0)) or float('inf'))
+    return Settings
+
+class TagCompressionState:
+    __slots__ = ('StoredTime', 'StoredValue', 'HeldTime', 'HeldValue', 'HeldStamp', 'LowSlope', 'HighSlope')
+
+    def __init__(self, StoredTime, StoredValue):
+        self.StoredTime = StoredTime
+        self.StoredValue = StoredValue
+        self.Hold(None, None, None)
+
+    def Hold(self, HeldTime, HeldValue, HeldStamp, LowSlope=float('-inf'), HighSlope=float('inf')):
+        self.HeldTime = HeldTime
+        self.HeldValue = HeldValue
+        self.HeldStamp = HeldStamp
+        self.LowSlope = LowSlope
+        self.HighSlope = HighSlope
+
+class CompressionStage:
+    def __init__(self, Settings):
+        self.Settings = Settings
+        self.State = {}
+        self.TimeCache = {}
+        self.RowsIn = 0
+        self.RowsOut = 0
+
+    def Seconds(self, Time):
+        if type(Time) is int: #epoch ns
+            return Time / 1e9
+        Stamp = self.TimeCache.get(Time)
+        if Stamp is None:
+            if len(self.TimeCache) > 10000:
+                self.TimeCache.clear()
+            Stamp = self.TimeCache[Time] = datetime.fromisoformat(str(Time)).timestamp()
+        return Stamp
+
+    #returns the rows that have to be stored - including held swinging door points this batch releases
+    def Filter(self, Columns):
+        Output = ([], [], [], [])
+        for Time, Equipment, Tagnum, Value in zip(*Columns):
+            Key = (Equipment, Tagnum)
+            Setting = self.Settings.get(Key)
+            Number = TypedValue(Value)
+            if Setting is None or Number is None or Number != Number:
+                if Setting is not None:
+                    self.Release(Key, Output)
+                KeepRow(Output, Time, Equipment, Tagnum, Value)
+                continue
+            Method, Deviation, Heartbeat = Setting
+            try:
+                Now = self.Seconds(Time)
+            except (ValueError, TypeError):
+                #a time we can't place - store the row as is and start the tag over, like a non-numeric value
+                self.Release(Key, Output)
+                KeepRow(Output, Time, Equipment, Tagnum, Value)
+                continue
+            State = self.State.get(Key)
+            if State is None or Now - State.StoredTime >= Heartbeat or Now <= (State.StoredTime if State.HeldTime is None else State.HeldTime):
+                #first point, heartbeat due, or time didn't move forward - store it and restart from here
+                self.Release(Key, Output)
+                self.State[Key] = TagCompressionState(Now, Number)
+                KeepRow(Output, Time, Equipment, Tagnum, Value)
+            elif Method == 'SwingingDoor':
+                self.SwingingDoor(Key, State, Now, Number, Time, Deviation, Output)
+            else:
+                Limit = abs(State.StoredValue) * Deviation / 100.0 if Method == 'Percent' else Deviation
+                if abs(Number - State.StoredValue) > Limit:
+                    State.StoredTime, State.StoredValue = Now, Number
+                    KeepRow(Output, Time, Equipment, Tagnum, Value)
+        self.RowsIn += len(Columns[0])
+        self.RowsOut += len(Output[0])
+        return Output
+
+    def SwingingDoor(self, Key, State, Now, Number, Time, Deviation, Output):
+        if State.HeldTime is None:
+            State.Hold(Now, Number, Time)
+            return
+        #the held point becomes an intermediate point - narrow the doors with it
+        Span = State.HeldTime - State.StoredTime
+        LowSlope = max(State.LowSlope, (State.HeldValue - Deviation - State.StoredValue) / Span)
+        HighSlope = min(State.HighSlope, (State.HeldValue + Deviation - State.StoredValue) / Span)
+        Slope = (Number - State.StoredValue) / (Now - State.StoredTime)
+        if LowSlope <= Slope <= HighSlope:
+            #a line from the stored point to the new one still passes every dropped point - keep holding
+            State.Hold(Now, Number, Time, LowSlope, HighSlope)
+            return
+        #door closed - store the held point and start a new segment from it
+        KeepRow(Output, State.HeldStamp, Key[0], Key[1], State.HeldValue)
+        State.StoredTime, State.StoredValue = State.HeldTime, State.HeldValue
+        State.Hold(Now, Number, Time)
+
+    #store a tag's held swinging door point, if it has one
+    def Release(self, Key, Output):
+        State = self.State.pop(Key, None)
+        if State is not None and State.HeldTime is not None:
+            KeepRow(Output, State.HeldStamp, Key[0], Key[1], State.HeldValue)
+
+    #rows still held back, used when the server shuts down
+    def Drain(self):
+        Output = ([], [], [], [])
+        for Key in list(self.State):
+            self.Release(Key, Output)
+        return Output
+
+def KeepRow(Output, Time, Equipment, Tagnum, Value):
+    Output[0].append(Time)
+    Output[1].append(Equipment)
+    Output[2].append(Tagnum)
+    Output[3].append(Value)
+
+#---------------- Rollup aggregator --------------------------
+#streaming min/max/mean/count/last per (equipment, tag, bucket) for each resolution in Rollups (e.g. ["1s", "1min", "1h"]).
+#each equipment has its own watermark (latest sample time seen); a bucket closes once the watermark passes its end by
+#RollupLateWindow seconds, so late rows inside that window still land in the right bucket. rows arriving for a bucket
+#that already closed are counted in LateRows and only kept in the raw table.
+#closed buckets are written to <DefaultTable>_rollup_<resolution> in the same transaction as the raw rows
+RollupColumns = ('bucket', 'equipment', 'tagnum', 'min', 'max', 'mean', 'count', 'last')
+RollupVerbiage = 'CREATE TABLE IF NOT EXISTS {table} (bucket TIMESTAMPTZ NOT NULL, equipment TEXT NOT NULL, tagnum TEXT NOT NULL, min DOUBLE PRECISION, max DOUBLE PRECISION, mean DOUBLE PRECISION, count INTEGER, last DOUBLE PRECISION)'
+RollupIndexVerbiage = 'CREATE INDEX IF NOT EXISTS {table}_tag_bucket_idx ON {table} (equipment, tagnum, bucket DESC)'
+RollupUnits = {'s': 1, 'min': 60, 'h': 3600, 'd': 86400}
+
+def RollupSeconds(Resolution):
+    Match = re.match(r'^(\d+)(s|min|h|d)$', Resolution)
+    if Match is None:
+        raise ValueError('unknown rollup resolution ' + Resolution)
+    return int(Match.group(1)) * RollupUnits[Match.group(2)]
+
+class RollupAggregator:
+    def __init__(self, Details, Router=None):
+        self.LateWindow = float(Details.get('RollupLateWindow', 5))
+        self.Resolutions = []
+        for Resolution in Details['Rollups']:
+            TableName = TableIdentifier(Details['DefaultTable'] + '_rollup_' + Resolution)
+            self.Resolutions.append((RollupSeconds(Resolution), TableName))
+            if Router is not None:
+                Router.RegisterTable(TableName, (RollupVerbiage, RollupIndexVerbiage))
+        #(seconds, equipment, tagnum, bucket start) -> [min, max, sum, count, last time, last value]
+        self.Buckets = {}
+        self.Watermark = {}
+        self.ClosedBefore = {}
+        self.TimeCache = {}
+        self.LateRows = 0
+
+    def Seconds(self, Time):
+        if type(Time) is int: #epoch ns
+            return Time / 1e9
+        Stamp = self.TimeCache.get(Time)
+        if Stamp is None:
+            if len(self.TimeCache) > 10000:
+                self.TimeCache.clear()
+            Stamp = self.TimeCache[Time] = datetime.fromisoformat(str(Time)).timestamp()
+        return Stamp
+
+    def Observe(self, Columns):
+        for Time, Equipment, Tagnum, Value in zip(*Columns):
+            Number = TypedValue(Value)
+            if Number is None or Number != Number:
+                continue
+            Now = self.Seconds(Time)
+            if Now > self.Watermark.get(Equipment, float('-inf')):
+                self.Watermark[Equipment] = Now
+            ClosedBefore = self.ClosedBefore.get(Equipment, float('-inf'))
+            for Seconds, TableName in self.Resolutions:
+                Start = Now - Now % Seconds
+                if Start + Seconds <= ClosedBefore:
+                    self.LateRows += 1
+                    continue
+                Key = (Seconds, Equipment, Tagnum, Start)
+                Bucket = self.Buckets.get(Key)
+                if Bucket is None:
+                    self.Buckets[Key] = [Number, Number, Number, 1, Now, Number]
+                    continue
+                if Number < Bucket[0]:
+                    Bucket[0] = Number
+                if Number > Bucket[1]:
+                    Bucket[1] = Number
+                Bucket[2] += Number
+                Bucket[3] += 1
+                if Now >= Bucket[4]:
+                    Bucket[4], Bucket[5] = Now, Number
+
+    #batches for every bucket that closed (all of them when Final)
+    def Collect(self, Final=False):
+        for Equipment, Watermark in self.Watermark.items():
+            self.ClosedBefore[Equipment] = float('inf') if Final else Watermark - self.LateWindow
+        Output = {TableName: ([], [], [], [], [], [], [], []) for Seconds, TableName in self.Resolutions}
+        TableNames = dict(self.Resolutions)
+        for Key in [Key for Key in self.Buckets if Key[3] + Key[0] <= self.ClosedBefore[Key[1]]]:
+            Seconds, Equipment, Tagnum, Start = Key
+            Minimum, Maximum, Total, Count, LastTime, Last = self.Buckets.pop(Key)
+            Row = (datetime.fromtimestamp(Start, timezone.utc).isoformat(), Equipment, Tagnum, Minimum, Maximum, Total / Count, Count, Last)
+            for Column, Value in zip(Output[TableNames[Seconds]], Row):
+                Column.append(Value)
+        return [(TableName, RollupColumns, Columns) for TableName, Columns in Output.items() if Columns[0]]
+
+#---------------- Local spool --------------------------
+#when postgres is unreachable whole batches go to an on-disk spool of append-only, memory-mapped
+#segment files and are replayed oldest first once the connection returns.
+#segment layout: header [magic, replay offset] followed by records [magic, length, crc32, payload]
+SpoolHeader = struct.Struct('>4sI')
+SpoolRecord = struct.Struct('>4sII')
+SpoolMagic = b'RSPL'
+RecordMagic = b'RREC'
+
+class SpoolSegment:
+    def __init__(self, Path, Size=None):
+        Create = Size is not None
+        self.Path = Path
+        self.File = open(Path, 'w+b' if Create else 'r+b')
+        if Create:
+            self.File.truncate(Size)
+        self.Size = os.path.getsize(Path)
+        self.Map = mmap.mmap(self.File.fileno(), self.Size)
+        if Create:
+            SpoolHeader.pack_into(self.Map, 0, SpoolMagic, SpoolHeader.size)
+        Magic, self.ReadOffset = SpoolHeader.unpack_from(self.Map, 0)
+        if Magic != SpoolMagic:
+            self.Close()
+            raise ValueError('not a spool segment: ' + Path)
+        #walk the records to find where the valid data ends - a torn write from a crash stops the scan
+        self.Records = 0
+        Offset = SpoolHeader.size
+        while Offset + SpoolRecord.size <= self.Size:
+            Magic, Length, Crc = SpoolRecord.unpack_from(self.Map, Offset)
+            End = Offset + SpoolRecord.size + Length
+            if Magic != RecordMagic or End > self.Size or zlib.crc32(self.Map[Offset + SpoolRecord.size:End]) != Crc:
+                break
+            if Offset >= self.ReadOffset:
+                self.Records += 1
+            Offset = End
+        self.WriteOffset = Offset
+        self.NextOffset = None
+
+    def Fits(self, Length):
+        return self.WriteOffset + SpoolRecord.size + Length <= self.Size
+
+    def Append(self, Payload):
+        Start = self.WriteOffset + SpoolRecord.size
+        self.Map[Start:Start + len(Payload)] = Payload
+        SpoolRecord.pack_into(self.Map, self.WriteOffset, RecordMagic, len(Payload), zlib.crc32(Payload))
+        self.WriteOffset = Start + len(Payload)
+        self.Records += 1
+
+    #oldest record that hasn't been replayed yet, None when the segment is used up
+    def Peek(self):
+        if self.ReadOffset >= self.WriteOffset:
+            return None
+        Magic, Length, Crc = SpoolRecord.unpack_from(self.Map, self.ReadOffset)
+        Start = self.ReadOffset + SpoolRecord.size
+        self.NextOffset = Start + Length
+        return self.Map[Start:self.NextOffset]
+
+    def Ack(self):
+        self.ReadOffset = self.NextOffset
+        SpoolHeader.pack_into(self.Map, 0, SpoolMagic, self.ReadOffset)
+        self.Records -= 1
+
+    def Flush(self):
+        self.Map.flush()
+
+    def Close(self):
+        self.Map.close()
+        self.File.close()
+
+    def Delete(self):
+        self.Close()
+        os.remove(self.Path)
+
+#FsyncPolicy: 'Always' syncs every append and replay, 'Segment' syncs when a segment is closed out, 'None' leaves it to the OS
+class SegmentSpool:
+    def __init__(self, Directory, MaxBytes, SegmentBytes, FsyncPolicy='Segment'):
+        self.Directory = Directory
+        self.MaxBytes = MaxBytes
+        self.SegmentBytes = SegmentBytes
+        self.FsyncPolicy = FsyncPolicy
+        self.DroppedRecords = 0
+        self.Segments = []
+        self.NextSeq = 0
+        os.makedirs(Directory, exist_ok=True)
+        for Name in sorted(os.listdir(Directory)):
+            if not Name.endswith('.spool'):
+                continue
+            self.NextSeq = max(self.NextSeq, int(Name.split('.')[0]) + 1)
+            try:
+                Segment = SpoolSegment(os.path.join(Directory, Name))
+            except Exception as e:
+                print('[Skipping unreadable spool segment: ' + str(e) + ']')
+                continue
+            if Segment.Records == 0:
+                Segment.Delete()
+            else:
+                self.Segments.append(Segment)
+
+    def NewSegment(self, Size):
+        Path = os.path.join(self.Directory, '{:012d}.spool'.format(self.NextSeq))
+        self.NextSeq += 1
+        Segment = SpoolSegment(Path, Size)
+        self.Segments.append(Segment)
+        return Segment
+
+    def Append(self, Payload):
+        Active = self.Segments[-1] if self.Segments else None
+        if Active is None or not Active.Fits(len(Payload)):
+            if Active is not None and self.FsyncPolicy != 'None':
+                Active.Flush()
+            Active = self.NewSegment(max(self.SegmentBytes, SpoolHeader.size + SpoolRecord.size + len(Payload)))
+        Active.Append(Payload)
+        if self.FsyncPolicy == 'Always':
+            Active.Flush()
+        #over the cap - give up the oldest data first
+        while len(self.Segments) > 1 and self.Bytes() > self.MaxBytes:
+            Oldest = self.Segments.pop(0)
+            self.DroppedRecords += Oldest.Records
+            Oldest.Delete()
+
+    def Peek(self):
+        while self.Segments:
+            Payload = self.Segments[0].Peek()
+            if Payload is not None:
+                return Payload
+            if len(self.Segments) == 1:
+                return None #keep the active segment around for new appends
+            self.Segments.pop(0).Delete()
+        return None
+
+    def Ack(self):
+        self.Segments[0].Ack()
+        if self.FsyncPolicy == 'Always':
+            self.Segments[0].Flush()
+
+    def Bytes(self):
+        return sum(Segment.Size for Segment in self.Segments)
+
+    def Close(self):
+        for Segment in self.Segments:
+            if self.FsyncPolicy != 'None':
+                Segment.Flush()
+            Segment.Close()
+        self.Segments = []
+
+    #spool depth as (records waiting for replay, bytes on disk)
+    def Depth(self):
+        return sum(Segment.Records for Segment in self.Segments), self.Bytes()
+
+def BatchRows(Batches):
+    return sum(len(Columns[0]) for TableName, Keys, Columns in Batches)
+
+def EncodeSpoolBatches(Batches):
+    return json.dumps([[TableName, list(Keys), [list(Column) for Column in Columns]] for TableName, Keys, Columns in Batches]).encode()
+
+def DecodeSpoolBatches(Payload):
+    return json.loads(bytes(Payload))
+
+#---------------- Write failures --------------------------
+#a failed write is either the connection (retry later, spool) or the batch itself (bad time text, a value the column
+#rejects, a missing table) - retrying the batch can never work and would block everything queued behind it.
+#psycopg2 isn't imported here, so the DBAPI error classes are matched by name (sqlalchemy wrappers carry it in .orig)
+ConnectionErrors = ('OperationalError', 'InterfaceError')
+BatchErrors = ('DataError', 'IntegrityError', 'ProgrammingError', 'NotSupportedError')
+
+def WriteFailure(Error):
+    for Candidate in (Error, getattr(Error, 'orig', None)):
+        if Candidate is None:
+            continue
+        Names = {Class.__name__ for Class in type(Candidate).__mro__}
+        if Names.intersection(ConnectionErrors) or isinstance(Candidate, (ConnectionError, TimeoutError)):
+            return 'Connection'
+        if Names.intersection(BatchErrors) or isinstance(Candidate, (ValueError, TypeError, OverflowError, KeyError)):
+            return 'Batch'
+    return 'Unknown'
+
+#---------------- Worker sharding --------------------------
+#supervisor mode runs Workers copies of the server under one DatabaseName. Hash mode keeps every equipment on one
+#worker (crc32 of the equipment name) so compression and rollup state stay whole; Shared mode lets the broker
+#round-robin $share/<DatabaseName>/Relay/Data/# and is only safe without per-equipment stages
+def ShardMode(Details):
+    Mode = Details.get('ShardMode', 'Hash')
+    if Mode == 'Shared' and (Details.get('Rollups') or Details.get('Compression')):
+        print('[ShardMode Shared splits equipment across workers - using Hash because Rollups/Compression are on]')
+        Mode = 'Hash'
+    return Mode
+
+def ShardIndex(Topic, WorkerCount):
+    Parts = Topic.split('/')
+    Equipment = Parts[2] if len(Parts) > 2 else Topic
+    return zlib.crc32(Equipment.encode()) % WorkerCount
+
+#histogram buckets for rows per flush
+FlushRowBuckets = (10, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+#---------------- Background writer --------------------------
+#dedicated writer thread fed by a bounded queue - the paho network thread only enqueues raw payloads,
+#parsing and the COPY happen here so a slow postgres can't stall MQTT keepalive.
+#a flush happens every FlushInterval seconds or once FlushRows are buffered, whichever comes first.
+#counters, gauges and histograms for throughput live in self.Metrics and are published by MQTT_Metrics_Lib
+class DatabaseWriter(threading.Thread):
+    def __init__(self, engine, DBConfig, client, ConfigDir='.', Worker=None):
+        threading.Thread.__init__(self, name='DatabaseWriter', daemon=True)
+        Details = DBConfig['DatabaseDetails']
+        self.engine = engine
+        self.client = client
+        self.TableName = Details['DefaultTable']
+        self.Router = TableRouter(Details)
+        self.CopyFormat = Details.get('CopyFormat', 'Binary')
+        self.DatabaseName = DBConfig['DatabaseTags']['DatabaseName']
+        self.FlushInterval = float(Details.get('FlushInterval', 1))
+        self.FlushRows = int(Details.get('FlushRows', 5000))
+        self.MaxBufferRows = int(Details.get('MaxBufferRows', 100000))
+        self.QueueTimeout = float(Details.get('QueueTimeout', 5))
+        self.Queue = queue.Queue(maxsize=int(Details.get('QueueSize', 10000)))
+        self.Buffer = IngestBuffer()
+        self.TagMaps = MQTT_Payload_Lib.TagMaps()
+        self.Spool = None
+        if Details.get('SpoolDirectory'):
+            #each worker gets its own spool, segments are single-writer
+            SpoolDirectory = Details['SpoolDirectory'] if Worker is None else os.path.join(Details['SpoolDirectory'], 'worker' + str(Worker))
+            self.Spool = SegmentSpool(SpoolDirectory, int(float(Details.get('SpoolMaxMB', 1024)) * 1048576),
+                                      int(float(Details.get('SpoolSegmentMB', 16)) * 1048576), Details.get('SpoolFsync', 'Segment'))
+        self.SpoolReplayBatches = int(Details.get('SpoolReplayBatches', 20))
+        #batches that can't be written go to DeadLetterDirectory (or are dropped) after BatchRetries failed attempts,
+        #straight away when the error is clearly the batch's own
+        self.DeadLetterDirectory = Details.get('DeadLetterDirectory') or None
+        if self.DeadLetterDirectory is not None and Worker is not None:
+            self.DeadLetterDirectory = os.path.join(self.DeadLetterDirectory, 'worker' + str(Worker))
+        self.BatchRetries = int(Details.get('BatchRetries', 5))
+        self.HeadFailures = 0
+        self.Rollups = None
+        if Details.get('Rollups'):
+            self.Rollups = RollupAggregator(Details, self.Router)
+        self.Compression = None
+        if Details.get('Compression') and Details.get('SystemConfig'):
+            self.Compression = CompressionStage(LoadCompressionSettings(os.path.join(ConfigDir, Details['SystemConfig'])))
+        #prepared batches waiting for the database, oldest first
+        self.Held = []
+        self.HeldRows = 0
+        self.StopToken = object()
+        self.Stopping = threading.Event()
+        self.StopTimeout = float(Details.get('StopTimeout', 30))
+        self.Dropped = 0
+        self.ReportedDropped = 0
+        self.LastFlushRows = 0
+        self.LastFlushSeconds = 0.0
+        self.Metrics = MQTT_Metrics_Lib.MetricsRegistry({'database': self.DatabaseName} if Worker is None else {'database': self.DatabaseName, 'worker': Worker})
+        self.Metrics.GaugeFunction('relay_queue_depth', self.Queue.qsize)
+        self.Metrics.GaugeFunction('relay_buffer_rows', lambda: len(self.Buffer) + self.HeldRows)
+        if self.Spool is not None:
+            self.Metrics.GaugeFunction('relay_spool_batches', lambda: self.Spool.Depth()[0])
+            self.Metrics.GaugeFunction('relay_spool_bytes', lambda: self.Spool.Depth()[1])
+        if self.Compression is not None:
+            self.Metrics.GaugeFunction('relay_compression_ratio', lambda: self.Compression.RowsOut / self.Compression.RowsIn if self.Compression.RowsIn else 1.0)
+        if self.Rollups is not None:
+            self.Metrics.GaugeFunction('relay_rollup_late_rows', lambda: self.Rollups.LateRows)
+
+    #called from the paho thread - blocks for at most QueueTimeout when the writer is behind, then drops the message.
+    #the topic tells JSON, packed payloads and tag maps apart
+    def Submit(self, Payload, Topic=''):
+        try:
+            self.Queue.put((Topic, Payload), timeout=self.QueueTimeout)
+            return True
+        except queue.Full:
+            self.Dropped += 1
+            self.Metrics.Increment('relay_dropped_messages_total')
+            return False
+
+    #flush whatever is left and wait for the thread to finish (used by the poison pill). the stop token goes in behind
+    #the queued messages when there's room; a queue left full by backpressure can't take it, so the Stopping event
+    #tells run to finish anyway. waits at most StopTimeout seconds, so a hung database can't hold up the shutdown
+    def Stop(self):
+        self.Stopping.set()
+        try:
+            self.Queue.put(self.StopToken, timeout=self.QueueTimeout)
+        except queue.Full:
+            pass
+        self.join(self.StopTimeout)
+        if self.is_alive():
+            print('[Database writer still busy after ' + str(self.StopTimeout) + ' s, shutting down without it]')
+
+    def run(self):
+        NextFlush = time.monotonic() + self.FlushInterval
+        while True:
+            #backpressure - while the database refuses writes stop draining the queue so Submit blocks
+            if len(self.Buffer) + self.HeldRows >= self.MaxBufferRows:
+                self.Stopping.wait(max(NextFlush - time.monotonic(), 0))
+                Item = None
+            else:
+                try:
+                    Item = self.Queue.get(timeout=max(NextFlush - time.monotonic(), 0))
+                except queue.Empty:
+                    Item = None
+            if Item is None and self.Stopping.is_set():
+                Item = self.StopToken
+            if Item is self.StopToken:
+                self.Flush(Final=True)
+                if self.Spool is not None:
+                    self.Spool.Close()
+                return
+            if Item is not None:
+                try:
+                    Topic, Payload = Item
+                    if Topic.startswith('Relay/TagMap/'):
+                        self.TagMaps.Update(Topic.split('/')[2], Payload)
+                    else:
+                        Rows = len(self.Buffer)
+                        if Topic.endswith(MQTT_Payload_Lib.PackedSuffix):
+                            Equipment = Topic.split('/')[2]
+                            self.Buffer.AppendColumns(Equipment, *self.TagMaps.Unpack(Equipment, Payload))
+                        else:
+                            self.Buffer.AppendMessage(json.loads(Payload.decode()))
+                        self.Metrics.Increment('relay_messages_total')
+                        self.Metrics.Increment('relay_rows_total', len(self.Buffer) - Rows)
+                except Exception as d:
+                    Status = '[Received bad message: ' + str(d) + ']'
+                    print(Status)
+                    self.Metrics.Increment('relay_bad_messages_total')
+            if len(self.Buffer) >= self.FlushRows or time.monotonic() >= NextFlush:
+                self.Flush()
+                self.ReportDropped()
+                NextFlush = time.monotonic() + self.FlushInterval
+
+    #clean (and roll up and compress) everything buffered into the batches that get written - Final also releases held compression points.
+    #the raw batch is left out when nothing is left in it (an empty buffer on the final flush, or every row compressed away)
+    def PrepareBatches(self, Final=False):
+        Columns = BufferBatch(self.Buffer)
+        self.Buffer.Clear()
+        #rollups see every raw value, compression only decides which raw rows get stored
+        RollupBatches = []
+        if self.Rollups is not None:
+            self.Rollups.Observe(Columns)
+            RollupBatches = self.Rollups.Collect(Final)
+        if self.Compression is not None:
+            Columns = self.Compression.Filter(Columns)
+            if Final:
+                Columns = tuple(Kept + Drained for Kept, Drained in zip(Columns, self.Compression.Drain()))
+        RawBatches = [(self.TableName, DBColumns, Columns)] if len(Columns[0]) else []
+        return RawBatches + RollupBatches
+
+    def Flush(self, Final=False):
+        if len(self.Buffer) or Final:
+            try:
+                Batches = self.PrepareBatches(Final)
+            except Exception as e:
+                #a row the rollup or compression stage can't take must not take the writer thread down with it
+                Status = '[Dropped a batch that could not be prepared: ' + str(e) + ']'
+                print(Status)
+                self.client.publish("Relay/ServerIssue/" + self.DatabaseName, json.dumps(Status))
+                self.Metrics.Increment('relay_bad_batches_total')
+                self.Buffer.Clear()
+                Batches = []
+            if BatchRows(Batches):
+                self.Held.append(Batches)
+                self.HeldRows += BatchRows(Batches)
+        while self.Held:
+            FlushStart = time.perf_counter()
+            try:
+                WriteBatches(self.engine, self.Held[0], self.CopyFormat, self.Router)
+            except Exception as e:
+                if self.Poisoned(e):
+                    Batches = self.Held.pop(0)
+                    self.HeldRows -= BatchRows(Batches)
+                    self.DeadLetter(Batches, e)
+                    continue
+                Status = '[Bad database write, ' + str(self.HeldRows) + ' rows held for retry: ' + str(e) + ']'
+                if self.Spool is not None:
+                    try:
+                        while self.Held:
+                            self.Spool.Append(EncodeSpoolBatches(self.Held[0]))
+                            self.HeldRows -= BatchRows(self.Held.pop(0))
+                        Status = '[Bad database write, rows spooled to disk (' + str(self.Spool.Depth()[0]) + ' batches waiting): ' + str(e) + ']'
+                    except Exception as s:
+                        Status = '[Bad database write and spool failed, ' + str(self.HeldRows) + ' rows held for retry: ' + str(s) + ']'
+                print(Status)
+                self.client.publish("Relay/ServerIssue/" + self.DatabaseName, json.dumps(Status))
+                self.Metrics.Increment('relay_write_failures_total')
+                return
+            self.HeadFailures = 0
+            RowCount = BatchRows(self.Held.pop(0))
+            self.HeldRows -= RowCount
+            self.LastFlushRows = RowCount
+            self.LastFlushSeconds = time.perf_counter() - FlushStart
+            self.Metrics.Increment('relay_rows_written_total', RowCount)
+            self.Metrics.Observe('relay_flush_rows', RowCount, Buckets=FlushRowBuckets)
+            self.Metrics.Observe('relay_flush_seconds', self.LastFlushSeconds)
+            print('Flushed ' + str(RowCount) + ' rows in ' + str(round(self.LastFlushSeconds, 4)) + ' s, queue depth ' + str(self.Queue.qsize()))
+        self.ReplaySpool()
+
+    #the connection is good again - replay a limited number of spooled batches per flush, oldest first
+    def ReplaySpool(self):
+        if self.Spool is None:
+            return
+        Replayed = 0
+        while Replayed < self.SpoolReplayBatches:
+            Payload = self.Spool.Peek()
+            if Payload is None:
+                break
+            try:
+                WriteBatches(self.engine, DecodeSpoolBatches(Payload), self.CopyFormat, self.Router)
+            except Exception as e:
+                if not self.Poisoned(e):
+                    print('[Spool replay stopped: ' + str(e) + ']')
+                    break
+                self.DeadLetter(DecodeSpoolBatches(Payload), e)
+            self.HeadFailures = 0
+            self.Spool.Ack()
+            self.Metrics.Increment('relay_spool_replayed_total')
+            Replayed += 1
+        if Replayed:
+            SpoolRecords, SpoolBytes = self.Spool.Depth()
+            print('Replayed ' + str(Replayed) + ' spooled batches, spool depth ' + str(SpoolRecords) + ' batches / ' + str(SpoolBytes) + ' bytes')
+
+    #True when the batch at the head of the queue (held or spooled) should be given up on - its own error, or an
+    #unrecognised one that keeps happening. connection errors never give a batch up, they're what the spool is for
+    def Poisoned(self, Error):
+        Kind = WriteFailure(Error)
+        if Kind == 'Connection':
+            return False
+        self.HeadFailures += 1
+        return Kind == 'Batch' or self.HeadFailures >= self.BatchRetries
+
+    #write a batch that can't go to the database to the dead letter directory (or drop it) and report it
+    def DeadLetter(self, Batches, Error):
+        self.HeadFailures = 0
+        self.Metrics.Increment('relay_dead_letter_batches_total')
+        Status = '[Batch of ' + str(BatchRows(Batches)) + ' rows can not be written and was dropped: ' + str(Error) + ']'
+        if self.DeadLetterDirectory is not None:
+            try:
+                os.makedirs(self.DeadLetterDirectory, exist_ok=True)
+                Path = os.path.join(self.DeadLetterDirectory, 'batch-' + str(time.time_ns()) + '.json')
+                with open(Path, 'wb') as DeadLetterFile:
+                    DeadLetterFile.write(EncodeSpoolBatches(Batches))
+                Status = '[Batch of ' + str(BatchRows(Batches)) + ' rows can not be written, saved to ' + Path + ': ' + str(Error) + ']'
+            except Exception as d:
+                Status = Status[:-1] + ' (dead letter file failed: ' + str(d) + ')]'
+        print(Status)
+        self.client.publish("Relay/ServerIssue/" + self.DatabaseName, json.dumps(Status))
+
+    #messages dropped by Submit or by the spool cap are reported from here so a full queue doesn't flood Relay/ServerIssue
+    def ReportDropped(self):
+        Dropped = self.Dropped
+        if Dropped > self.ReportedDropped:
+            Status = '[Database writer queue full, dropped ' + str(Dropped - self.ReportedDropped) + ' messages]'
+            print(Status)
+            self.client.publish("Relay/ServerIssue/" + self.DatabaseName, json.dumps(Status))
+            self.ReportedDropped = Dropped
+        if self.Spool is not None and self.Spool.DroppedRecords:
+            Status = '[Spool over its size cap, dropped ' + str(self.Spool.DroppedRecords) + ' oldest batches]'
+            print(Status)
+            self.client.publish("Relay/ServerIssue/" + self.DatabaseName, json.dumps(Status))
+            self.Spool.DroppedRecords = 0
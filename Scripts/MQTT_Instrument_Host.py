@@ -0,0 +1,260 @@
+#!/usr/bin/python           # Runs every active instrument from the system config in one process
+
+import sys
+import os
+import json
+import time
+import queue
+import threading
+import paho.mqtt.client as mqtt
+import MQTT_Instrument_Lib
+import MQTT_Metrics_Lib
+import MQTT_Async_Lib
+from MQTT_Config_Lib import LoadEquipmentConfigs
+
+#---------------- Instrument worker --------------------------
+#one per instrument - owns the connection and works through that instrument's requests in order, so a slow or
+#hung device only backs up its own queue. requests arrive from the paho thread through Submit, which never blocks
+class InstrumentWorker(threading.Thread):
+    def __init__(self, InstrConfig, client, DataSampling=None):
+        threading.Thread.__init__(self, name='Instrument-' + InstrConfig['EquipmentTags']['EquipmentName'], daemon=True)
+        self.InstrConfig = InstrConfig
+        self.client = client
+        self.EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+        self.Queue = queue.Queue(int(InstrConfig['EquipmentTags'].get('QueueSize', 100)))
+        self.InstrConn = None
+        self.AsyncHost = None
+        self.Ready = threading.Event()
+        self.Running = True
+        self.Poller = None
+        if InstrConfig['EquipmentTags'].get('Polling') and InstrConfig['EquipmentTags']['Communication'] != 'MQTT':
+            self.Poller = MQTT_Instrument_Lib.PollScheduler(InstrConfig, DataSampling or {}, self.Poll, client)
+
+    #the topics this instrument answers to (MQTT instruments also listen on their DataReadTopic)
+    def Topics(self):
+        Topics = ["Relay/Request/" + self.EquipmentName]
+        if self.InstrConfig['EquipmentTags']['Communication'] == 'MQTT':
+            Topics.append(self.InstrConfig['EquipmentTags']['DataReadTopic'])
+        return Topics
+
+    def Submit(self, Request, RequestTopic, Done=None):
+        if self.Ready.is_set() and not self.Running:
+            MQTT_Instrument_Lib.CommIssue(self.client, self.InstrConfig, 'Instrument is not connected, send Relay/Restart/' + self.EquipmentName + ' to retry')
+            return False
+        try:
+            self.Queue.put_nowait((Request, RequestTopic, Done))
+            return True
+        except queue.Full:
+            MQTT_Instrument_Lib.CommIssue(self.client, self.InstrConfig, 'Request queue full (' + str(self.Queue.maxsize) + '), request dropped')
+            return False
+
+    #scheduled polls go through the same queue as requests and wait their turn, so the scheduler sees overruns
+    def Poll(self, Request):
+        Done = threading.Event()
+        if self.Submit(Request, "Relay/Request/" + self.EquipmentName, Done):
+            while not Done.wait(1) and self.Running:
+                pass
+
+    def Stop(self):
+        self.Running = False
+        if self.Poller is not None:
+            self.Poller.Stop()
+        try:
+            self.Queue.put_nowait(None)
+        except queue.Full: #the worker checks Running after each request
+            pass
+
+    def Connect(self):
+        if self.InstrConfig['EquipmentTags'].get('Async') and self.InstrConfig['EquipmentTags']['Communication'] in MQTT_Async_Lib.AsyncCommunications:
+            self.AsyncHost = MQTT_Async_Lib.AsyncInstrument(self.InstrConfig, self.client)
+            self.InstrConn = self.AsyncHost.Bridge
+        else:
+            self.InstrConn = MQTT_Instrument_Lib.InitializeInstrumentConnection(self.InstrConfig, self.client)
+
+    def Close(self):
+        try:
+            if self.AsyncHost is not None:
+                self.AsyncHost.Stop()
+            elif self.InstrConn is not self.client and hasattr(self.InstrConn, 'close'): #MQTT instruments share the host client
+                self.InstrConn.close()
+        except Exception as e:
+            print('[Error closing ' + self.EquipmentName + ': ' + str(e) + ']')
+
+    def run(self):
+        try:
+            self.Connect()
+        except SystemExit: #InitializeInstrumentConnection has already reported it on Relay/ServerIssue
+            self.Running = False
+            return
+        except Exception as e:
+            Status = '[Error with instrument connection: ' + str(e) + ']'
+            print(Status)
+            self.client.publish("Relay/ServerIssue/" + self.EquipmentName, json.dumps(Status))
+            self.Running = False
+            return
+        finally:
+            self.Ready.set()
+        if self.Poller is not None:
+            self.Poller.start()
+        while self.Running:
+            Item = self.Queue.get()
+            if Item is None or not self.Running:
+                break
+            Request, RequestTopic, Done = Item
+            try:
+                if self.AsyncHost is not None:
+                    if Done is not None:
+                        self.AsyncHost.Run(Request, RequestTopic)
+                    else:
+                        self.AsyncHost.Submit(Request, RequestTopic)
+                else:
+                    MQTT_Instrument_Lib.InstrumentSelect(Request, self.InstrConfig, self.InstrConn, RequestTopic, self.client)
+            except (Exception, SystemExit) as e:
+                Status = '[Received bad message or instrument comms: ' + str(e) + ']'
+                print(Status)
+                self.client.publish("Relay/ServerIssue/" + self.EquipmentName, json.dumps(Status))
+            finally:
+                if Done is not None:
+                    Done.set()
+        self.Close()
+
+#---------------- Instrument bookkeeping --------------------------
+#Workers is keyed by equipment name, Routes maps every subscribed data/request topic to its worker
+Workers = {}
+Routes = {}
+RoutesLock = threading.Lock()
+
+def StartInstrument(InstrConfig, DataSampling):
+    Worker = InstrumentWorker(InstrConfig, client, DataSampling)
+    with RoutesLock:
+        Workers[Worker.EquipmentName] = Worker
+        for Topic in Worker.Topics():
+            Routes[Topic] = Worker
+    Worker.start()
+    for Topic in Worker.Topics() + ["Relay/PoisonPill/" + Worker.EquipmentName, "Relay/Restart/" + Worker.EquipmentName]:
+        client.subscribe(Topic)
+    Metrics.GaugeFunction('instrument_queue_depth', Worker.Queue.qsize, {'equipment': Worker.EquipmentName})
+    return Worker
+
+def StopInstrument(EquipmentName):
+    with RoutesLock:
+        Worker = Workers.get(EquipmentName)
+        for Topic in [Topic for Topic, Routed in Routes.items() if Routed is Worker]:
+            del Routes[Topic]
+    if Worker is not None:
+        Worker.Stop()
+    return Worker
+
+#stop the instrument, wait for its last request to finish, then reload its config from disk and start it again
+def RestartInstrument(EquipmentName):
+    try:
+        Worker = StopInstrument(EquipmentName)
+        if Worker is not None:
+            Worker.join(float(HostDetails.get('StopTimeout', 10)))
+        SystemConfig, EquipmentConfigs = LoadEquipmentConfigs(SystemConfigPath)
+        StartInstrument(EquipmentConfigs[EquipmentName], SystemConfig.get('DataSampling', {}))
+        Status = 'Restarted ' + EquipmentName
+    except Exception as e:
+        Status = '[Error restarting ' + EquipmentName + ': ' + str(e) + ']'
+    print(Status)
+    client.publish("Relay/ServerIssue/" + EquipmentName, json.dumps(Status))
+
+#---------------- Communication client --------------------------
+#this function sets up the connection to the MQTT Broker and (re)subscribes to every instrument's topics
+def on_connect(client, userdata, flags, rc):
+       print("connected to Broker for " + HostName)
+       data = {"success?":"totally", "Host":HostName, "Instruments":sorted(Workers)}
+       jsondata = json.dumps(data)
+       client.publish("Relay/Alive/", jsondata)
+       client.subscribe("Relay/PoisonPill/" + HostName) #stops the whole host
+       with RoutesLock:
+           Topics = list(Routes)
+           Names = list(Workers)
+       for Topic in Topics:
+           client.subscribe(Topic)
+       for EquipmentName in Names:
+           client.subscribe("Relay/PoisonPill/" + EquipmentName)
+           client.subscribe("Relay/Restart/" + EquipmentName)
+
+#this function hands each request to its instrument's worker - nothing here waits on a device
+def on_message(client, userdata, message):
+    try:
+        Request = message.payload.decode()
+        RequestTopic = message.topic
+        if RequestTopic == "Relay/PoisonPill/" + HostName:
+           Status = 'Poison pill arrived - host shutting down'
+           print(Status)
+           for EquipmentName in list(Workers):
+               StopInstrument(EquipmentName)
+           Deadline = time.monotonic() + float(HostDetails.get('StopTimeout', 10))
+           for Worker in list(Workers.values()):
+               Worker.join(max(Deadline - time.monotonic(), 0))
+           client.publish("Relay/ServerIssue/" + HostName, json.dumps(Status))
+           sys.exit()
+        if RequestTopic.startswith("Relay/PoisonPill/"):
+           EquipmentName = RequestTopic[len("Relay/PoisonPill/"):]
+           if StopInstrument(EquipmentName) is not None:
+               Status = 'Poison pill arrived - ' + EquipmentName + ' shutting down'
+               print(Status)
+               client.publish("Relay/ServerIssue/" + EquipmentName, json.dumps(Status))
+           return
+        if RequestTopic.startswith("Relay/Restart/"):
+           #restarts block on the old worker, so run them off the paho thread
+           threading.Thread(target=RestartInstrument, args=(RequestTopic[len("Relay/Restart/"):],), daemon=True).start()
+           return
+        with RoutesLock:
+           Worker = Routes.get(RequestTopic)
+        if Worker is not None:
+           Worker.Submit(Request, RequestTopic)
+    except Exception as e:
+        Status = '[Received bad message or instrument comms: ' + str(e) + ']'
+        print(Status)
+        Status = json.dumps(Status)
+        client.publish("Relay/ServerIssue/" + HostName, Status )
+
+#------------------ Load System Config  ------------------
+try:
+    SystemConfigPath = os.path.abspath(sys.argv[1])
+    SystemConfig, EquipmentConfigs = LoadEquipmentConfigs(SystemConfigPath)
+    HostDetails = SystemConfig.get('HostTags', {})
+    HostName = HostDetails.get('HostName', SystemConfig['SystemTags']['SystemName'] + '-Host')
+except Exception as e:
+    Status = '[Error with config loading: ' + str(e) + ']'
+    print(Status)
+    sys.exit()
+
+#------------------Initialize MQTT Host ------------------
+try:
+    client = mqtt.Client()#(mqtt.CallbackAPIVersion.VERSION1)
+    client.on_connect=on_connect
+    client.on_message=on_message
+    client.connect('localhost')
+except Exception as e:
+    Status = '[Error with instrument host startup: ' + str(e) + ']'
+    print(Status)
+    sys.exit()
+
+#--------------Start every instrument--------------
+#connections open in parallel on each worker's thread, instruments with Polling on poll at the DataSampling rates.
+#the metrics of all instruments go out on Relay/Metrics/<host>
+Metrics = MQTT_Instrument_Lib.Metrics
+try:
+    for EquipmentName, InstrConfig in EquipmentConfigs.items():
+        StartInstrument(InstrConfig, SystemConfig.get('DataSampling', {}))
+    MQTT_Metrics_Lib.MetricsPublisher(Metrics, client, HostName, HostDetails.get('MetricsInterval', 10), HostDetails.get('MetricsTextFile')).start()
+except Exception as e:
+    Status = '[Error with instrument host startup: ' + str(e) + ']'
+    print(Status)
+    client.publish("Relay/ServerIssue/" + HostName, json.dumps(Status))
+    sys.exit()
+
+#--------------------Run Host ----------------------------
+while True:
+   try:
+     client.loop_forever()
+   except Exception as e:
+     Status = "Something broke, not sure what" + str(e)
+     print(Status)
+     Status = json.dumps(Status)
+     client.publish("Relay/ServerIssue/" + HostName, Status )
+     sys.exit()
@@ -3,15 +3,25 @@
 
 import json
 import sys
-import pandas as pd
 import numpy as np
 import math
 import time
 import struct
-from datetime import datetime, timedelta 
+from datetime import datetime, date, timedelta
+from decimal import Decimal
 import subprocess
 import platform
+import threading
+import asyncio
+import heapq
+import socket
+from collections import OrderedDict, deque
 from sqlalchemy import text
+import MQTT_Metrics_Lib
+import MQTT_Payload_Lib
+
+#request latency, per-channel I/O time and CommIssue counts - published by the server with MQTT_Metrics_Lib.MetricsPublisher
+Metrics = MQTT_Metrics_Lib.MetricsRegistry()
 
 #-----------------------Helper functions------------------
 # This script pulls the config file and returns it as a json dictonary file
@@ -31,16 +41,29 @@ def InstrumentSelect(Request, InstrConfig, InstrConn, RequestTopic, client):
         sys.exit()
     # Defining the communication type used to interface with the instrument
     InstrType  = InstrConfig['EquipmentTags']['Communication'] 
+    Reused = () #tags answered by the read cache
     # For any non equipment not using MQTT as communication the function will load the request,
     # determine whether the intention is to read or write to an instrument and finaly compile
     # the function that will perform the request
     if InstrType != 'MQTT':
+        DispatchStart = time.perf_counter()
         RequestDetails = json.loads(Request)
         #print(RequestDetails)
         ReadWrite = RequestDetails['Read/Write']
         FunctionName = InstrType + ReadWrite
-        func = globals()[FunctionName]
-        ReturnData = func(RequestDetails, InstrConfig, InstrConn, client)   
+        func = DriverFor(InstrConfig).Function(ReadWrite)
+        RequestStart = time.perf_counter()
+        Metrics.Observe('instrument_dispatch_seconds', RequestStart - DispatchStart, {'equipment': InstrConfig['EquipmentTags']['EquipmentName']})
+        try:
+            if ReadWrite == 'R': #served from the read cache where it can be
+                ReturnData, Reused = ReadCacheFor(InstrConfig).Read(RequestDetails, lambda Details: func(Details, InstrConfig, InstrConn, client))
+            else:
+                try:
+                    ReturnData = func(RequestDetails, InstrConfig, InstrConn, client)
+                finally:
+                    ReadCacheFor(InstrConfig).Invalidate(RequestDetails['Channels'])
+        finally:
+            ObserveRequest(InstrConfig, FunctionName, RequestStart)
     else:
         if RequestTopic == InstrConfig['EquipmentTags']['DataReadTopic']:
            ReturnData = MQTTR(Request, RequestTopic, InstrConfig, InstrConn, client)
@@ -48,23 +71,69 @@ def InstrumentSelect(Request, InstrConfig, InstrConn, RequestTopic, client):
              RequestDetails = json.loads(Request)
              ReadWrite = RequestDetails['Read/Write']
              FunctionName = InstrType + ReadWrite
-             func = globals()[FunctionName]
-             ReturnData = func(Request, RequestTopic, InstrConfig, InstrConn, client)
-    # The output from the function determined above will be dumped in json format to the jsondata
-    jsondata = json.dumps(ReturnData)
-    # The topic for the client publishing will be the Equipment name
-    Topic = "Relay/Data/" + InstrConfig['EquipmentTags']['EquipmentName']
-    # Publishing the data to the topic on the instrument client
-    client.publish(Topic, jsondata)
+             func = DriverFor(InstrConfig).Function(ReadWrite)
+             RequestStart = time.perf_counter()
+             try:
+                 ReturnData = func(Request, RequestTopic, InstrConfig, InstrConn, client)
+             finally:
+                 ObserveRequest(InstrConfig, FunctionName, RequestStart)
+    # The output from the function determined above is published on Relay/Data for the equipment
+    # (values answered from the read cache were published when they were read, they go to Relay/Cached instead)
+    PublishData(client, InstrConfig, ReturnData, Reused)
     # Returning the data as an output from the function.
     return ReturnData
 
+#JSON on Relay/Data/<instrument>, or packed on Relay/Data/<instrument>/Packed when EquipmentTags Payload is "Packed"
+#(results the tag map can't describe still go out as JSON). Reused tags are values the read cache answered with, already
+#published when they were read - they go to Relay/Cached/<instrument> so the database doesn't store them twice
+def PublishData(client, InstrConfig, ReturnData, Reused=()):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    Topic = "Relay/Data/" + EquipmentName
+    if Reused:
+        Values = ReturnData[EquipmentName]
+        client.publish("Relay/Cached/" + EquipmentName, json.dumps({EquipmentName: {Tagnum: Values[Tagnum] for Tagnum in Reused}}))
+        ReturnData = {EquipmentName: {Tagnum: Value for Tagnum, Value in Values.items() if Tagnum not in Reused}}
+        if not ReturnData[EquipmentName]:
+            return
+    Packer = DriverFor(InstrConfig).Packer
+    if Packer is not None:
+        Payload = Packer.Pack(ReturnData)
+        if Payload is not None:
+            Packer.Announce(client)
+            client.publish(Topic + MQTT_Payload_Lib.PackedSuffix, Payload)
+            return
+    client.publish(Topic, json.dumps(ReturnData))
+
+#request latency per driver function, labelled with the equipment so several instruments can share a registry
+def ObserveRequest(InstrConfig, FunctionName, RequestStart):
+    Labels = {'equipment': InstrConfig['EquipmentTags']['EquipmentName'], 'driver': FunctionName}
+    Metrics.Observe('instrument_request_seconds', time.perf_counter() - RequestStart, Labels)
+    Metrics.Increment('instrument_requests_total', 1, Labels)
+
+#iterates the channel rows of a request and times the loop body for each channel - conversion, plus the device I/O
+#for drivers that read one channel at a time. span and block reads happen before the loop and are timed on their own
+#(instrument_span_seconds). labelled by equipment only, a label per tag would be one series per channel
+def TimedRows(Rows, InstrConfig):
+    Labels = {'equipment': InstrConfig['EquipmentTags']['EquipmentName']}
+    for row in Rows:
+        ChanStart = time.perf_counter()
+        yield row
+        Metrics.Observe('instrument_channel_loop_seconds', time.perf_counter() - ChanStart, Labels)
 
-def SCPIConvert(DatatoConvert, row):
+#publish a communication issue and count it
+def CommIssue(client, InstrConfig, Status):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    Metrics.Increment('instrument_comm_issues_total', 1, {'equipment': EquipmentName})
+    client.publish("Relay/CommIssue/" + EquipmentName, json.dumps(Status))
+
+
+#Parts is the response already split on ',' when several channels share it
+def SCPIConvert(DatatoConvert, row, Parts=None):
     #manage the potential for an array return (stupid NHR...)
-    if ',' in DatatoConvert:
-        TempArray = DatatoConvert.split(',')
-        TempData = TempArray[int(row['ArrayPos'])]
+    if Parts is None:
+        Parts = DatatoConvert.split(',')
+    if len(Parts) > 1:
+        TempData = Parts[int(row['ArrayPos'])]
     else:
         TempData = DatatoConvert
     #Convert NR1 and NR2
@@ -121,8 +190,9 @@ def ModbusConvert(Row):
         FullVal = "NULL"
     else:
         # Converts the value to a float and apply the scaling before rounding it to decimal
+        # (scaling is done on a python float so the result stays json serializable)
         NpInt = np.array(Row['Value'], Row['DataType'])
-        Raw = NpInt.astype('float32')
+        Raw = float(NpInt.astype('float32'))
         OffsetVal = Raw + Row['Offset']
         ScaledVal = OffsetVal * Row['Scalar']
         FullVal =  round(ScaledVal, int(Row['Decimal']))  
@@ -203,24 +273,677 @@ def ModbusDecoder(BinValue, Row):
         FullVal = BinValue
     return FullVal
     
-#Channel Dataframe Buildout
-def ChanDFBuild(RequestDetails, InstrConfig):
-    #build channel short list  
-    ChannelList = []
-    KeyList = []
-    ValueList = []
-    for key in RequestDetails['Channels']:    
-        ChannelList.append(InstrConfig['Channels'][key])
-        KeyList.append(key)
-        ValueList.append(RequestDetails['Channels'][key])
-    ChanDF = pd.DataFrame(ChannelList)
-    ChanDF['Tagnum'] = KeyList
-    ChanDF['Value'] = ValueList
-    return ChanDF
+#---------------- Compiled channel plans --------------------------
+#the channel config is compiled once per instrument into ChannelSpecs, and the channel list of each distinct
+#request into a plan (tuple of specs) kept in a small LRU cache. a request then only costs one ChannelRow per
+#channel. rows answer row['Field'] like the old DataFrame rows did, including NaN for fields a channel doesn't have.
+#each row is stamped when its value is acquired - right after the span/block read it came from, or the first time
+#its Time is asked for (drivers build the result right after the read). the stamp is epoch ns from the wall clock,
+#Latency is the monotonic time from the start of the request to the stamp
+NaN = float('nan')
+RowFields = frozenset(('Tagnum', 'Value'))
+
+class ChannelSpec:
+    __slots__ = ('Tagnum', 'Fields')
+
+    def __init__(self, Tagnum, Fields):
+        self.Tagnum = Tagnum
+        self.Fields = Fields
+
+def AcquisitionStamp():
+    return time.time_ns(), time.perf_counter()
+
+#the local "%Y-%m-%d %H:%M:%S" text of an epoch ns stamp, formatted once per second
+TimeText = (None, None)
+
+def LocalTime(Stamp):
+    global TimeText
+    Second = Stamp // 1000000000
+    Cached = TimeText
+    if Cached[0] != Second:
+        Cached = TimeText = (Second, datetime.fromtimestamp(Second).strftime("%Y-%m-%d %H:%M:%S"))
+    return Cached[1]
+
+class ChannelRow:
+    __slots__ = ('Spec', 'Tagnum', 'Value', 'Started', 'Stamp', 'Latency')
+
+    def __init__(self, Spec, Value, Started):
+        self.Spec = Spec
+        self.Tagnum = Spec.Tagnum
+        self.Value = Value
+        self.Started = Started
+        self.Stamp = None
+        self.Latency = None
+
+    #the row's acquisition time in epoch ns, stamped the first time it's needed
+    def Acquired(self, Stamp=None):
+        if self.Stamp is None:
+            Stamp = Stamp or AcquisitionStamp()
+            self.Stamp = Stamp[0]
+            self.Latency = Stamp[1] - self.Started
+        return self.Stamp
+
+    def __getitem__(self, Key):
+        if Key in RowFields:
+            return getattr(self, Key)
+        if Key == 'Time':
+            return LocalTime(self.Acquired())
+        return self.Spec.Fields.get(Key, NaN)
+
+    def __setitem__(self, Key, Value):
+        if Key not in RowFields:
+            raise KeyError(Key)
+        setattr(self, Key, Value)
+
+    def get(self, Key, Default=None):
+        if Key in RowFields or Key == 'Time':
+            return self[Key]
+        return self.Spec.Fields.get(Key, Default)
+
+#stamp every row of a span or block that was just read
+def StampRows(Rows, Indexes, Stamp=None):
+    Stamp = Stamp or AcquisitionStamp()
+    for Index in Indexes:
+        Rows[Index].Acquired(Stamp)
+
+#one channel's entry in Relay/Data - Time stays the local text for dashboards, TimeNs and Latency are the acquisition
+#stamp and how long after the request it was taken (seconds)
+def ChannelResult(row, Value):
+    Stamp = row.Acquired()
+    return {'Value': Value, 'Time': LocalTime(Stamp), 'TimeNs': Stamp, 'Latency': round(row.Latency, 6)}
+
+class ChannelPlanner:
+    def __init__(self, InstrConfig):
+        self.Channels = InstrConfig['Channels']
+        self.Specs = {Tagnum: ChannelSpec(Tagnum, dict(Fields)) for Tagnum, Fields in self.Channels.items()}
+        self.Plans = OrderedDict()
+        self.MaxPlans = int(InstrConfig['EquipmentTags'].get('PlanCacheSize', 64))
+        #things drivers derive from a plan (e.g. Modbus spans), same LRU rules
+        self.Derived = OrderedDict()
+        #async mode can run several requests for one instrument at once
+        self.Lock = threading.Lock()
+
+    def Plan(self, ChannelKeys):
+        Key = tuple(ChannelKeys)
+        with self.Lock:
+            Plan = self.Plans.get(Key)
+            if Plan is None:
+                Plan = self.Plans[Key] = tuple(self.Specs[Tagnum] for Tagnum in Key)
+                if len(self.Plans) > self.MaxPlans:
+                    self.Plans.popitem(last=False)
+            else:
+                self.Plans.move_to_end(Key)
+        return Plan
+
+    def DerivedFrom(self, Kind, Plan, Build):
+        Key = (Kind, Plan)
+        with self.Lock:
+            Value = self.Derived.get(Key)
+            if Value is None:
+                Value = self.Derived[Key] = Build()
+                if len(self.Derived) > self.MaxPlans * 4:
+                    self.Derived.popitem(last=False)
+            else:
+                self.Derived.move_to_end(Key)
+        return Value
+
+#one planner per instrument - rebuilt if the instrument's config is reloaded
+Planners = {}
+
+def ChannelPlanFor(InstrConfig):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    Planner = Planners.get(EquipmentName)
+    if Planner is None or Planner.Channels is not InstrConfig['Channels']:
+        Planner = Planners[EquipmentName] = ChannelPlanner(InstrConfig)
+    return Planner
+
+#the rows for one request, in request order - latencies count from here
+def ChannelRows(RequestDetails, InstrConfig):
+    Requested = RequestDetails['Channels']
+    Plan = ChannelPlanFor(InstrConfig).Plan(Requested)
+    Started = time.perf_counter()
+    return [ChannelRow(Spec, Requested[Spec.Tagnum], Started) for Spec in Plan]
+
+#---------------- Read cache --------------------------
+#one per instrument. a read for a tag that another request is already fetching waits for that result instead of going
+#to the device again, and a value younger than the channel's MaxAge (seconds, default EquipmentTags MaxAge, 0 = off) is
+#answered from memory with the time it was read. writes drop the written tags. Read returns the result and the tags that
+#were answered from memory or from another request's read rather than read for this request
+class PendingRead:
+    __slots__ = ('Done', 'Values', 'Stale')
+
+    def __init__(self):
+        self.Done = threading.Event()
+        self.Values = {}
+        self.Stale = set()
+
+class ReadCache:
+    def __init__(self, InstrConfig):
+        self.Channels = InstrConfig['Channels']
+        self.EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+        Default = float(InstrConfig['EquipmentTags'].get('MaxAge', 0))
+        self.MaxAge = {Tagnum: float(Channel.get('MaxAge', Default)) for Tagnum, Channel in self.Channels.items()}
+        self.WaitTimeout = float(InstrConfig['EquipmentTags'].get('CoalesceTimeout', 30))
+        self.Values = {} #Tagnum -> (monotonic read time, {'Value', 'Time'})
+        self.Pending = {} #Tagnum -> PendingRead
+        self.Lock = threading.Lock()
+
+    #Fetch(RequestDetails) runs the driver for the tags this request has to read itself
+    def Read(self, RequestDetails, Fetch):
+        Now = time.monotonic()
+        Found = {}
+        Waiting = {}
+        Claimed = {}
+        Mine = PendingRead()
+        with self.Lock:
+            for Tagnum, Value in RequestDetails['Channels'].items():
+                MaxAge = self.MaxAge.get(Tagnum, 0)
+                Cached = self.Values.get(Tagnum) if MaxAge > 0 else None
+                if Cached is not None and Now - Cached[0] <= MaxAge:
+                    Found[Tagnum] = Cached[1]
+                elif Tagnum in self.Pending:
+                    Waiting[Tagnum] = self.Pending[Tagnum]
+                else:
+                    Claimed[Tagnum] = Value
+                    self.Pending[Tagnum] = Mine
+        Labels = {'equipment': self.EquipmentName}
+        for Name, Tags in (('instrument_cache_hits_total', Found), ('instrument_cache_coalesced_total', Waiting), ('instrument_cache_misses_total', Claimed)):
+            if Tags:
+                Metrics.Increment(Name, len(Tags), Labels)
+        Fetched = {}
+        if Claimed:
+            try:
+                Fetched = Fetch(dict(RequestDetails, Channels=Claimed))[self.EquipmentName]
+            finally:
+                with self.Lock:
+                    for Tagnum in Claimed:
+                        if self.Pending.get(Tagnum) is Mine:
+                            del self.Pending[Tagnum]
+                        if Tagnum in Fetched and Tagnum not in Mine.Stale:
+                            self.Values[Tagnum] = (Now, Fetched[Tagnum]) #aged from before the read went out
+                    Mine.Values = Fetched
+                Mine.Done.set()
+        for Tagnum, Pending in Waiting.items():
+            if Pending.Done.wait(self.WaitTimeout) and Tagnum in Pending.Values:
+                Found[Tagnum] = Pending.Values[Tagnum]
+        Reused = set(Found)
+        Found.update(Fetched)
+        return {self.EquipmentName: {Tagnum: Found[Tagnum] for Tagnum in RequestDetails['Channels'] if Tagnum in Found}}, Reused
+
+    #a read already in flight for these tags still answers its waiters, but isn't kept
+    def Invalidate(self, Tags):
+        with self.Lock:
+            for Tagnum in Tags:
+                self.Values.pop(Tagnum, None)
+                if Tagnum in self.Pending:
+                    self.Pending[Tagnum].Stale.add(Tagnum)
+
+ReadCaches = {}
+
+def ReadCacheFor(InstrConfig):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    Cache = ReadCaches.get(EquipmentName)
+    if Cache is None or Cache.Channels is not InstrConfig['Channels']:
+        Cache = ReadCaches[EquipmentName] = ReadCache(InstrConfig)
+    return Cache
+
+#---------------- Poll scheduler --------------------------
+#the instrument server polls its own channels at the system config's DataSampling rates instead of waiting for
+#Relay/Request. a channel belongs to a class when its FilterTopic entry (e.g. Tags) holds the class's FilterKey
+SamplingUnits = {'MS': 0.001, 'S': 1, 'M': 60, 'H': 3600}
+
+def SamplingPeriod(Sampling):
+    return float(Sampling['Rate']) * SamplingUnits[str(Sampling.get('Unit', 'S')).upper()]
+
+#{class: (period in seconds, [tags])} for the active readable channels of this instrument
+def PollClasses(InstrConfig, DataSampling):
+    Classes = {}
+    for Name, Sampling in DataSampling.items():
+        Topic = Sampling.get('FilterTopic', 'Tags')
+        Key = Sampling.get('FilterKey', Name)
+        Tags = [Tagnum for Tagnum, Channel in InstrConfig['Channels'].items()
+                if Channel.get('Active', True) and 'R' in str(Channel.get('ReadWrite', 'R')) and Key in (Channel.get(Topic) or ())]
+        if Tags:
+            Classes[Name] = (SamplingPeriod(Sampling), Tags)
+    return Classes
+
+#each class is due at Start + n * its period, so timing never drifts however long a poll takes, and the scheduler
+#sleeps until the earliest class on a heap of (due, class) is due. every class due by then goes out as one read
+#request through Poll(Request). a class whose poll ran past its next due times skips them and is polled once, along
+#with whatever else is due, straight away
+class PollScheduler(threading.Thread):
+    def __init__(self, InstrConfig, DataSampling, Poll, client):
+        threading.Thread.__init__(self, name='Poll-' + InstrConfig['EquipmentTags']['EquipmentName'], daemon=True)
+        self.InstrConfig = InstrConfig
+        self.Poll = Poll
+        self.client = client
+        self.Classes = PollClasses(InstrConfig, DataSampling)
+        self.Sampling = bool(DataSampling)
+        self.Periods = {Name: max(Period, 0.001) for Name, (Period, Tags) in self.Classes.items()}
+        self.Requests = {}
+        self.Stopped = threading.Event()
+        self.Labels = {'equipment': InstrConfig['EquipmentTags']['EquipmentName']}
+
+    #the request for a set of due classes is built once and reused
+    def RequestFor(self, Due):
+        Request = self.Requests.get(Due)
+        if Request is None:
+            Channels = {}
+            for Name in sorted(Due):
+                for Tagnum in self.Classes[Name][1]:
+                    Channels[Tagnum] = 0
+            Request = self.Requests[Due] = json.dumps({'Read/Write': 'R', 'Channels': Channels})
+        return Request
+
+    def Stop(self):
+        self.Stopped.set()
+
+    def run(self):
+        if not self.Classes:
+            #Polling is on but there is nothing to poll - say so rather than sit idle
+            if self.Sampling:
+                Status = '[Polling is on but no channel matches a DataSampling class - not polling]'
+            else:
+                Status = '[Polling is on but there are no DataSampling classes (is the system config loaded?) - not polling]'
+            print(Status)
+            self.client.publish("Relay/ServerIssue/" + self.InstrConfig['EquipmentTags']['EquipmentName'], json.dumps(Status))
+            return
+        Start = time.monotonic()
+        Queue = [(Start, Name, 0) for Name in sorted(self.Periods)] #(due, class, n)
+        heapq.heapify(Queue)
+        while not self.Stopped.is_set():
+            Now = time.monotonic()
+            if Queue[0][0] > Now:
+                self.Stopped.wait(Queue[0][0] - Now)
+                continue
+            Popped = []
+            while Queue and Queue[0][0] <= Now:
+                Popped.append(heapq.heappop(Queue))
+            Metrics.Observe('instrument_poll_lag_seconds', Now - Popped[0][0], self.Labels)
+            try:
+                self.Poll(self.RequestFor(frozenset(Name for Due, Name, Number in Popped)))
+            except (Exception, SystemExit) as e:
+                Status = '[Scheduled poll failed: ' + str(e) + ']'
+                print(Status)
+                self.client.publish("Relay/ServerIssue/" + self.InstrConfig['EquipmentTags']['EquipmentName'], json.dumps(Status))
+            Now = time.monotonic()
+            Skipped = 0
+            for Due, Name, Number in Popped:
+                Period = self.Periods[Name]
+                Number += 1
+                Behind = int((Now - Start) / Period) #latest n already due
+                if Behind > Number:
+                    Skipped += Behind - Number
+                    Number = Behind
+                heapq.heappush(Queue, (Start + Number * Period, Name, Number))
+            if Skipped:
+                Metrics.Increment('instrument_poll_overruns_total', Skipped, self.Labels)
+
+#---------------- Modbus span planner --------------------------
+#requested channels are grouped by unit and register type, sorted by address and merged into spans of at most
+#SpanRegisters registers (125, the protocol limit) - channels up to SpanGap unused registers apart share a span.
+#each channel is then decoded from its slice of the span. a span the device rejects with an exception response
+#(usually a hole in the register map) is marked Failed and its channels go back to one read each - a span that just
+#timed out is read as a span again next time
+RegisterTypes = ('HRegister', 'IRegister')
+MaxSpanBits = 2000
 
+class ModbusSpan:
+    __slots__ = ('Unit', 'Type', 'Start', 'End', 'Members', 'Failed')
+
+    def __init__(self, Unit, Type, Start, End):
+        self.Unit = Unit
+        self.Type = Type
+        self.Start = Start
+        self.End = End
+        self.Members = []
+        self.Failed = False
+
+#the drivers treat any type that isn't a register or discrete input as a coil
+def ModbusSpanType(Type):
+    return Type if Type in RegisterTypes or Type == 'DiscreteInputs' else 'Coil'
+
+def RegisterWidth(Fields):
+    Registers = Fields.get('Registers')
+    if isinstance(Registers, int) and Registers > 0:
+        return Registers
+    return 2 if Fields.get('DataType') in ('int32', 'float32') else 1
+
+def PlanModbusSpans(Plan, InstrConfig, UnitOf, Include):
+    Gap = int(InstrConfig['EquipmentTags'].get('SpanGap', 0))
+    MaxRegisters = min(int(InstrConfig['EquipmentTags'].get('SpanRegisters', 125)), 125)
+    Groups = {}
+    for Index, Spec in enumerate(Plan):
+        if not Include(Spec.Fields):
+            continue
+        Type = ModbusSpanType(Spec.Fields.get('Type'))
+        Width = RegisterWidth(Spec.Fields) if Type in RegisterTypes else 1
+        Groups.setdefault((UnitOf(Spec.Fields), Type), []).append((int(Spec.Fields['IOPoint']), Width, Index))
+    Spans = []
+    for (Unit, Type), Channels in Groups.items():
+        Limit = MaxRegisters if Type in RegisterTypes else MaxSpanBits
+        Span = None
+        for Start, Width, Index in sorted(Channels):
+            End = Start + Width
+            if Span is None or Start - Span.End > Gap or max(End, Span.End) - Span.Start > Limit:
+                Span = ModbusSpan(Unit, Type, Start, End)
+                Spans.append(Span)
+            Span.End = max(Span.End, End)
+            Span.Members.append((Index, Start - Span.Start, Width))
+    return Spans
+
+#spans for the channels of one request, cached with the request's plan
+def ModbusSpans(Rows, InstrConfig, Kind, UnitOf, Include=lambda Fields: True):
+    Plan = tuple(row.Spec for row in Rows)
+    return ChannelPlanFor(InstrConfig).DerivedFrom(Kind, Plan, lambda: PlanModbusSpans(Plan, InstrConfig, UnitOf, Include))
+
+#client method for each span type - the same names on the sync and async pymodbus clients
+SpanReads = {'HRegister': 'read_holding_registers', 'IRegister': 'read_input_registers', 'DiscreteInputs': 'read_discrete_inputs', 'Coil': 'read_coils'}
+
+#a span covering just one channel, for reads outside a span
+def ChannelSpan(row, Unit):
+    Type = ModbusSpanType(row['Type'])
+    Span = ModbusSpan(Unit, Type, int(row['IOPoint']), int(row['IOPoint']) + (RegisterWidth(row) if Type in RegisterTypes else 1))
+    Span.Members.append((0, 0, Span.End - Span.Start))
+    return Span
+
+#only an exception response (function code + 0x80) means the device refuses the span - a timeout or dropped connection
+#comes back as a ModbusIOException, also isError(), and must not split the span for good
+def SpanData(Span, Response):
+    if Response.isError():
+        if getattr(Response, 'function_code', 0) > 0x80:
+            Span.Failed = True
+            raise Exception('exception response ' + str(Response))
+        raise Exception('no response ' + str(Response))
+    return Response.registers if Span.Type in RegisterTypes else Response.bits
+
+def ReadModbusSpan(InstrConn, Span):
+    return SpanData(Span, getattr(InstrConn, SpanReads[Span.Type])(Span.Start, Span.End - Span.Start, Span.Unit))
+
+def StoreSpan(Span, Position, Data, SpanValues, Blocks):
+    for Index, Offset, Width in Span.Members:
+        SpanValues[Index] = Data[Offset:Offset + Width] if Span.Type in RegisterTypes else Data[Offset]
+    if Blocks is not None:
+        Blocks[Position] = Data
+
+def SpanRejected(Span, e):
+    return 'Modbus span ' + Span.Type + ' ' + str(Span.Start) + '-' + str(Span.End - 1) + ' rejected, reading its channels one at a time: ' + str(e)
+
+#read every span once - returns {row index: register slice (or bit)}, rows missing from it need their own read.
+#the rows of each span are stamped as soon as it's read. pass a dict as Blocks to also get the whole register list of
+#each span that was read, by span position
+def ReadModbusSpans(InstrConn, Rows, Spans, InstrConfig, client, Blocks=None):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    SpanValues = {}
+    for Position, Span in enumerate(Spans):
+        if Span.Failed:
+            continue
+        SpanStart = time.perf_counter()
+        try:
+            Data = ReadModbusSpan(InstrConn, Span)
+        except Exception as e:
+            if Span.Failed:
+                CommIssue(client, InstrConfig, SpanRejected(Span, e))
+            continue
+        StampRows(Rows, [Index for Index, Offset, Width in Span.Members])
+        Metrics.Observe('instrument_span_seconds', time.perf_counter() - SpanStart, {'equipment': EquipmentName, 'type': Span.Type})
+        StoreSpan(Span, Position, Data, SpanValues, Blocks)
+    return SpanValues
+
+#decode one channel from its registers (or bit) the per-row way - BinaryPayloadDecoder, ModbusDecoder, ModbusConvert
+def DecodeModbusValue(row, Value, InstrConfig):
+    if row['Type'] in RegisterTypes:
+        BinValue =  DriverFor(InstrConfig).Codec.Decode(Value)
+        row['Value'] = ModbusDecoder(BinValue,row)
+    else:
+        row['Value'] = Value
+    return ModbusConvert(row)
+
+#---------------- NumPy block decoder --------------------------
+#decodes every channel of a register span in one pass instead of BinaryPayloadDecoder + ModbusDecoder + ModbusConvert
+#per value. the span is gathered into an (n, words) uint16 array per data type, byte swapped for ByteOrder Little and
+#word reversed for WordOrder Little at compile time, then viewed as big-endian int16/uint16/float16/int32/float32.
+#offset and scale are array operations; the final round is python's so results match ModbusConvert exactly.
+#bool follows decode_bits - bit 0 of the register's high byte. anything else (HEX, bit, odd configs) keeps the per-row path
+BlockTypes = {'int16': ('>i2', 1), 'uint16': ('>u2', 1), 'float16': ('>f2', 1), 'int32': ('>i4', 2), 'float32': ('>f4', 2), 'bool': (None, 1)}
+
+def NumericField(Value):
+    return isinstance(Value, (int, float)) and not isinstance(Value, bool)
+
+#per span: {DataType: (row indexes, word index array, offsets, scalars, decimals)}
+def CompileBlockDecoders(Plan, Spans, WordLittle):
+    Decoders = []
+    for Span in Spans:
+        Groups = {}
+        if Span.Type in RegisterTypes:
+            for Index, Offset, Width in Span.Members:
+                Fields = Plan[Index].Fields
+                DataType = Fields.get('DataType')
+                if DataType not in BlockTypes or Width < BlockTypes[DataType][1]:
+                    continue
+                if DataType in ('int16', 'uint16', 'float16', 'float32') and not (NumericField(Fields.get('Offset')) and NumericField(Fields.get('Scalar')) and isinstance(Fields.get('Decimal'), int)):
+                    continue
+                Words = list(range(Offset, Offset + BlockTypes[DataType][1]))
+                if WordLittle and DataType != 'bool':
+                    Words.reverse()
+                Group = Groups.setdefault(DataType, ([], [], [], [], []))
+                Group[0].append(Index)
+                Group[1].append(Words)
+                Group[2].append(Fields.get('Offset'))
+                Group[3].append(Fields.get('Scalar'))
+                Group[4].append(Fields.get('Decimal'))
+        Decoders.append({DataType: (Indexes, np.array(Words, dtype=np.intp), np.array(Offsets, dtype=np.float64), np.array(Scalars, dtype=np.float64), Decimals)
+                         for DataType, (Indexes, Words, Offsets, Scalars, Decimals) in Groups.items()})
+    return Decoders
+
+def DecodeBlock(Decoder, Data, ByteLittle):
+    Registers = np.asarray(Data, dtype=np.uint16)
+    Swapped = Registers.byteswap() if ByteLittle else Registers
+    Decoded = {}
+    for DataType, (Indexes, Words, Offsets, Scalars, Decimals) in Decoder.items():
+        if DataType == 'bool':
+            Values = ((Registers[Words[:, 0]] >> 8) & 1).astype(bool).tolist()
+        else:
+            Raw = Swapped[Words].astype('>u2').view(BlockTypes[DataType][0])[:, 0]
+            if DataType == 'int32':
+                Values = Raw.tolist()
+            else:
+                with np.errstate(invalid='ignore'): #NaN readings become "NULL" below
+                    Scaled = ((Raw.astype(np.float32).astype(np.float64) + Offsets) * Scalars).tolist()
+                Values = ["NULL" if Value != Value else round(Value, Decimal) for Value, Decimal in zip(Scaled, Decimals)]
+        Decoded.update(zip(Indexes, Values))
+    return Decoded
+
+#finished values for every channel the block decoder handles, {row index: value}
+def DecodeModbusBlocks(Rows, Spans, Blocks, InstrConfig):
+    if not Blocks or InstrConfig['EquipmentTags'].get('BlockDecode', True) is False:
+        return {}
+    Plan = tuple(row.Spec for row in Rows)
+    WordLittle = InstrConfig['EquipmentTags'].get('WordOrder') == "Little"
+    ByteLittle = InstrConfig['EquipmentTags'].get('ByteOrder') == "Little"
+    Decoders = ChannelPlanFor(InstrConfig).DerivedFrom('Blocks', Plan, lambda: CompileBlockDecoders(Plan, Spans, WordLittle))
+    Decoded = {}
+    for Position, Data in Blocks.items():
+        Decoded.update(DecodeBlock(Decoders[Position], Data, ByteLittle))
+    return Decoded
+
+#---------------- Modbus block writes --------------------------
+#the write drivers encode every channel first, then channels whose registers (or coils) follow straight on from each
+#other go out as one write_registers/write_coils per unit - at most 123 registers or 1968 coils, the protocol limits.
+#a block the device rejects is written again one channel at a time. read-back runs after all the writes as span reads
+#over the channels written; channels with Verify false (per channel, or for all of them in EquipmentTags) skip it and
+#report the value that was written
+MaxWriteRegisters = 123
+MaxWriteBits = 1968
+
+class WriteBlock:
+    __slots__ = ('Unit', 'Coils', 'Start', 'Values', 'Members')
+
+    def __init__(self, Unit, Coils, Start):
+        self.Unit = Unit
+        self.Coils = Coils
+        self.Start = Start
+        self.Values = []
+        self.Members = []
+
+#one channel's write - the row index, its unit, the register (or coil) values and where they go
+class ChannelWrite:
+    __slots__ = ('Index', 'Unit', 'Coils', 'Start', 'Values')
+
+    def __init__(self, Index, Unit, row, Values):
+        self.Index = Index
+        self.Unit = Unit
+        self.Coils = ModbusSpanType(row['Type']) not in RegisterTypes
+        self.Start = int(row['IOPoint'])
+        self.Values = Values
+
+#ModbusInvert + ModbusBuilder as register values, or the coil state
+def ModbusWriteValues(row, Codec):
+    if ModbusSpanType(row['Type']) not in RegisterTypes:
+        return [bool(row['Value'])]
+    builder = Codec.NewBuilder()
+    ModbusBuilder(builder, row, ModbusInvert(row))
+    Values = builder.to_registers()
+    if not Values:
+        raise Exception('no register encoding for DataType ' + str(row['DataType']))
+    return Values
+
+#channels overlapping one already in a block start a new one, so a repeated address is still written in request order
+def PlanModbusWrites(Writes):
+    Groups = {}
+    for Order, Write in enumerate(Writes):
+        Groups.setdefault((Write.Unit, Write.Coils), []).append((Write.Start, Order, Write))
+    Blocks = []
+    for (Unit, Coils), Channels in Groups.items():
+        Limit = MaxWriteBits if Coils else MaxWriteRegisters
+        Block = None
+        for Start, Order, Write in sorted(Channels, key=lambda Channel: Channel[:2]):
+            if Block is None or Start != Block.Start + len(Block.Values) or len(Block.Values) + len(Write.Values) > Limit:
+                Block = WriteBlock(Unit, Coils, Start)
+                Blocks.append(Block)
+            Block.Values.extend(Write.Values)
+            Block.Members.append(Write)
+    return Blocks
+
+#SingleWrites keeps write_register/write_coil for lone channels, for drivers that have always written that way
+def WriteModbusBlock(InstrConn, Block, SingleWrites):
+    if SingleWrites and len(Block.Values) == 1:
+        Response = (InstrConn.write_coil if Block.Coils else InstrConn.write_register)(Block.Start, Block.Values[0], Block.Unit)
+    else:
+        Response = (InstrConn.write_coils if Block.Coils else InstrConn.write_registers)(Block.Start, Block.Values, Block.Unit)
+    if Response.isError():
+        raise Exception('exception response ' + str(Response))
+
+def WriteBlockRejected(Block, e):
+    return 'Modbus write ' + ('coils ' if Block.Coils else 'registers ') + str(Block.Start) + '-' + str(Block.Start + len(Block.Values) - 1) + ' rejected, writing its channels one at a time: ' + str(e)
+
+#write every block once - returns the row indexes written
+def WriteModbusChannels(InstrConn, Rows, Writes, InstrConfig, client, SingleWrites=False):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    Written = set()
+    for Block in PlanModbusWrites(Writes):
+        BlockStart = time.perf_counter()
+        try:
+            WriteModbusBlock(InstrConn, Block, SingleWrites)
+            Metrics.Observe('instrument_write_block_seconds', time.perf_counter() - BlockStart, {'equipment': EquipmentName, 'type': 'Coil' if Block.Coils else 'Register'})
+            Written.update(Write.Index for Write in Block.Members)
+            continue
+        except Exception as e:
+            if len(Block.Members) > 1:
+                CommIssue(client, InstrConfig, WriteBlockRejected(Block, e))
+            else:
+                CommIssue(client, InstrConfig, 'Issue with modbus write ' + str(Rows[Block.Members[0].Index]['Tagnum']) + ': ' + str(e))
+                continue
+        for Write in Block.Members:
+            Single = WriteBlock(Write.Unit, Write.Coils, Write.Start)
+            Single.Values = Write.Values
+            try:
+                WriteModbusBlock(InstrConn, Single, SingleWrites)
+                Written.add(Write.Index)
+            except Exception as e:
+                CommIssue(client, InstrConfig, 'Issue with modbus write ' + str(Rows[Write.Index]['Tagnum']) + ': ' + str(e))
+    return Written
+
+def WriteVerified(Fields, InstrConfig):
+    return Fields.get('Verify', InstrConfig['EquipmentTags'].get('Verify', True)) is not False
+
+#read back the written channels that want it in one pass of spans, then build the per-tag results. Decode turns a
+#channel's register slice (or bit) into its reported value
+def VerifyModbusWrites(InstrConn, Rows, Written, InstrConfig, client, Kind, UnitOf, Decode):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    ReturnData = {EquipmentName: {}}
+    Spans = ModbusSpans(Rows, InstrConfig, Kind, UnitOf, lambda Fields: WriteVerified(Fields, InstrConfig))
+    SpanValues = ReadModbusSpans(InstrConn, Rows, Spans, InstrConfig, client) if any(WriteVerified(Rows[Index].Spec.Fields, InstrConfig) for Index in Written) else {}
+    for Index in sorted(Written):
+        row = Rows[Index]
+        try:
+            if not WriteVerified(row.Spec.Fields, InstrConfig):
+                FValue = row['Value']
+            else:
+                if Index not in SpanValues: #span rejected or failed - read the channel back on its own
+                    Span = ChannelSpan(row, UnitOf(row.Spec.Fields))
+                    Single = {}
+                    StoreSpan(Span, 0, ReadModbusSpan(InstrConn, Span), Single, None)
+                    SpanValues[Index] = Single[0]
+                FValue = Decode(row, SpanValues[Index])
+            ReturnData[EquipmentName][row['Tagnum']] = ChannelResult(row, FValue)
+        except Exception as e:
+            CommIssue(client, InstrConfig, 'Issue with modbus write read-back ' + str(row['Tagnum']) + ': ' + str(e))
+    return ReturnData
 
 #-----------------------Communication functions------------------
+#---------------- Driver registry --------------------------
+#resolved once per instrument when its connection is set up (and again if its config is reloaded): the driver
+#functions for its Communication, and for Modbus a codec with the byte/word order and unit bound, so drivers don't
+#re-import pymodbus or rebuild the orders for every channel. instruments with a packed Payload get their packer here too
+ModbusCommunications = ('ModbusTcp', 'SingleModbusTcp', 'DoubleModbusTcp', 'ModbusTcpKRBH', 'ModbusTcpGeneric', 'ModbusRTU', 'ModbusRTUDouble')
+
+class ModbusCodec:
+    __slots__ = ('ByteOrder', 'WordOrder', 'Unit', 'Builder', 'Decoder')
+
+    def __init__(self, InstrConfig):
+        from pymodbus.payload import BinaryPayloadBuilder, BinaryPayloadDecoder  #expensive library, don't load unless you need it
+        self.ByteOrder = '<' if InstrConfig['EquipmentTags'].get('ByteOrder') == "Little" else '>'
+        self.WordOrder = '<' if InstrConfig['EquipmentTags'].get('WordOrder') == "Little" else '>'
+        Connection = InstrConfig['EquipmentTags'].get('Connection')
+        self.Unit = int(Connection['Unit']) if isinstance(Connection, dict) and 'Unit' in Connection else None #serial units are per channel
+        self.Builder = BinaryPayloadBuilder
+        self.Decoder = BinaryPayloadDecoder
+
+    def NewBuilder(self):
+        return self.Builder(byteorder=self.ByteOrder, wordorder=self.WordOrder)
+
+    def Decode(self, Registers):
+        return self.Decoder.fromRegisters(list(Registers), byteorder=self.ByteOrder, wordorder=self.WordOrder)
+
+class InstrumentDriver:
+    __slots__ = ('InstrConfig', 'Communication', 'Functions', 'Codec', 'Packer')
+
+    def __init__(self, InstrConfig):
+        self.InstrConfig = InstrConfig
+        self.Communication = InstrConfig['EquipmentTags']['Communication']
+        self.Functions = {ReadWrite: globals()[self.Communication + ReadWrite] for ReadWrite in ('R', 'W') if self.Communication + ReadWrite in globals()}
+        self.Codec = ModbusCodec(InstrConfig) if self.Communication in ModbusCommunications else None
+        self.Packer = MQTT_Payload_Lib.PayloadPacker(InstrConfig) if InstrConfig['EquipmentTags'].get('Payload') == 'Packed' else None
+
+    #any other Read/Write suffix is looked up the first time it's asked for
+    def Function(self, ReadWrite):
+        Function = self.Functions.get(ReadWrite)
+        if Function is None:
+            Function = self.Functions[ReadWrite] = globals()[self.Communication + ReadWrite]
+        return Function
+
+Drivers = {}
+
+def DriverFor(InstrConfig):
+    EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+    Driver = Drivers.get(EquipmentName)
+    if Driver is None or Driver.InstrConfig is not InstrConfig:
+        Driver = Drivers[EquipmentName] = InstrumentDriver(InstrConfig)
+    return Driver
+
 def InitializeInstrumentConnection(InstrConfig, client): 
+    StartupStart = time.perf_counter()
     try:
         if InstrConfig['EquipmentTags']['Communication'] == 'ModbusTcp' or InstrConfig['EquipmentTags']['Communication'] == 'SingleModbusTcp' or InstrConfig['EquipmentTags']['Communication'] == 'DoubleModbusTcp' or InstrConfig['EquipmentTags']['Communication'] == 'ModbusTcpKRBH' or InstrConfig['EquipmentTags']['Communication'] == 'ModbusTcpGeneric':
             #fire up modbus server
@@ -251,14 +974,16 @@ def InitializeInstrumentConnection(InstrConfig, client):
             client.subscribe(RequestTopic)
             InstrConn = client
         elif InstrConfig['EquipmentTags']['Communication'] == 'Ping':
-            InstrConn = InstrConfig['EquipmentTags']['TargetIP'] #Set Ping address
+            InstrConn = ReachabilityFor().Watch(InstrConfig) #probed in the background, PingR answers from memory
         elif InstrConfig['EquipmentTags']['Communication'] == 'PostGreSQL':
             from sqlalchemy import create_engine
-            engine = create_engine(InstrConfig['EquipmentTags']['Server'])
-            InstrConn = engine.connect()
+            #a pooled engine, each request checks a connection out and pre-ping replaces any that dropped
+            InstrConn = create_engine(InstrConfig['EquipmentTags']['Server'], pool_pre_ping=True)
         else:
             #Do nothing
             InstrConn =  'Virtual'
+        DriverFor(InstrConfig) #resolve the drivers and bind the codec now rather than on the first request
+        Metrics.Observe('instrument_startup_seconds', time.perf_counter() - StartupStart, {'equipment': InstrConfig['EquipmentTags']['EquipmentName'], 'communication': InstrConfig['EquipmentTags']['Communication']})
         return(InstrConn)
     except Exception as e:
         Status = 'Issue with Instrument connection' + str(e)
@@ -267,285 +992,364 @@ def InitializeInstrumentConnection(InstrConfig, client):
         client.publish("Relay/ServerIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
         sys.exit()   
 
+#---------------- PostGreSQL queries --------------------------
+#all the requested channels' QueryText in one round trip - each query is a numbered branch of a UNION ALL returning
+#the first column of its first row as text along with that column's type, and the value is rebuilt from the text as
+#the type the driver would have returned for fetchone()[0] (numeric stays Decimal, NaN/Infinity stay floats, timestamps
+#stay datetimes). the statement is built once per channel plan. if the batch fails its queries run one at a time, and
+#any that fail on their own too are quarantined for QuarantineTime seconds (default 300) - they run by themselves
+#meanwhile, so they only fail their own channel
+PostGreSQLQuarantine = {}
+PostGreSQLTypes = {'double precision': float, 'real': float, 'smallint': int, 'integer': int, 'bigint': int, 'numeric': Decimal,
+                   'boolean': lambda Text: Text == 'true', 'timestamp without time zone': datetime.fromisoformat,
+                   'timestamp with time zone': datetime.fromisoformat, 'date': date.fromisoformat, 'json': json.loads, 'jsonb': json.loads}
+
+def PostGreSQLBatch(Plan):
+    Branches = ['(SELECT {} AS channel, q.c0::text AS result, pg_typeof(q.c0)::text AS type FROM ({}\n) q(c0) LIMIT 1)'.format(Position, Spec.Fields['QueryText'].strip().rstrip(';'))
+                for Position, Spec in enumerate(Plan)]
+    return text(' UNION ALL '.join(Branches))
+
+#a value from the batch - the text of the first column and its type name, None when the query returned no rows
+def PostGreSQLValue(Result):
+    if Result is None:
+        raise ValueError('query returned no rows')
+    Text, TypeName = Result
+    if Text is None:
+        return None
+    return PostGreSQLTypes.get(TypeName, str)(Text)
+
+#roll back after a failed query - False when the connection itself is gone
+def PostGreSQLRollback(Conn):
+    try:
+        Conn.rollback()
+        return True
+    except Exception:
+        return False
+
 def PostGreSQLR(RequestDetails, InstrConfig, InstrConn, client): 
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    for index, row in ChanDF.iterrows():      
-        try: #note - this is the first draft! we're only doing direct SQL queries, later we might add fancy select statments or similar, but that's a future me problem
-           querybuild = InstrConn.execute(text(row['QueryText']))
-           row['Value'] = querybuild.fetchone()[0]
+    Quarantine = PostGreSQLQuarantine.setdefault(InstrConfig['EquipmentTags']['EquipmentName'], {})
+    Now = time.monotonic()
+    Batch = [Index for Index, row in enumerate(Rows) if Quarantine.get(row['Tagnum'], 0) <= Now and isinstance(row['QueryText'], str)]
+    Batched = set()
+    Values = {}
+    Errors = {}
+    Lost = None
+    try:
+        with InstrConn.connect() as Conn:
+            if len(Batch) > 1:
+                Plan = tuple(Rows[Index].Spec for Index in Batch)
+                try:
+                    Statement = ChannelPlanFor(InstrConfig).DerivedFrom('PostGreSQL', Plan, lambda: PostGreSQLBatch(Plan))
+                    for Position, Result, TypeName in Conn.execute(Statement).fetchall():
+                        Values[Batch[Position]] = (Result, TypeName)
+                    Batched.update(Batch)
+                except Exception as e:
+                    if not PostGreSQLRollback(Conn):
+                        Lost = e
+            for Index, row in enumerate(Rows):
+                if Index in Batched:
+                    continue
+                if Lost is not None: #no connection left to run the rest on - fail them without quarantining anything
+                    Errors[Index] = Lost
+                    continue
+                try: #note - this is the first draft! we're only doing direct SQL queries, later we might add fancy select statments or similar, but that's a future me problem
+                    Values[Index] = Conn.execute(text(row['QueryText'])).fetchone()
+                except Exception as e:
+                    Errors[Index] = e
+                    if not PostGreSQLRollback(Conn):
+                        Lost = e
+                    elif len(Batch) > 1 and Index in Batch: #it broke the batch
+                        Quarantine[row['Tagnum']] = Now + float(InstrConfig['EquipmentTags'].get('QuarantineTime', 300))
+    except Exception as e: #no connection to be had (or it broke closing) - every channel still waiting on it fails with it
+        for Index in range(len(Rows)):
+            if Index not in Batched and Index not in Values and Index not in Errors:
+                Errors[Index] = e
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):
+        try:
+           if Index in Errors:
+               raise Errors[Index]
+           if Index in Batched:
+               row['Value'] = PostGreSQLValue(Values.get(Index))
+           elif Values[Index] is None:
+               raise ValueError('query returned no rows')
+           else:
+               row['Value'] = Values[Index][0]
            FValue = ModbusConvert(row)           
-           ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = {'Value': FValue, 'Time': row['Time']} 
+           ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = ChannelResult(row, FValue) 
         except Exception as e:
             Status = 'Issue with Database Read' + str(e)
             print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
-            pass     
-    return(ReturnData)   
+            CommIssue(client, InstrConfig, Status)
+            pass
+    return ReturnData
 
 def VirtualR(RequestDetails, InstrConfig, InstrConn, client): #One register at a time reads
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    for index, row in ChanDF.iterrows():        
+    for row in TimedRows(Rows, InstrConfig):        
         try:
             #row['Value'] = 15 
             FValue = ModbusConvert(row)
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}            
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)            
         except Exception as e:
             Status = 'Issue with Virtual Read' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     return(ReturnData)
 
 def VirtualW(RequestDetails, InstrConfig, InstrConn, client): #One register at a time writess
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    for index, row in ChanDF.iterrows():        
+    for row in TimedRows(Rows, InstrConfig):        
         try:
             #row['Value'] = 12   
             FValue = row['Value'] #ModbusConvert(row)
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}            
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)            
         except Exception as e:
             Status = 'Issue with Virtual write' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     return(ReturnData)   
 
-def ModbusRTUR(RequestDetails, InstrConfig, InstrConn, client):
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+def ModbusRTUR(RequestDetails, InstrConfig, InstrConn, client): #holding registers read in spans per unit
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']: {}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
+    Spans = ModbusSpans(Rows, InstrConfig, 'RTU', lambda Fields: int(Fields['Unit']), lambda Fields: Fields.get('Type') == 'HRegister' and Fields.get('Registers') in (1, 2))
+    SpanValues = ReadModbusSpans(InstrConn, Rows, Spans, InstrConfig, client)
     
-    for index, row in ChanDF.iterrows():
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):
         try:
             if row['Type'] == 'HRegister' and row['Registers'] == 1:
-                row['Value'] = InstrConn.read_holding_registers(row['IOPoint'], 1, int(row['Unit'])).registers[0]
+                Registers = SpanValues[Index] if Index in SpanValues else InstrConn.read_holding_registers(row['IOPoint'], 1, int(row['Unit'])).registers
+                row['Value'] = Registers[0]
                 FValue = ModbusConvert(row)
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = {'Value': FValue, 'Time': row['Time']} 
+                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = ChannelResult(row, FValue) 
 
             elif row['Type'] == 'HRegister' and row['Registers'] == 2:
-                Ftemp = InstrConn.read_holding_registers(row['IOPoint'], 2, int(row['Unit'])).registers
+                Ftemp = SpanValues[Index] if Index in SpanValues else InstrConn.read_holding_registers(row['IOPoint'], 2, int(row['Unit'])).registers
                 LSB = int(Ftemp[0])
                 MSB = int(Ftemp[1])
                 Fvar = struct.unpack('!f', bytes.fromhex('{0:04x}'.format(LSB) + '{0:04x}'.format(MSB)))
                 FValue = round(Fvar[0], 2)
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = {'Value': FValue, 'Time': row['Time']} 
+                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = ChannelResult(row, FValue) 
 
         except Exception as e:
             Status = 'Issue with Single modbusRTU Read: ' + str(e)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status)
+            CommIssue(client, InstrConfig, Status)
             pass
 
     return(ReturnData)
         
-def ModbusRTUW(RequestDetails, InstrConfig, InstrConn, client):  # One register at a time write
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
-    ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']: {}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-
-    for index, row in ChanDF.iterrows():        
+def ModbusRTUW(RequestDetails, InstrConfig, InstrConn, client):  # contiguous channels per unit written in blocks, read back in spans
+    Rows = ChannelRows(RequestDetails, InstrConfig)
+    Codec = DriverFor(InstrConfig).Codec
+    Writes = []
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):
         try:
-
-            ScaledOutput = ModbusInvert(row)
-            from pymodbus.payload import BinaryPayloadBuilder
-            from pymodbus.payload import BinaryPayloadDecoder
-            
-            bo = '<' if 'ByteOrder' in InstrConfig['EquipmentTags'] and InstrConfig['EquipmentTags']['ByteOrder'] == "Little" else '>'
-            wo = '<' if 'WordOrder' in InstrConfig['EquipmentTags'] and InstrConfig['EquipmentTags']['WordOrder'] == "Little" else '>'
-           
-            builder = BinaryPayloadBuilder(byteorder=bo, wordorder=wo) 
-                        
-            payload = ModbusBuilder(builder,row,ScaledOutput)
-                        
-            payload = builder.build()
-
             #### use row['Unit'] because unlike the TCP version, a serial connection will have multiple units
-            print("number of registers is " + str(int(row['Unit'])))          
-            if row['Type'] == 'HRegister' :
-                InstrConn.write_registers(row['IOPoint'], payload, int(row['Unit']), skip_encode=True)
-                DataArray = InstrConn.read_holding_registers(row['IOPoint'], row['Registers'], int(row['Unit'])).registers
-                print(DataArray)
-                BinValue =  BinaryPayloadDecoder.fromRegisters(DataArray, byteorder=bo, wordorder=wo) 
-                row['Value'] = ModbusDecoder(BinValue,row)
-            elif row['Type'] == 'IRegister':
-                #print("this is an input register")
-                InstrConn.write_registers(row['IOPoint'], payload, int(row['Unit']), skip_encode=True)  
-                DataArray = InstrConn.read_input_registers(row['IOPoint'], row['Registers'], int(row['Unit'])).registers     
-                BinValue =  BinaryPayloadDecoder.fromRegisters(DataArray, byteorder=bo, wordorder=wo) 
-                row['Value'] = ModbusDecoder(BinValue,row)
-            else: # write coil
-                InstrConn.write_coils(row['IOPoint'], row['Value'], int(row['Unit']), skip_encode=True)               
-                row['Value'] = InstrConn.read_coils(row['IOPoint'], row['Registers'], int(row['Unit'])).bits
-            
-            
-            FValue = ModbusConvert(row)
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}            
-
+            Writes.append(ChannelWrite(Index, int(row['Unit']), row, ModbusWriteValues(row, Codec)))
         except Exception as e:
             Status = 'Issue with Single modbusRTU Write: ' + str(e)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status)
+            CommIssue(client, InstrConfig, Status)
             pass
+    Written = WriteModbusChannels(InstrConn, Rows, Writes, InstrConfig, client)
+    return VerifyModbusWrites(InstrConn, Rows, Written, InstrConfig, client, 'VerifyRTU', lambda Fields: int(Fields['Unit']),
+                              lambda row, Value: DecodeModbusValue(row, Value, InstrConfig))
 
-    return(ReturnData)
-
-def ModbusTcpGenericR(RequestDetails, InstrConfig, InstrConn, client): #One register at a time reads
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+def ModbusTcpGenericR(RequestDetails, InstrConfig, InstrConn, client): #Span reads, one register at a time for channels outside a span
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    for index, row in ChanDF.iterrows():        
+    Codec = DriverFor(InstrConfig).Codec
+    Unit = Codec.Unit
+    Spans = ModbusSpans(Rows, InstrConfig, 'Tcp', lambda Fields: Unit)
+    Blocks = {}
+    SpanValues = ReadModbusSpans(InstrConn, Rows, Spans, InstrConfig, client, Blocks)
+    Decoded = DecodeModbusBlocks(Rows, Spans, Blocks, InstrConfig)
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):        
         try:
-            
-            from pymodbus.payload import BinaryPayloadDecoder
-            bo = '<' if 'ByteOrder' in InstrConfig['EquipmentTags'] and InstrConfig['EquipmentTags']['ByteOrder'] == "Little" else '>'
-            wo = '<' if 'WordOrder' in InstrConfig['EquipmentTags'] and InstrConfig['EquipmentTags']['WordOrder'] == "Little" else '>'
+            if Index in Decoded: #already decoded and scaled with the rest of its span
+                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, Decoded[Index])
+                continue
+            if Index in SpanValues:
+                FValue = DecodeModbusValue(row, SpanValues[Index], InstrConfig)
+                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)
+                continue
             
             if row['Type'] == 'HRegister':
-                DataArray = InstrConn.read_holding_registers(row['IOPoint'], row['Registers'], int(InstrConfig['EquipmentTags']['Connection']['Unit'])).registers       
-                BinValue =  BinaryPayloadDecoder.fromRegisters(DataArray, byteorder=bo, wordorder=wo) 
+                DataArray = InstrConn.read_holding_registers(row['IOPoint'], row['Registers'], Codec.Unit).registers       
+                BinValue =  Codec.Decode(DataArray) 
                 row['Value'] = ModbusDecoder(BinValue,row)
             elif row['Type'] == 'IRegister':            
-                DataArray = InstrConn.read_input_registers(row['IOPoint'], row['Registers'], int(InstrConfig['EquipmentTags']['Connection']['Unit'])).registers     
-                BinValue =  BinaryPayloadDecoder.fromRegisters(DataArray, byteorder=bo, wordorder=wo) 
+                DataArray = InstrConn.read_input_registers(row['IOPoint'], row['Registers'], Codec.Unit).registers     
+                BinValue =  Codec.Decode(DataArray) 
                 row['Value'] = ModbusDecoder(BinValue,row)
             elif row['Type'] == 'DiscreteInputs':
-                row['Value'] = InstrConn.read_discrete_inputs(row['IOPoint'], row['Registers'], int(InstrConfig['EquipmentTags']['Connection']['Unit'])).bits[0]
+                row['Value'] = InstrConn.read_discrete_inputs(row['IOPoint'], row['Registers'], Codec.Unit).bits[0]
             else: #read coils
-                row['Value'] = InstrConn.read_coils(row['IOPoint'], row['Registers'], int(InstrConfig['EquipmentTags']['Connection']['Unit'])).bits[0]
+                row['Value'] = InstrConn.read_coils(row['IOPoint'], row['Registers'], Codec.Unit).bits[0]
             
             FValue = ModbusConvert(row)
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}            
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)            
         except Exception as e:
             Status = 'Issue with Updated modbus read' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     return(ReturnData)   
 
-def ModbusTcpGenericW(RequestDetails, InstrConfig, InstrConn, client): #One register at a time reads
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
-    ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    for index, row in ChanDF.iterrows():        
+def ModbusTcpGenericW(RequestDetails, InstrConfig, InstrConn, client): #contiguous channels written in blocks, read back in spans
+    Rows = ChannelRows(RequestDetails, InstrConfig)
+    Codec = DriverFor(InstrConfig).Codec
+    Writes = []
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):
         try:
-            
-            ScaledOutput = ModbusInvert(row)
-            
-            from pymodbus.payload import BinaryPayloadBuilder
-            from pymodbus.payload import BinaryPayloadDecoder
-            
-            bo = '<' if 'ByteOrder' in InstrConfig['EquipmentTags'] and InstrConfig['EquipmentTags']['ByteOrder'] == "Little" else '>'
-            wo = '<' if 'WordOrder' in InstrConfig['EquipmentTags'] and InstrConfig['EquipmentTags']['WordOrder'] == "Little" else '>'
-           
-            builder = BinaryPayloadBuilder(byteorder=bo, wordorder=wo) 
-                        
-            payload = ModbusBuilder(builder,row,ScaledOutput)
-                        
-            payload = builder.build()
-          
-            if row['Type'] == 'HRegister' :
-                InstrConn.write_registers(row['IOPoint'], payload, int(InstrConfig['EquipmentTags']['Connection']['Unit']), skip_encode=True)
-                DataArray = InstrConn.read_holding_registers(row['IOPoint'], row['Registers'], int(InstrConfig['EquipmentTags']['Connection']['Unit'])).registers
-                BinValue =  BinaryPayloadDecoder.fromRegisters(DataArray, byteorder=bo, wordorder=wo) 
-                row['Value'] = ModbusDecoder(BinValue,row)
-            elif row['Type'] == 'IRegister':
-                InstrConn.write_registers(row['IOPoint'], payload, int(InstrConfig['EquipmentTags']['Connection']['Unit']), skip_encode=True)  
-                DataArray = InstrConn.read_input_registers(row['IOPoint'], row['Registers'], int(InstrConfig['EquipmentTags']['Connection']['Unit'])).registers     
-                BinValue =  BinaryPayloadDecoder.fromRegisters(DataArray, byteorder=bo, wordorder=wo) 
-                row['Value'] = ModbusDecoder(BinValue,row)
-            else: # write coil
-                InstrConn.write_coils(row['IOPoint'], row['Value'], int(InstrConfig['EquipmentTags']['Connection']['Unit']), skip_encode=True)               
-                row['Value'] = InstrConn.read_coils(row['IOPoint'], row['Registers'], int(InstrConfig['EquipmentTags']['Connection']['Unit'])).bits
-            
-            
-            FValue = ModbusConvert(row)
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}            
+            Writes.append(ChannelWrite(Index, Codec.Unit, row, ModbusWriteValues(row, Codec)))
         except Exception as e:
             Status = 'Issue with single modbus write' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
-    return(ReturnData)  
+    Written = WriteModbusChannels(InstrConn, Rows, Writes, InstrConfig, client)
+    return VerifyModbusWrites(InstrConn, Rows, Written, InstrConfig, client, 'VerifyTcp', lambda Fields: Codec.Unit,
+                              lambda row, Value: DecodeModbusValue(row, Value, InstrConfig))
 
 def ModbusTcpR(RequestDetails, InstrConfig, InstrConn, client): #Multi-register reads
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    ChanGroups = ChanDF.groupby('Type')
-    for key, data in ChanGroups:    
-        IOmax = ChanGroups['IOPoint'].max().values[0]
-        IOmin = ChanGroups['IOPoint'].min().values[0]
+    Codec = DriverFor(InstrConfig).Codec
+    Unit = Codec.Unit
+    Spans = ModbusSpans(Rows, InstrConfig, 'Tcp', lambda Fields: Unit)
+    SpanValues = ReadModbusSpans(InstrConn, Rows, Spans, InstrConfig, client)
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):
         try:
-            if key == 'HRegister':             
-                DataArray = InstrConn.read_holding_registers(IOmin, IOmax - IOmin + 1, unit = int(InstrConfig['EquipmentTags']['Connection']['Unit'])).registers
-            elif key == 'IRegister':
-                DataArray = InstrConn.read_input_registers(IOmin, IOmax - IOmin + 1, unit = int(InstrConfig['EquipmentTags']['Connection']['Unit'])).registers        
-            else: #read coils
-                DataArray = InstrConn.read_coils(IOmin, IOmax - IOmin + 1, unit = int(InstrConfig['EquipmentTags']['Connection']['Unit'])).bits         
-            DataDF= pd.DataFrame(DataArray, columns=['Values'])
-            DataDF['Regnum']= range(IOmin, IOmax+1)
-            DataDict = DataDF.set_index('Regnum')['Values'].T.to_dict()
-            data['Value'] = data['IOPoint'].map(DataDict)
-            data['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']]
-            for index, row in data.iterrows():
-                FValue = ModbusConvert(row)
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
+            if Index not in SpanValues: #span rejected or failed - read the channel on its own
+                Span = ChannelSpan(row, Unit)
+                Single = {}
+                StoreSpan(Span, 0, ReadModbusSpan(InstrConn, Span), Single, None)
+                SpanValues[Index] = Single[0]
+            if row['Type'] in RegisterTypes and len(SpanValues[Index]) > 1: #multi-register types get decoded
+                BinValue =  Codec.Decode(SpanValues[Index])
+                row['Value'] = ModbusDecoder(BinValue,row)
+            elif row['Type'] in RegisterTypes:
+                row['Value'] = SpanValues[Index][0]
+            else:
+                row['Value'] = SpanValues[Index]
+            FValue = ModbusConvert(row)
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)
         except Exception as e:
             Status = 'Issue with modbus read generic ' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     return(ReturnData)                
 
-def ModbusTcpW(RequestDetails, InstrConfig, InstrConn, client): #One register at a time reads
+#raw register values, read back as the first register of the channel
+def ModbusTcpWValue(row, Value):
+    row['Value'] = Value[0] if row['Type'] in RegisterTypes else Value
+    return ModbusConvert(row)
+
+def ModbusTcpW(RequestDetails, InstrConfig, InstrConn, client): #contiguous channels written in blocks, lone ones with write_register/write_coil
     #print('modbus write')
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
-    ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    for index, row in ChanDF.iterrows():        
+    Rows = ChannelRows(RequestDetails, InstrConfig)
+    Unit = DriverFor(InstrConfig).Codec.Unit
+    Writes = []
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):
         try:
-            if row['Type'] == 'HRegister' :
-                InstrConn.write_register(row['IOPoint'], row['Value'], unit = int(InstrConfig['EquipmentTags']['Connection']['Unit']))
-                row['Value'] = InstrConn.read_holding_registers(row['IOPoint'], 1, unit = int(InstrConfig['EquipmentTags']['Connection']['Unit'])).registers[0]
-            elif row['Type'] == 'IRegister':
-                InstrConn.write_register(row['IOPoint'], row['Value'], unit = int(InstrConfig['EquipmentTags']['Connection']['Unit']))  
-                row['Value'] = InstrConn.read_input_registers(row['IOPoint'], 1, unit = int(InstrConfig['EquipmentTags']['Connection']['Unit'])).registers[0]      
-            else: #read coils
-                InstrConn.write_coil(row['IOPoint'], row['Value'], unit = int(InstrConfig['EquipmentTags']['Connection']['Unit']))               
-                row['Value'] = InstrConn.read_coils(row['IOPoint'], 1, unit = int(InstrConfig['EquipmentTags']['Connection']['Unit'])).bits[0]   
-            FValue = ModbusConvert(row)
-          #ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}    
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}            
+            Values = [int(row['Value'])] if row['Type'] in RegisterTypes else [bool(row['Value'])]
+            Writes.append(ChannelWrite(Index, Unit, row, Values))
         except Exception as e:
             Status = 'Issue with modbus write generic ' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
-    return(ReturnData) 
+    Written = WriteModbusChannels(InstrConn, Rows, Writes, InstrConfig, client, SingleWrites=True)
+    return VerifyModbusWrites(InstrConn, Rows, Written, InstrConfig, client, 'VerifyTcp', lambda Fields: Unit, ModbusTcpWValue)
+
+#---------------- Opto block reads --------------------------
+#the optommp point read areas - the addresses GetAnalogPointValue/GetDigitalPointState read, 0x40 bytes per point and
+#0x1000 per module. Feature is the digital point's feature value at +0x10
+OptoAnalogRead = 0xF0260000
+OptoDigitalRead = 0xF01E0000
+OptoPointSize = 0x40
+OptoModuleSize = 0x1000
+OptoFeatureOffset = 0x10
+#optommp puts the read size in one byte of the request
+OptoMaxBlock = 252
+
+class OptoBlock:
+    __slots__ = ('Start', 'End', 'Members')
+
+    def __init__(self, Start):
+        self.Start = Start
+        self.End = Start
+        self.Members = [] #(row index, byte offset in the block, struct format)
+
+#memory map address and struct format of a channel's 4 byte value
+def OptoPointAddress(Fields):
+    Point = OptoModuleSize * int(Fields['Module']) + OptoPointSize * int(Fields['Channel'])
+    if Fields['Type'] == 'Analog':
+        return OptoAnalogRead + Point, '>f'
+    elif Fields['Type'] == 'Feature':
+        return OptoDigitalRead + Point + OptoFeatureOffset, '>f'
+    return OptoDigitalRead + Point, '>i'
+
+#the fewest ReadBlock ranges of at most OptoBlockSize bytes covering every point in the plan - points sorted by address
+#and packed greedily, so neighbouring modules share a block too. channels without a usable address are left out and
+#read one at a time by OptoR
+def PlanOptoBlocks(Plan, InstrConfig):
+    MaxBlock = min(int(InstrConfig['EquipmentTags'].get('OptoBlockSize', OptoMaxBlock)), 255)
+    Points = []
+    for Index, Spec in enumerate(Plan):
+        try:
+            Address, Format = OptoPointAddress(Spec.Fields)
+        except Exception:
+            continue
+        Points.append((Address, Index, Format))
+    Blocks = []
+    for Address, Index, Format in sorted(Points):
+        if not Blocks or Address + 4 - Blocks[-1].Start > MaxBlock:
+            Blocks.append(OptoBlock(Address))
+        Block = Blocks[-1]
+        Block.End = max(Block.End, Address + 4)
+        Block.Members.append((Index, Address - Block.Start, Format))
+    return Blocks
+
+#{row index: raw value} for every point whose block read worked. the reply is the 16 byte MMP header and the data
+def ReadOptoBlocks(InstrConn, Rows, InstrConfig, client):
+    Plan = tuple(row.Spec for row in Rows)
+    Blocks = ChannelPlanFor(InstrConfig).DerivedFrom('Opto', Plan, lambda: PlanOptoBlocks(Plan, InstrConfig))
+    Values = {}
+    for Block in Blocks:
+        Size = Block.End - Block.Start
+        BlockStart = time.perf_counter()
+        try:
+            Data = bytes(InstrConn.ReadBlock(Block.Start, Size)[16:])
+            if len(Data) < Size:
+                raise ValueError('short reply, ' + str(len(Data)) + ' of ' + str(Size) + ' bytes')
+        except Exception as e:
+            CommIssue(client, InstrConfig, 'Issue with Opto block read at ' + hex(Block.Start) + ', reading its points one at a time ' + str(e))
+            continue
+        StampRows(Rows, [Index for Index, Offset, Format in Block.Members])
+        Metrics.Observe('instrument_span_seconds', time.perf_counter() - BlockStart, {'equipment': InstrConfig['EquipmentTags']['EquipmentName'], 'type': 'Opto'})
+        for Index, Offset, Format in Block.Members:
+            Values[Index] = struct.unpack_from(Format, Data, Offset)[0]
+    return Values
 
 def OptoR(RequestDetails, InstrConfig, InstrConn, client): 
-    #read channels
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    #read channels - with OptoBulkRead the points come from a few block reads, anything those missed is read on its own
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")   
-    for index, row in  ChanDF.iterrows():
+    BlockValues = ReadOptoBlocks(InstrConn, Rows, InstrConfig, client) if InstrConfig['EquipmentTags'].get('OptoBulkRead') else {}
+    for Index, row in enumerate(TimedRows(Rows, InstrConfig)):
         try:
             #read the register and scale it appropriately                     
-            if row['Type'] == 'Analog':
+            if Index in BlockValues:
+               row['Value'] = BlockValues[Index]
+            elif row['Type'] == 'Analog':
                row['Value'] = InstrConn.GetAnalogPointValue(int(row['Module']), int(row['Channel']))   
             #read the coil
             elif row['Type'] == 'Feature':    
@@ -555,21 +1359,19 @@ def OptoR(RequestDetails, InstrConfig, InstrConn, client):
             else:
                 row['Value'] = InstrConn.GetDigitalPointState(int(row['Module']), int(row['Channel']))
             FValue = ModbusConvert(row)
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)
         except Exception as e:
             Status = 'Issue with Opto Read ' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     return ReturnData  
 
 def OptoW(RequestDetails, InstrConfig, InstrConn, client): 
     #read channels
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")   
-    for index, row in  ChanDF.iterrows():
+    for row in TimedRows(Rows, InstrConfig):
         try:
             if row['Type'] == 'Analog':
                InstrConn.SetAnalogPointValue(int(row['Module']), int(row['Channel']), int(row['Value']))                
@@ -579,12 +1381,11 @@ def OptoW(RequestDetails, InstrConfig, InstrConn, client):
                InstrConn.SetDigitalPointState(int(row['Module']), int(row['Channel']), int(row['Value']))
                row['Value'] = InstrConn.GetDigitalPointState(int(row['Module']), int(row['Channel']))
             FValue = ModbusConvert(row)
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)
         except Exception as e:
             Status = 'Issue with Opto Write ' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     return ReturnData   
 
@@ -593,18 +1394,16 @@ def MQTTR(Request, RequestTopic, InstrConfig, InstrConn, client):
     Request_mod = json.loads(Request)
     RequestDetails = json.loads(Request)
     if RequestTopic == InstrConfig['EquipmentTags']['DataReadTopic']:
+        Stamp = time.time_ns() #the values all arrived in this message
         for key, value in Request_mod.items():
-            Time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             FValue = value
             Tagnum = key
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][Tagnum]={"Value": FValue, "Time": Time}
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][Tagnum]={"Value": FValue, "Time": LocalTime(Stamp), "TimeNs": Stamp, "Latency": 0.0}
         #print("ReturnData_Relay_1",ReturnData)
     else:
-        ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
-        ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        Time = ChanDF['Time'][0]
-        First_Tag = ChanDF['Tagnum'][0]
-        ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][First_Tag] = {'Value': 1, 'Time': Time}
+        Rows = ChannelRows(RequestDetails, InstrConfig)
+        First_Tag = Rows[0]['Tagnum']
+        ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][First_Tag] = ChannelResult(Rows[0], 1)
     return ReturnData
        
 def MQTTW(Request, RequestTopic, InstrConfig, InstrConn, client):
@@ -622,39 +1421,78 @@ def MQTTW(Request, RequestTopic, InstrConfig, InstrConn, client):
 #    print("data_from_mqttW",ReturnData)
     return ReturnData
 
-def SCPIR(RequestDetails, InstrConfig, InstrConn, client):
-    # Read channels
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
-    ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']: {}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+#the query for each channel - the first channel flagged Init_Func in a request uses its Init_Text instead.
+#a channel whose query can't be built gets the exception, reported when its row comes up
+def SCPIQueries(Rows):
+    Queries = []
     InitFlag = False
-    for index, row in ChanDF.iterrows():
+    for row in Rows:
         try:
-            # row['Type'] == 'Analog' #confirm data types
             if (row['Init_Func'] == True and InitFlag == False):
-                QueryText = row['Init_Text'] + row['IOPoint'] + '?'
-                DatatoConvert = InstrConn.query(QueryText)  # read and return the data
+                Queries.append(row['Init_Text'] + row['IOPoint'] + '?')
                 InitFlag = True
             else:
-                QueryText = row['RequestText'] + row['IOPoint'] + '?'
-                DatatoConvert = InstrConn.query(QueryText)  # read and return the data
-            FValue = SCPIConvert(DatatoConvert, row) #convert to relevant values
-            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = {'Value': FValue, 'Time': row['Time']}
+                Queries.append(row['RequestText'] + row['IOPoint'] + '?')
+        except Exception as e:
+            Queries.append(e)
+    return Queries
+
+#one response per distinct query. with SCPIBatch > 1 in EquipmentTags up to that many queries go out as one command,
+#joined with ';' and each after the first sent from the root (':'), and the ';' separated reply is split back out.
+#a batch whose reply doesn't come back as one answer per query is retried a query at a time
+def SCPIQueryAll(InstrConn, Queries, InstrConfig):
+    Batch = max(int(InstrConfig['EquipmentTags'].get('SCPIBatch', 1)), 1)
+    Unique = list(dict.fromkeys(Query for Query in Queries if isinstance(Query, str)))
+    Responses = {}
+    Errors = {}
+    for Start in range(0, len(Unique), Batch):
+        Chunk = Unique[Start:Start + Batch]
+        if len(Chunk) > 1:
+            try:
+                Reply = InstrConn.query(';'.join(Chunk[:1] + [Query if Query[:1] in (':', '*') else ':' + Query for Query in Chunk[1:]])).split(';')
+                if len(Reply) == len(Chunk):
+                    Responses.update(zip(Chunk, Reply))
+                    continue
+            except Exception:
+                pass
+        for Query in Chunk:
+            try:
+                Responses[Query] = InstrConn.query(Query)  # read and return the data
+            except Exception as e:
+                Errors[Query] = e
+    return Responses, Errors
+
+def SCPIR(RequestDetails, InstrConfig, InstrConn, client):
+    # Read channels - channels sharing a query (array returns) read it once and each take their ArrayPos
+    Rows = ChannelRows(RequestDetails, InstrConfig)
+    ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']: {}}
+    Queries = SCPIQueries(Rows)
+    Responses, Errors = SCPIQueryAll(InstrConn, Queries, InstrConfig)
+    Parsed = {}
+    for row, QueryText in zip(TimedRows(Rows, InstrConfig), Queries):
+        try:
+            if isinstance(QueryText, Exception):
+                raise QueryText
+            if QueryText in Errors:
+                raise Errors[QueryText]
+            DatatoConvert = Responses[QueryText]
+            if QueryText not in Parsed:
+                Parsed[QueryText] = DatatoConvert.split(',')
+            FValue = SCPIConvert(DatatoConvert, row, Parsed[QueryText]) #convert to relevant values
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = ChannelResult(row, FValue)
         except Exception as e:
             Status = 'Issue with SCPI Read ' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status)
+            CommIssue(client, InstrConfig, Status)
             pass
             
     return ReturnData
 
 def SCPIW(RequestDetails, InstrConfig, InstrConn, client): 
     #read channels
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")   
-    for index, row in  ChanDF.iterrows():
+    for row in TimedRows(Rows, InstrConfig):
         try:
             if row['Type'] == 'Analog': #confirm data types
                 WriteText = "OUTP" + row['IOPoint']
@@ -664,7 +1502,7 @@ def SCPIW(RequestDetails, InstrConfig, InstrConn, client):
                 InstrConn.write(command)
                 read_cmd = f"{row['IOPoint']}?"
                 FValue = InstrConn.query(read_cmd) #write, and read the data has been written
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
+                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)
             else:
                 value = SCPIInvert(row)                
                 command = row['RequestText'] + row['IOPoint'] + " " + str(value)
@@ -672,64 +1510,207 @@ def SCPIW(RequestDetails, InstrConfig, InstrConn, client):
                 QueryText = row['RequestText'] + row['IOPoint'] + '?'      
                 DatatoConvert = InstrConn.query(QueryText)
                 FValue = SCPIConvert(DatatoConvert, row) #convert to relevant values          
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = {'Value': FValue, 'Time': row['Time']}                
+                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']] = ChannelResult(row, FValue)                
         except Exception as e:
             Status = 'Issue with SCPI Write ' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     #InstrConn.close()
     return ReturnData
 
+#---------------- Reachability monitor --------------------------
+#one background asyncio loop probes every Ping instrument's TargetIP each PingInterval seconds (default 1), all targets
+#at once. PingMethod ICMP (default, what ping -c 4 used to measure) sends an echo request on an unprivileged ping socket
+#(needs net.ipv4.ping_group_range to include the user, falls back to TCP otherwise). TCP connects to PingPort (default
+#the instrument's PortNum, else 80) - a refused connection still means the host answered. each target keeps its last
+#PingWindow results (default 20) for latency and loss
+class PingTarget:
+    def __init__(self, InstrConfig):
+        Tags = InstrConfig['EquipmentTags']
+        self.EquipmentName = Tags['EquipmentName']
+        self.Address = Tags['TargetIP']
+        self.Method = str(Tags.get('PingMethod', 'ICMP')).upper()
+        self.Port = int(Tags.get('PingPort', Tags.get('PortNum', 80)))
+        self.Interval = float(Tags.get('PingInterval', 1))
+        self.Timeout = float(Tags.get('PingTimeout', 1))
+        self.Stale = float(Tags.get('PingStale', 2))
+        self.Results = deque(maxlen=int(Tags.get('PingWindow', 20))) #latency in seconds, None for a lost probe
+        self.LastSeen = None
+        self.Wake = None
+        self.Task = None
+
+    def Record(self, Latency):
+        self.Results.append(Latency)
+        Labels = {'equipment': self.EquipmentName}
+        if Latency is None:
+            Metrics.Increment('instrument_ping_lost_total', 1, Labels)
+        else:
+            self.LastSeen = time.monotonic()
+            Metrics.Observe('instrument_ping_seconds', Latency, Labels)
+
+    #0 while the target answered within the last PingStale seconds (default 2), 1 otherwise - what PingR always returned
+    def Status(self):
+        return 0 if self.LastSeen is not None and time.monotonic() - self.LastSeen <= self.Stale else 1
+
+    def Statistic(self, Name):
+        Results = list(self.Results)
+        Answered = [Latency for Latency in Results if Latency is not None]
+        if Name == 'Loss': #percent of the window lost
+            return round(100 * (len(Results) - len(Answered)) / len(Results), 1) if Results else 100.0
+        elif Name == 'Latency': #mean round trip over the window, ms
+            return round(1000 * sum(Answered) / len(Answered), 3) if Answered else None
+        elif Name == 'LastLatency':
+            return round(1000 * Results[-1], 3) if Results and Results[-1] is not None else None
+        return self.Status()
+
+class ReachabilityMonitor:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='Reachability', daemon=True).start()
+        self.Targets = {}
+        self.Sequence = 0
+
+    #start probing an instrument's target, replacing the one it had before (config reload or restart)
+    def Watch(self, InstrConfig):
+        Target = PingTarget(InstrConfig)
+        if Target.Method == 'ICMP':
+            try:
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+            except OSError as e:
+                print('[Unprivileged ICMP not available for ' + Target.EquipmentName + ', probing TCP port ' + str(Target.Port) + ' instead: ' + str(e) + ']')
+                Target.Method = 'TCP'
+        Old = self.Targets.get(Target.EquipmentName)
+        if Old is not None and Old.Task is not None:
+            self.loop.call_soon_threadsafe(Old.Task.cancel)
+        self.Targets[Target.EquipmentName] = Target
+        Target.Task = asyncio.run_coroutine_threadsafe(self.Run(Target), self.loop)
+        return Target
+
+    #probe straight away instead of waiting for the next interval
+    def ProbeNow(self, Target):
+        if Target.Wake is not None:
+            self.loop.call_soon_threadsafe(Target.Wake.set)
+
+    #probes on a fixed grid from the start time, an early probe doesn't move the grid
+    async def Run(self, Target):
+        Target.Wake = asyncio.Event()
+        Start = self.loop.time()
+        Number = 0
+        while True:
+            try:
+                Target.Record(await self.Probe(Target))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e: #keep the grid going whatever one round did
+                print('[Ping monitor for ' + Target.EquipmentName + ': ' + str(e) + ']')
+            Number = max(Number + 1, int((self.loop.time() - Start) / Target.Interval) + 1)
+            try:
+                await asyncio.wait_for(Target.Wake.wait(), max(Start + Number * Target.Interval - self.loop.time(), 0))
+                Target.Wake.clear()
+                Number -= 1
+            except asyncio.TimeoutError:
+                pass
+
+    async def Probe(self, Target):
+        ProbeStart = time.perf_counter()
+        try:
+            if Target.Method == 'ICMP':
+                await asyncio.wait_for(self.Echo(Target), Target.Timeout)
+            else:
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(Target.Address, Target.Port), Target.Timeout)
+                    writer.close()
+                    try:
+                        await writer.wait_closed()
+                    except Exception:
+                        pass
+                except ConnectionRefusedError: #the host sent a reset, so it's up
+                    pass
+            return time.perf_counter() - ProbeStart
+        except (OSError, asyncio.TimeoutError):
+            return None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e: #a broken probe counts as lost, monitoring carries on
+            print('[Ping probe for ' + Target.EquipmentName + ' failed: ' + str(e) + ']')
+            return None
+
+    async def Echo(self, Target):
+        Address = (await self.loop.getaddrinfo(Target.Address, None, family=socket.AF_INET))[0][4][0]
+        #every target probes on this loop, so the sequence this probe waits for is its own
+        self.Sequence = Sequence = (self.Sequence + 1) & 0xFFFF
+        Packet = EchoPacket(Sequence)
+        Sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        Sock.setblocking(False)
+        try:
+            await self.loop.sock_connect(Sock, (Address, 0))
+            await self.loop.sock_sendall(Sock, Packet)
+            while True: #the kernel only hands this socket replies to its own echo id
+                Reply = await self.loop.sock_recv(Sock, 1024)
+                if EchoReplyFor(Reply, Sequence):
+                    return
+        finally:
+            Sock.close()
+
+#ICMP echo request (type 8) with the internet checksum over the header and payload, padded to whole 16 bit words
+EchoPayload = b'MQTT_Instrument'
+
+def EchoChecksum(Data):
+    Padded = Data + b'\0' * (len(Data) % 2)
+    Sum = sum(struct.unpack('!%dH' % (len(Padded) // 2), Padded))
+    Sum = (Sum >> 16) + (Sum & 0xFFFF)
+    return ~(Sum + (Sum >> 16)) & 0xFFFF
+
+def EchoPacket(Sequence):
+    Header = struct.pack('!BBHHH', 8, 0, 0, 0, Sequence) + EchoPayload
+    return Header[:2] + struct.pack('!H', EchoChecksum(Header)) + Header[4:]
+
+def EchoReplyFor(Reply, Sequence):
+    return len(Reply) >= 8 and Reply[0] == 0 and struct.unpack('!H', Reply[6:8])[0] == Sequence
+
+Reachability = None
+
+def ReachabilityFor():
+    global Reachability
+    if Reachability is None:
+        Reachability = ReachabilityMonitor()
+    return Reachability
+
+#writing 0 asks for a probe now and returns the current status (it used to block on ping -c 4), anything else is echoed
 def PingW(RequestDetails, InstrConfig, InstrConn, client): 
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    global last_ping_time
-    for index, row in ChanDF.iterrows():        
+    for row in TimedRows(Rows, InstrConfig):        
         try:
             state = row['Value']
             if state == 0:
-                count=4
-                command = ["ping", "-c", str(count), InstrConn]
-                result = subprocess.run(command, capture_output=True, text=True, check=True)
-                last_ping_time = datetime.now()
-                print('last_ping_time_W', last_ping_time )
-                FValue = result.returncode;
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
+                ReachabilityFor().ProbeNow(InstrConn)
+                FValue = InstrConn.Status()
+                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)
             else: 
                 FValue = state;
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
+                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)
         except Exception as e:
             Status = 'Issue with ping read generic ' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     return(ReturnData)
     
-
+#answered from the monitor's memory. a channel's Statistic picks what it reports: Status (default, 0 reachable / 1 not),
+#Loss (% of the window), Latency (mean ms) or LastLatency (ms)
 def PingR(RequestDetails, InstrConfig, InstrConn, client): 
-    ChanDF = ChanDFBuild(RequestDetails, InstrConfig)
+    Rows = ChannelRows(RequestDetails, InstrConfig)
     ReturnData = {InstrConfig['EquipmentTags']['EquipmentName']:{}}
-    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-    for index, row in ChanDF.iterrows():        
+    for row in TimedRows(Rows, InstrConfig):        
         try:
-            if last_ping_time is None:  #No ping has ever occurred
-                FValue = 1;
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
-            elif datetime.now() - last_ping_time > timedelta(seconds=2): #Missed ping! No ping in the last 2 seconds.
-                print('last_ping_time_R', last_ping_time )
-                FValue = 1;
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
-            else:
-                FValue = 0;
-                ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]={'Value': FValue, 'Time': row['Time']}
+            Statistic = row['Statistic'] if isinstance(row['Statistic'], str) else 'Status'
+            FValue = InstrConn.Statistic(Statistic)
+            ReturnData[InstrConfig['EquipmentTags']['EquipmentName']][row['Tagnum']]=ChannelResult(row, FValue)
         except Exception as e:
             Status = 'Issue with ping read generic ' + str(e)
             #print(Status)
-            Status = json.dumps(Status)
-            client.publish("Relay/CommIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status )
+            CommIssue(client, InstrConfig, Status)
             pass
     return(ReturnData)
@@ -4,8 +4,11 @@ import sys
 import json
 import struct
 import time
+import threading
 import paho.mqtt.client as mqtt
 import MQTT_Instrument_Lib
+import MQTT_Metrics_Lib
+import MQTT_Async_Lib
 from datetime import datetime
 
 
@@ -27,11 +30,19 @@ def on_message(client, userdata, message):
         if RequestTopic  ==    "Relay/PoisonPill/" + InstrConfig['EquipmentTags']['EquipmentName']:
            Status = 'Poison pill arrived - server shutting down'
            print(Status)
+           if Poller is not None:
+               Poller.Stop()
+           if AsyncHost is not None:
+               AsyncHost.Stop() #cancel in-flight requests and close the connections
            Status = json.dumps(Status)    
            client.publish("Relay/ServerIssue/" + InstrConfig['EquipmentTags']['EquipmentName'], Status ) 
            sys.exit()       
         #print("Request_topic",RequestTopic)
-        MQTT_Instrument_Lib.InstrumentSelect(Request, InstrConfig, InstrConn, RequestTopic, client)
+        if AsyncHost is not None:
+            AsyncHost.Submit(Request, RequestTopic) #returns straight away, the request runs on the async loop
+        else:
+            with DeviceLock: #the poll scheduler shares the connection
+                MQTT_Instrument_Lib.InstrumentSelect(Request, InstrConfig, InstrConn, RequestTopic, client)
     except Exception as e:
         Status = '[Received bad message or instrument comms: ' + str(e) + ']'
         print(Status)
@@ -42,6 +53,11 @@ def on_message(client, userdata, message):
 try:
     InstrConfigString = open(sys.argv[1])
     InstrConfig = json.load(InstrConfigString)
+    #optional system config - its DataSampling classes drive the poll scheduler
+    DataSampling = {}
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as SystemConfigString:
+            DataSampling = json.load(SystemConfigString).get('DataSampling', {})
 except Exception as e:
     Status = '[Error with config loading: ' + str(e) + ']'
     print(Status)
@@ -63,8 +79,29 @@ except Exception as e:
     sys.exit()       
 
 #--------------Set up the correct communication protocol--------------
+AsyncHost = None
+Poller = None
+DeviceLock = threading.Lock()
 try:  
-    InstrConn = MQTT_Instrument_Lib.InitializeInstrumentConnection(InstrConfig, client)
+    if InstrConfig['EquipmentTags'].get('Async') and InstrConfig['EquipmentTags']['Communication'] in MQTT_Async_Lib.AsyncCommunications:
+        #asyncio mode - pooled async Modbus connections, requests handled off the paho thread
+        AsyncHost = MQTT_Async_Lib.AsyncInstrument(InstrConfig, client)
+        InstrConn = AsyncHost.Bridge
+    else:
+        InstrConn = MQTT_Instrument_Lib.InitializeInstrumentConnection(InstrConfig, client)
+    #request latency, channel I/O and CommIssue counts on Relay/Metrics/<instrument>
+    MQTT_Metrics_Lib.MetricsPublisher(MQTT_Instrument_Lib.Metrics, client, InstrConfig['EquipmentTags']['EquipmentName'],
+                                      InstrConfig['EquipmentTags'].get('MetricsInterval', 10), InstrConfig['EquipmentTags'].get('MetricsTextFile')).start()
+    #server side polling - publishes straight to Relay/Data, Relay/Request still serves on-demand reads and writes
+    if InstrConfig['EquipmentTags'].get('Polling') and InstrConfig['EquipmentTags']['Communication'] != 'MQTT':
+        def Poll(Request):
+            if AsyncHost is not None:
+                AsyncHost.Run(Request, "Relay/Request/" + InstrConfig['EquipmentTags']['EquipmentName'])
+            else:
+                with DeviceLock:
+                    MQTT_Instrument_Lib.InstrumentSelect(Request, InstrConfig, InstrConn, "Relay/Request/" + InstrConfig['EquipmentTags']['EquipmentName'], client)
+        Poller = MQTT_Instrument_Lib.PollScheduler(InstrConfig, DataSampling, Poll, client)
+        Poller.start()
 except Exception as e:
     Status = '[Error with instrument connection: ' + str(e) + ']'
     print(Status)
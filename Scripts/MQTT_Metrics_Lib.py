@@ -0,0 +1,173 @@
+#!/usr/bin/python           # Metrics helpers shared by the instrument and database servers
+
+import json
+import os
+import time
+import threading
+from datetime import datetime
+
+#default histogram buckets - seconds for latencies
+LatencyBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#-----------------------helper functions------------------
+def LabelKey(Labels):
+    return tuple(sorted(Labels.items())) if Labels else ()
+
+def PrometheusLabels(Key, Extra=None):
+    Pairs = list(Key) + (Extra or [])
+    if not Pairs:
+        return ''
+    Escaped = ['{}="{}"'.format(Name, str(Value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for Name, Value in Pairs]
+    return '{' + ','.join(Escaped) + '}'
+
+class Histogram:
+    def __init__(self, Buckets):
+        self.Buckets = tuple(Buckets)
+        self.Counts = [0] * (len(self.Buckets) + 1)
+        self.Sum = 0.0
+        self.Count = 0
+
+    def Observe(self, Value):
+        Index = 0
+        for Bound in self.Buckets:
+            if Value <= Bound:
+                break
+            Index += 1
+        self.Counts[Index] += 1
+        self.Sum += Value
+        self.Count += 1
+
+    #upper bound of the bucket the quantile falls in - coarse, but enough for capacity tracking
+    def Quantile(self, Fraction):
+        if self.Count == 0:
+            return None
+        Target = Fraction * self.Count
+        Running = 0
+        for Bound, Count in zip(self.Buckets + (float('inf'),), self.Counts):
+            Running += Count
+            if Running >= Target:
+                return Bound if Bound != float('inf') else self.Buckets[-1]
+        return self.Buckets[-1]
+
+#---------------- Metrics registry --------------------------
+#counters, gauges and histograms keyed by metric name and a label dict. thread safe - the paho thread,
+#writer/worker threads and the publisher all touch it. BaseLabels are added to every exported sample
+class MetricsRegistry:
+    def __init__(self, BaseLabels=None):
+        self.BaseLabels = dict(BaseLabels or {})
+        self.Lock = threading.Lock()
+        self.Counters = {}
+        self.Gauges = {}
+        self.GaugeFunctions = {}
+        self.Histograms = {}
+
+    def Increment(self, Name, Amount=1, Labels=None):
+        Key = (Name, LabelKey(Labels))
+        with self.Lock:
+            self.Counters[Key] = self.Counters.get(Key, 0) + Amount
+
+    def SetGauge(self, Name, Value, Labels=None):
+        with self.Lock:
+            self.Gauges[(Name, LabelKey(Labels))] = Value
+
+    #gauges read on demand at publish time, e.g. queue depth
+    def GaugeFunction(self, Name, Function, Labels=None):
+        with self.Lock:
+            self.GaugeFunctions[(Name, LabelKey(Labels))] = Function
+
+    def Observe(self, Name, Value, Labels=None, Buckets=LatencyBuckets):
+        Key = (Name, LabelKey(Labels))
+        with self.Lock:
+            Hist = self.Histograms.get(Key)
+            if Hist is None:
+                Hist = self.Histograms[Key] = Histogram(Buckets)
+            Hist.Observe(Value)
+
+    def Samples(self):
+        with self.Lock:
+            Counters = dict(self.Counters)
+            Gauges = dict(self.Gauges)
+            GaugeFunctions = dict(self.GaugeFunctions)
+            Histograms = {Key: (Hist.Buckets, list(Hist.Counts), Hist.Sum, Hist.Count, Hist.Quantile(0.5), Hist.Quantile(0.95)) for Key, Hist in self.Histograms.items()}
+        for Key, Function in GaugeFunctions.items():
+            try:
+                Gauges[Key] = Function()
+            except Exception as e:
+                print('[Metrics gauge ' + Key[0] + ' failed: ' + str(e) + ']')
+        return Counters, Gauges, Histograms
+
+    def WithBase(self, Key):
+        return tuple(sorted(list(self.BaseLabels.items()) + list(Key)))
+
+    def PrometheusText(self):
+        Counters, Gauges, Histograms = self.Samples()
+        Lines = []
+        Typed = set()
+        def TypeLine(Name, Kind):
+            if Name not in Typed:
+                Typed.add(Name)
+                Lines.append('# TYPE {} {}'.format(Name, Kind))
+        for (Name, Key), Value in sorted(Counters.items()):
+            TypeLine(Name, 'counter')
+            Lines.append('{}{} {}'.format(Name, PrometheusLabels(self.WithBase(Key)), Value))
+        for (Name, Key), Value in sorted(Gauges.items()):
+            TypeLine(Name, 'gauge')
+            Lines.append('{}{} {}'.format(Name, PrometheusLabels(self.WithBase(Key)), Value))
+        for (Name, Key), (Buckets, Counts, Sum, Count, P50, P95) in sorted(Histograms.items()):
+            TypeLine(Name, 'histogram')
+            Labels = self.WithBase(Key)
+            Running = 0
+            for Bound, BucketCount in zip(list(Buckets) + ['+Inf'], Counts):
+                Running += BucketCount
+                Lines.append('{}_bucket{} {}'.format(Name, PrometheusLabels(Labels, [('le', Bound)]), Running))
+            Lines.append('{}_sum{} {}'.format(Name, PrometheusLabels(Labels), Sum))
+            Lines.append('{}_count{} {}'.format(Name, PrometheusLabels(Labels), Count))
+        return '\n'.join(Lines) + '\n'
+
+#---------------- Metrics publisher --------------------------
+#publishes a JSON snapshot to Relay/Metrics/<name> every Interval seconds, counters also carry their per second rate
+#over the last interval. with TextFile set the Prometheus text format is written there too (for a node_exporter
+#textfile collector) - written to a temp file and renamed so a scrape never sees half a file
+class MetricsPublisher(threading.Thread):
+    def __init__(self, Registry, client, Name, Interval=10, TextFile=None):
+        threading.Thread.__init__(self, name='MetricsPublisher', daemon=True)
+        self.Registry = Registry
+        self.client = client
+        self.Name = Name
+        self.Interval = float(Interval)
+        self.TextFile = TextFile
+        self.LastCounters = {}
+        self.LastTime = time.monotonic()
+
+    def run(self):
+        while True:
+            time.sleep(self.Interval)
+            try:
+                self.Publish()
+            except Exception as e:
+                print('[Metrics publish failed: ' + str(e) + ']')
+
+    def Snapshot(self):
+        Counters, Gauges, Histograms = self.Registry.Samples()
+        Now = time.monotonic()
+        Elapsed = max(Now - self.LastTime, 1e-9)
+        Snapshot = {'Name': self.Name, 'Time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'Interval': round(Elapsed, 3), 'Labels': self.Registry.BaseLabels,
+                    'Counters': [], 'Gauges': [], 'Histograms': []}
+        for (Name, Key), Value in sorted(Counters.items()):
+            Rate = (Value - self.LastCounters.get((Name, Key), 0)) / Elapsed
+            Snapshot['Counters'].append({'Metric': Name, 'Labels': dict(Key), 'Value': Value, 'Rate': round(Rate, 3)})
+        for (Name, Key), Value in sorted(Gauges.items()):
+            Snapshot['Gauges'].append({'Metric': Name, 'Labels': dict(Key), 'Value': Value})
+        for (Name, Key), (Buckets, Counts, Sum, Count, P50, P95) in sorted(Histograms.items()):
+            Snapshot['Histograms'].append({'Metric': Name, 'Labels': dict(Key), 'Count': Count, 'Sum': Sum, 'Mean': Sum / Count if Count else None, 'P50': P50, 'P95': P95})
+        self.LastCounters = Counters
+        self.LastTime = Now
+        return Snapshot
+
+    def Publish(self):
+        self.client.publish("Relay/Metrics/" + self.Name, json.dumps(self.Snapshot()))
+        if self.TextFile:
+            TempFile = self.TextFile + '.tmp'
+            with open(TempFile, 'w') as textfile:
+                textfile.write(self.Registry.PrometheusText())
+            os.replace(TempFile, self.TextFile)
@@ -0,0 +1,93 @@
+#!/usr/bin/python           # Packed Relay/Data payloads shared by the instrument and database servers
+
+import json
+import time
+import struct
+import zlib
+import numpy as np
+from datetime import datetime
+
+#---------------- Packed data payload --------------------------
+#an instrument with EquipmentTags Payload "Packed" publishes its results on Relay/Data/<instrument>/Packed instead of
+#JSON on Relay/Data/<instrument>. the payload is a 12 byte header (magic, tag map crc, record count) followed by one
+#20 byte little-endian record per channel: tag index (uint32), value (float64), time (int64 ns since the epoch).
+#the tag index points into the instrument's channel list, which goes out retained on Relay/TagMap/<instrument> as
+#{"Crc": crc, "Tags": [...]} - again every TagMapInterval seconds so a restarted broker or relay picks it up.
+#values are numbers only: bools become 1/0, text that isn't a number becomes NaN (null in the database)
+PackedMagic = b'RPK1'
+PackedHeader = struct.Struct('<4sII')
+PackedRecord = np.dtype([('Tag', '<u4'), ('Value', '<f8'), ('Time', '<i8')])
+PackedSuffix = '/Packed'
+TagMapInterval = 60
+
+def PackedValue(Value):
+    try:
+        return float(Value)
+    except (ValueError, TypeError):
+        return float('nan')
+
+#request times are local "%Y-%m-%d %H:%M:%S" strings (or already epoch ns)
+def EpochNs(Time):
+    if isinstance(Time, int):
+        return Time
+    return int(round(datetime.fromisoformat(str(Time)).timestamp() * 1000000)) * 1000
+
+class PayloadPacker:
+    def __init__(self, InstrConfig):
+        self.EquipmentName = InstrConfig['EquipmentTags']['EquipmentName']
+        self.Tags = [str(Tag) for Tag in InstrConfig['Channels']]
+        self.Index = {Tag: Index for Index, Tag in enumerate(self.Tags)}
+        self.Crc = zlib.crc32(json.dumps(self.Tags).encode())
+        self.TagMap = json.dumps({'Crc': self.Crc, 'Tags': self.Tags})
+        self.Announced = None
+        self.Times = {}
+
+    #(re)publish the retained tag map when it's due
+    def Announce(self, client):
+        if self.Announced is None or time.monotonic() - self.Announced >= TagMapInterval:
+            client.publish("Relay/TagMap/" + self.EquipmentName, self.TagMap, retain=True)
+            self.Announced = time.monotonic()
+
+    #the packed payload for a Relay/Data result, or None when it has anything the tag map can't describe
+    def Pack(self, ReturnData):
+        if list(ReturnData) != [self.EquipmentName]:
+            return None
+        Entries = ReturnData[self.EquipmentName]
+        Records = np.empty(len(Entries), dtype=PackedRecord)
+        try:
+            Records['Tag'] = [self.Index[Tag] for Tag in Entries]
+        except KeyError:
+            return None
+        Records['Value'] = [PackedValue(Entry['Value']) for Entry in Entries.values()]
+        if len(self.Times) > 1000:
+            self.Times.clear()
+        Times = []
+        for Entry in Entries.values():
+            Stamp = Entry.get('TimeNs')
+            if Stamp is None: #results without an acquisition stamp
+                Stamp = self.Times.get(Entry['Time'])
+                if Stamp is None:
+                    Stamp = self.Times[Entry['Time']] = EpochNs(Entry['Time'])
+            Times.append(Stamp)
+        Records['Time'] = Times
+        return PackedHeader.pack(PackedMagic, self.Crc, len(Records)) + Records.tobytes()
+
+#the database side - tag maps by equipment, filled from Relay/TagMap
+class TagMaps:
+    def __init__(self):
+        self.Maps = {}
+
+    def Update(self, Equipment, Payload):
+        TagMap = json.loads(bytes(Payload))
+        self.Maps[Equipment] = (TagMap['Crc'], np.array(TagMap['Tags'], dtype=object))
+
+    #(times, tagnums, values) columns straight from the records - times stay epoch ns, the relay converts them on COPY
+    def Unpack(self, Equipment, Payload):
+        Magic, Crc, Count = PackedHeader.unpack_from(Payload)
+        if Magic != PackedMagic:
+            raise ValueError('not a packed payload')
+        Known = self.Maps.get(Equipment)
+        if Known is None or Known[0] != Crc:
+            raise ValueError('no tag map for ' + Equipment + ' (crc ' + str(Crc) + ')')
+        Records = np.frombuffer(Payload, dtype=PackedRecord, count=Count, offset=PackedHeader.size)
+        return Records['Time'].tolist(), Known[1][Records['Tag']].tolist(), Records['Value'].tolist()
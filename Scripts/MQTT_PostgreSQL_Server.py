@@ -1,104 +1,63 @@
-import numpy as np
 from sqlalchemy import create_engine
 import sys
+import os
 import json
-import struct
-import paho.mqtt.client as mqtt
-import pandas as pd
-from io import StringIO
-import csv
 import time
-import re
-
-global Last_DB_Write
-global DBTemp_df
-
-#-----------------------helper functions------------------
-#this is a special function to convert a pandas dataframe to direct writable CSV - it's referenced in the pandas docs
-def psql_insert_copy(table, conn, keys, data_iter):
-    # gets a DBAPI connection that can provide a cursor
-    dbapi_conn = conn.connection
-    with dbapi_conn.cursor() as cur:
-        s_buf = StringIO()
-        writer = csv.writer(s_buf)
-        writer.writerows(data_iter)
-        s_buf.seek(0)
+import subprocess
+import paho.mqtt.client as mqtt
+import MQTT_Database_Lib
+import MQTT_Metrics_Lib
 
-        columns = ', '.join('"{}"'.format(k) for k in keys)
-        if table.schema:
-            table_name = '{}.{}'.format(table.schema, table.name)
-        else:
-            table_name = table.name
+global DBWriter
 
-        sql = 'COPY {} ({}) FROM STDIN WITH CSV'.format(
-            table_name, columns)
-        cur.copy_expert(sql=sql, file=s_buf)
-		
-		
 #---------------- Communication client --------------------------  Will need update/rework
 #this function sets up the connection to the MQTT Broker and subscribes to all the relevant data
 def on_connect(client, userdata, flags, rc):
-       global Last_DB_Write
-       global DBTemp_df
        global DBConfig
-       print("connected to Broker for " + DBConfig['DatabaseTags']['DatabaseName'])
-       data = {"success?":"totally", "Database":DBConfig['DatabaseTags']['DatabaseName']}
+       print("connected to Broker for " + DBConfig['DatabaseTags']['DatabaseName'] + WorkerName)
+       data = {"success?":"totally", "Database":DBConfig['DatabaseTags']['DatabaseName'] + WorkerName}
        jsondata = json.dumps(data)
        client.publish("Relay/Alive/", jsondata)
-       client.subscribe("Relay/Data/#") #subscribe to all active intrument servers       
+       if Supervisor:
+           pass #the supervisor only listens for the poison pill, the workers take the data
+       elif Shard == 'Shared':
+           client.subscribe("$share/" + DBConfig['DatabaseTags']['DatabaseName'] + "/Relay/Data/#") #the broker splits the data between workers
+           client.subscribe("Relay/TagMap/#") #every worker needs the tag maps of packed instruments
+       else:
+           client.subscribe("Relay/Data/#") #subscribe to all active intrument servers
+           client.subscribe("Relay/TagMap/#") #channel lists for instruments that publish packed data
        client.subscribe("Relay/PoisonPill/" + DBConfig['DatabaseTags']['DatabaseName'])
-       DBTemp_df = pd.DataFrame()
-       Last_DB_Write = time.perf_counter()
 
 #this function responds when a message comes in, it decodes it and then processes the results using the instrument library  
 #at some point it might make sense to move the refactoring into another library, but not immediately
 def on_message(client, userdata, message):
     try:
-        global DBTemp_df
-        global Last_DB_Write
+        global DBWriter
         global DBConfig
-        Request = message.payload.decode()
-        print("Raw Request Payload:", repr(Request))
+        global Stopping
         RequestTopic= message.topic
         #check for shutdown request
         if RequestTopic  ==    "Relay/PoisonPill/" + DBConfig['DatabaseTags']['DatabaseName']:
-           Status = 'Poison pill arrived - server shutting down'
+           if Supervisor:
+               Stopping = True #every worker gets the pill too, the main loop waits for them
+               return
+           Status = 'Poison pill arrived - server shutting down' + WorkerName
            print(Status)
+           DBWriter.Stop() #write out whatever is still buffered
            Status = json.dumps(Status)    
            client.publish("Relay/ServerIssue/" + DBConfig['DatabaseTags']['DatabaseName'], Status ) 
            sys.exit()    
-        try:    #build the data to write
-            RequestDict = json.loads(Request)
-            equipment = list(RequestDict.keys())[0]
-            JSON_df = pd.DataFrame.from_dict(RequestDict[equipment], orient='index')
-            DBRead_df = pd.DataFrame()
-            DBRead_df['time'] = JSON_df['Time']
-            DBRead_df['equipment'] = equipment
-            DBRead_df['tagnum'] = JSON_df.index
-            DBRead_df['value'] = JSON_df['Value']
-            DBRead_df['value'] = DBRead_df['value'].replace(['NULL',False, True, 'OFF', 'ON', 'true', 'false', "OFF", "ON", '', ' '],[np.nan, 0, 1, 0, 1, 1, 0, 0, 1, None, None])   # changed 'OFF' to "OFF" 'ON' to "ON"
-            # Step 2: Replace ISO 8601 timestamp strings from redLion with NaN
-            DBRead_df['value'] = DBRead_df['value'].apply(
-                lambda x: np.nan if isinstance(x, str) and re.match(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}', x) else x )
-            TimeSince = time.perf_counter() - Last_DB_Write
-            print(TimeSince)
-            if TimeSince >= 1 :#check how long it has been since we wrote last, if it's more than one second write
-                Last_DB_Write = time.perf_counter()
-                DBTemp_df = pd.concat([DBTemp_df, DBRead_df], ignore_index=True)
-                DBTemp_df.to_sql(DBConfig['DatabaseDetails']['DefaultTable'], engine, if_exists='append', index=False, method = psql_insert_copy)
-                DBTemp_df = pd.DataFrame()
-            else:
-                DBTemp_df = pd.concat([DBTemp_df, DBRead_df], ignore_index=True)
-        except Exception as d:
-            Status = '[Received bad message or bad database write: ' + str(d) + ']'
-            print(Status)
-            pass #note - this should just throw out bad messages from Redlion
+        #hash sharding - every worker sees every message and keeps its own equipment
+        if Shard == 'Hash' and WorkerCount > 1 and MQTT_Database_Lib.ShardIndex(RequestTopic, WorkerCount) != WorkerIndex:
+           return
+        #hand the raw payload to the writer thread, parsing and the database write happen there
+        DBWriter.Submit(message.payload, RequestTopic)
     except Exception as e:
         Status = '[Received bad message or bad database write: ' + str(e) + ']'
         print(Status)
         Status = json.dumps(Status)    
         client.publish("Relay/ServerIssue/" + DBConfig['DatabaseTags']['DatabaseName'], Status )        
-       
+
 #------------------ Load Database Config  ------------------
 try:
     DBConfigString = open(sys.argv[1])
@@ -108,7 +67,19 @@ except Exception as e:
     Status = '[Error with config loading: ' + str(e) + ']'
     print(Status)
     sys.exit()  
-       
+
+#------------------ Supervisor / worker mode ------------------
+#Workers > 1 turns this process into a supervisor that starts the workers (this script with --worker <index> <count>)
+WorkerCount = int(DBConfig['DatabaseDetails'].get('Workers', 1))
+WorkerIndex = None
+if '--worker' in sys.argv:
+    WorkerIndex = int(sys.argv[sys.argv.index('--worker') + 1])
+    WorkerCount = int(sys.argv[sys.argv.index('--worker') + 2])
+Supervisor = WorkerCount > 1 and WorkerIndex is None
+WorkerName = '' if WorkerIndex is None else ' worker ' + str(WorkerIndex)
+Shard = MQTT_Database_Lib.ShardMode(DBConfig['DatabaseDetails'])
+Stopping = False
+
 #------------------Initialize DB MQTT Server ------------------       
 try:
     client = mqtt.Client()#mqtt.CallbackAPIVersion.VERSION1)
@@ -122,18 +93,53 @@ except Exception as e:
     Status = json.dumps(Status)    
     client.publish("Relay/ServerIssue/" + DBConfig['DatabaseTags']['DatabaseName'], Status )
     sys.exit()  
-    
+
+#------------------Run Supervisor ------------------
+#start the workers, restart any that die, and on the poison pill wait for them to flush and exit
+if Supervisor:
+    def StartWorker(Index):
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), sys.argv[1], '--worker', str(Index), str(WorkerCount)])
+    Workers = [StartWorker(Index) for Index in range(WorkerCount)]
+    client.loop_start()
+    while not Stopping:
+        time.sleep(1)
+        for Index, Worker in enumerate(Workers):
+            if Worker.poll() is not None and not Stopping:
+                Status = '[Database worker ' + str(Index) + ' exited with ' + str(Worker.returncode) + ', restarting]'
+                print(Status)
+                client.publish("Relay/ServerIssue/" + DBConfig['DatabaseTags']['DatabaseName'], json.dumps(Status))
+                Workers[Index] = StartWorker(Index)
+    Deadline = time.monotonic() + float(DBConfig['DatabaseDetails'].get('WorkerStopTimeout', 60))
+    for Worker in Workers:
+        try:
+            Worker.wait(timeout=max(Deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            Worker.kill()
+    Status = 'Poison pill arrived - database workers stopped'
+    print(Status)
+    client.publish("Relay/ServerIssue/" + DBConfig['DatabaseTags']['DatabaseName'], json.dumps(Status))
+    client.loop_stop()
+    sys.exit()  
+
 #------------------Initialize DB Connection ------------------
 try:
     engine = create_engine(DBConfig['DatabaseDetails']['Server'])
-    pd.options.mode.chained_assignment = None
+    DBWriter = MQTT_Database_Lib.DatabaseWriter(engine, DBConfig, client, os.path.dirname(os.path.abspath(sys.argv[1])), WorkerIndex)
+    DBWriter.start()
+    #throughput, flush and buffer metrics on Relay/Metrics/<database>
+    MetricsName = DBConfig['DatabaseTags']['DatabaseName']
+    MetricsTextFile = DBConfig['DatabaseDetails'].get('MetricsTextFile')
+    if WorkerIndex is not None: #one topic and text file per worker
+        MetricsName = MetricsName + '-' + str(WorkerIndex)
+        MetricsTextFile = MetricsTextFile and '{0}-{2}{1}'.format(*os.path.splitext(MetricsTextFile), WorkerIndex)
+    MQTT_Metrics_Lib.MetricsPublisher(DBWriter.Metrics, client, MetricsName, DBConfig['DatabaseDetails'].get('MetricsInterval', 10), MetricsTextFile).start()
 except Exception as e:
     Status = '[Error - unable to connect to postgresql: ', str(e), ']'
     print(Status)
     Status = json.dumps(Status)    
-    client.publish("Relay/ServerIssue/" + DBConfig['DatabaseTags']['DatabaseName'], Status )    
-    sys.exit()
-    
+    client.publish("Relay/ServerIssue/" + DBConfig['DatabaseTags']['DatabaseName'], Status )
+    sys.exit()  
+
 #--------------------Run Server ----------------------------
 while True:
    try:
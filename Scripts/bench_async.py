@@ -0,0 +1,79 @@
+#!/usr/bin/python           # Throughput of the async Modbus path against the sync one, on a simulated slow device
+#usage: python bench_async.py [requests] [device delay ms]
+
+import sys
+import json
+import time
+import struct
+import random
+import asyncio
+import threading
+import MQTT_Instrument_Lib
+import MQTT_Async_Lib
+
+Requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+Delay = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+random.seed(2)
+Memory = [random.randrange(65536) for Register in range(1000)]
+
+#a modbus tcp device answering holding register reads after Delay seconds
+async def Device(reader, writer):
+    try:
+        while True:
+            Tid, Proto, Length, Unit = struct.unpack('>HHHB', await reader.readexactly(7))
+            Pdu = await reader.readexactly(Length - 1)
+            Code, Address, Count = struct.unpack('>BHH', Pdu[:5])
+            await asyncio.sleep(Delay)
+            Body = struct.pack('>BB', Code, Count * 2) + b''.join(struct.pack('>H', Memory[Address + i]) for i in range(Count))
+            writer.write(struct.pack('>HHHB', Tid, 0, len(Body) + 1, Unit) + Body)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+def Serve(Ready):
+    loop = asyncio.new_event_loop()
+    Server = loop.run_until_complete(asyncio.start_server(Device, '127.0.0.1', 0))
+    Ready.append(Server.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+class Client:
+    def __init__(self):
+        self.Published = []
+
+    def publish(self, Topic, Payload, **kwargs):
+        self.Published.append((Topic, Payload))
+
+Ready = []
+threading.Thread(target=Serve, args=(Ready,), daemon=True).start()
+while not Ready:
+    time.sleep(0.01)
+#three channels far enough apart to be three spans
+Channels = {'T%d' % i: {'Type': 'HRegister', 'DataType': 'float32', 'Registers': 2, 'IOPoint': i * 40, 'Scalar': 1, 'Offset': 0, 'Decimal': 2} for i in range(3)}
+def Config(Name, Async):
+    return {'EquipmentTags': {'EquipmentName': Name, 'Communication': 'ModbusTcpGeneric', 'PortNum': Ready[0], 'Connection': {'IP': '127.0.0.1', 'Unit': 1},
+                              'Async': Async, 'AsyncConnections': 4, 'RequestTimeout': 5}, 'Channels': Channels}
+Request = json.dumps({'Read/Write': 'R', 'Channels': {Tag: 0 for Tag in Channels}})
+
+SyncClient = Client()
+SyncConfig = Config('Sync', False)
+Connection = MQTT_Instrument_Lib.InitializeInstrumentConnection(SyncConfig, SyncClient)
+Start = time.perf_counter()
+for Number in range(Requests):
+    MQTT_Instrument_Lib.InstrumentSelect(Request, SyncConfig, Connection, 'Relay/Request/Sync', SyncClient)
+Sync = time.perf_counter() - Start
+
+AsyncClient = Client()
+Instrument = MQTT_Async_Lib.AsyncInstrument(Config('Async', True), AsyncClient)
+Start = time.perf_counter()
+for Number in range(Requests):
+    Instrument.Submit(Request, 'Relay/Request/Async')
+while len([Topic for Topic, Payload in AsyncClient.Published if Topic == 'Relay/Data/Async']) < Requests:
+    time.sleep(0.001)
+Async = time.perf_counter() - Start
+Instrument.Stop()
+
+Values = lambda Published, Name: [Entry['Value'] for Entry in json.loads(Published[-1][1])[Name].values()]
+print('%d requests x %d spans, device answers in %d ms' % (Requests, len(Channels), Delay * 1000))
+print('sync  %.3f s  %.1f requests/s' % (Sync, Requests / Sync))
+print('async %.3f s  %.1f requests/s' % (Async, Requests / Async))
+print('same values:', Values(SyncClient.Published, 'Sync') == Values(AsyncClient.Published, 'Async'))
@@ -0,0 +1,62 @@
+#!/usr/bin/python           # Per-request channel setup: compiled channel plans against ChanDFBuild + iterrows
+#usage: python bench_channel_plans.py [channels] [requests]
+
+import sys
+import time
+from datetime import datetime
+import pandas as pd
+import MQTT_Instrument_Lib
+
+Count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+Requests = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+Channels = {}
+for Number in range(Count):
+    Channels['T%d' % Number] = {"Active": True, "DataType": "float32" if Number % 3 else "int16", "Type": "HRegister", "Registers": 1, "ReadWrite": "R", "IOPoint": Number,
+                                "Scalar": 0.1 if Number % 2 else 1, "Offset": 0, "Decimal": 2, "Units": "NA", "Tags": ["X"]}
+InstrConfig = {'EquipmentTags': {'EquipmentName': 'Virtual', 'Communication': 'Virtual'}, 'Channels': Channels}
+Request = {'Read/Write': 'R', 'Channels': {Tag: (Number * 1.37 if Number % 3 else Number) for Number, Tag in enumerate(Channels)}}
+
+class Client:
+    def publish(self, *args, **kwargs):
+        pass
+
+#the channel DataFrame every driver used to build per request
+def ChanDFBuild(RequestDetails, InstrConfig):
+    ChannelList = []
+    KeyList = []
+    ValueList = []
+    for key in RequestDetails['Channels']:
+        ChannelList.append(InstrConfig['Channels'][key])
+        KeyList.append(key)
+        ValueList.append(RequestDetails['Channels'][key])
+    ChanDF = pd.DataFrame(ChannelList)
+    ChanDF['Tagnum'] = KeyList
+    ChanDF['Value'] = ValueList
+    return ChanDF
+
+#VirtualR before channel plans - a DataFrame built from the config on every request, walked with iterrows
+def DataFramePath():
+    ChanDF = ChanDFBuild(Request, InstrConfig)
+    ReturnData = {}
+    ChanDF['Time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for index, row in ChanDF.iterrows():
+        ReturnData[row['Tagnum']] = {'Value': MQTT_Instrument_Lib.ModbusConvert(row), 'Time': row['Time']}
+    return ReturnData
+
+def PlanPath():
+    return MQTT_Instrument_Lib.VirtualR(Request, InstrConfig, 'Virtual', Client())['Virtual']
+
+def PerRequest(Function):
+    Begin = time.perf_counter()
+    for Number in range(Requests):
+        Result = Function()
+    return (time.perf_counter() - Begin) / Requests, Result
+
+Old, Expected = PerRequest(DataFramePath)
+New, Result = PerRequest(PlanPath)
+print('%d channels, %d requests' % (Count, Requests))
+print('ChanDFBuild + iterrows %.3f ms/request' % (Old * 1000))
+print('channel plan           %.3f ms/request' % (New * 1000))
+#the old path scaled a float32 scalar, so compare at the configured precision
+Differ = [Tag for Tag in Channels if round(float(Expected[Tag]['Value']), 2) != round(Result[Tag]['Value'], 2)]
+print('values that differ:', Differ)
@@ -0,0 +1,51 @@
+#!/usr/bin/python           # Encoding a COPY batch: binary stream against the CSV text the relay used to send
+#usage: python bench_copy.py [rows]
+#client side only - the server also skips parsing float and timestamp text with FORMAT BINARY, which needs a live
+#postgres to measure
+
+import sys
+import csv
+import time
+import random
+from io import StringIO
+from datetime import datetime
+import MQTT_Database_Lib
+
+Rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+random.seed(3)
+Zone = datetime.now().astimezone().tzinfo
+Start = time.time_ns()
+#100 tags per equipment sampled at 10 Hz - time, equipment and tagnum repeat, values don't
+Times = [Start + (Row // 100) * 100000000 for Row in range(Rows)]
+TimeText = [MQTT_Database_Lib.EpochNsText(Time, Zone, True) for Time in Times]
+Equipment = ['Equipment%d' % (Row // 100 % 10) for Row in range(Rows)]
+Tagnums = ['T%d' % (Row % 100) for Row in range(Rows)]
+Values = [None if random.random() < 0.01 else random.uniform(-1000, 1000) for Row in range(Rows)]
+#time timestamptz, equipment text, tagnum text, value float8
+TypeOids = (1184, 25, 25, 701)
+
+#what psql_insert_copy builds
+def CsvPath():
+    s_buf = StringIO()
+    writer = csv.writer(s_buf)
+    writer.writerows(zip(TimeText, Equipment, Tagnums, Values))
+    return s_buf.getvalue().encode()
+
+def BinaryPath():
+    return MQTT_Database_Lib.BinaryCopyStream(TypeOids, Zone, (Times, Equipment, Tagnums, Values))
+
+def BinaryTextTimes():
+    return MQTT_Database_Lib.BinaryCopyStream(TypeOids, Zone, (TimeText, Equipment, Tagnums, Values))
+
+def Best(Function, Repeats=3):
+    Times = []
+    for Repeat in range(Repeats):
+        Begin = time.perf_counter()
+        Result = Function()
+        Times.append(time.perf_counter() - Begin)
+    return min(Times), Result
+
+print('%d rows (time, equipment, tagnum, value)' % Rows)
+for Name, Function in (('CSV text', CsvPath), ('binary, epoch ns times', BinaryPath), ('binary, text times', BinaryTextTimes)):
+    Elapsed, Stream = Best(Function)
+    print('%-24s %7.1f ms  %9.0f rows/s  %8d bytes' % (Name, Elapsed * 1000, Rows / Elapsed, len(Stream)))
@@ -0,0 +1,38 @@
+#!/usr/bin/python           # Driver dispatch: cached InstrumentDriver + bound ModbusCodec against globals() lookup + per-row imports
+#usage: python bench_dispatch.py [channels]
+
+import sys
+import time
+import timeit
+import MQTT_Instrument_Lib
+
+Channels = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+InstrConfig = {'EquipmentTags': {'EquipmentName': 'Modbus', 'Communication': 'ModbusTcpGeneric', 'Connection': {'Unit': 1}, 'ByteOrder': 'Big', 'WordOrder': 'Little'}, 'Channels': {}}
+Registers = [0x0fdb, 0x4049] #pi, low word first
+
+Start = time.perf_counter()
+MQTT_Instrument_Lib.DriverFor(InstrConfig)
+print('first driver resolve + codec bind (loads pymodbus.payload) %.1f ms' % ((time.perf_counter() - Start) * 1000))
+
+#InstrumentSelect and the Modbus drivers before the registry - driver found in globals() on every request, the
+#decoder imported and the byte and word orders worked out again for every channel
+def GlobalsPath():
+    func = globals()['MQTT_Instrument_Lib'].__dict__['ModbusTcpGenericR']
+    for Channel in range(Channels):
+        from pymodbus.payload import BinaryPayloadDecoder
+        byteorder = '<' if 'ByteOrder' in InstrConfig['EquipmentTags'] and InstrConfig['EquipmentTags']['ByteOrder'] == "Little" else '>'
+        wordorder = '<' if 'WordOrder' in InstrConfig['EquipmentTags'] and InstrConfig['EquipmentTags']['WordOrder'] == "Little" else '>'
+        Value = BinaryPayloadDecoder.fromRegisters(Registers, byteorder=byteorder, wordorder=wordorder).decode_32bit_float()
+    return Value
+
+def RegistryPath():
+    Driver = MQTT_Instrument_Lib.DriverFor(InstrConfig)
+    func = Driver.Function('R')
+    for Channel in range(Channels):
+        Value = Driver.Codec.Decode(Registers).decode_32bit_float()
+    return Value
+
+print('%d channels per request' % Channels)
+for Name, Function in (('globals() + per-row import', GlobalsPath), ('driver registry + codec', RegistryPath)):
+    PerRequest = min(timeit.repeat(Function, number=500, repeat=5)) / 500
+    print('%-28s %7.1f us/request  %.2f us/channel  value %r' % (Name, PerRequest * 1e6, PerRequest / Channels * 1e6, Function()))
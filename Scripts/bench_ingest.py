@@ -0,0 +1,65 @@
+#!/usr/bin/python           # Buffering Relay/Data messages: columnar IngestBuffer against the per-message DataFrame path it replaced
+#usage: python bench_ingest.py [messages] [tags per message]
+
+import re
+import sys
+import json
+import time
+import random
+import numpy as np
+import pandas as pd
+import MQTT_Database_Lib
+
+Messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+Tags = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+random.seed(1)
+Start = time.time_ns()
+#one flush window of JSON payloads as the relay receives them, a few sentinel values mixed in
+Payloads = []
+for Number in range(Messages):
+    Equipment = 'Equipment%d' % (Number % 10)
+    Entries = {}
+    for Tag in range(Tags):
+        Value = random.choice(['NULL', 'ON', 'OFF', True, '']) if random.random() < 0.05 else round(random.uniform(-1000, 1000), 3)
+        Stamp = Start + Number * 100000000
+        Entries['T%d' % Tag] = {'Value': Value, 'Time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(Stamp / 1e9)), 'TimeNs': Stamp}
+    Payloads.append(json.dumps({Equipment: Entries}).encode())
+
+#the relay before the ingest buffer - a DataFrame per message, cleaned and concatenated onto the pending frame
+def DataFramePath():
+    Pending = pd.DataFrame()
+    for Payload in Payloads:
+        RequestDict = json.loads(Payload.decode())
+        equipment = list(RequestDict.keys())[0]
+        JSON_df = pd.DataFrame.from_dict(RequestDict[equipment], orient='index')
+        DBRead_df = pd.DataFrame()
+        DBRead_df['time'] = JSON_df['Time']
+        DBRead_df['equipment'] = equipment
+        DBRead_df['tagnum'] = JSON_df.index
+        DBRead_df['value'] = JSON_df['Value']
+        DBRead_df['value'] = DBRead_df['value'].replace(['NULL', False, True, 'OFF', 'ON', 'true', 'false', "OFF", "ON", '', ' '], [np.nan, 0, 1, 0, 1, 1, 0, 0, 1, None, None])
+        DBRead_df['value'] = DBRead_df['value'].apply(lambda x: np.nan if isinstance(x, str) and re.match(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}', x) else x)
+        Pending = pd.concat([Pending, DBRead_df], ignore_index=True)
+    return Pending
+
+def BufferPath():
+    Buffer = MQTT_Database_Lib.IngestBuffer()
+    for Payload in Payloads:
+        Buffer.AppendMessage(json.loads(Payload))
+    return MQTT_Database_Lib.BufferBatch(Buffer)
+
+def Best(Function, Repeats=3):
+    Times = []
+    for Repeat in range(Repeats):
+        Begin = time.perf_counter()
+        Result = Function()
+        Times.append(time.perf_counter() - Begin)
+    return min(Times), Result
+
+Old, Frame = Best(DataFramePath)
+New, Columns = Best(BufferPath)
+print('%d messages x %d tags (%d rows), parse + buffer + clean' % (Messages, Tags, Messages * Tags))
+print('DataFrame per message %.1f ms  %.0f rows/s' % (Old * 1000, Messages * Tags / Old))
+print('IngestBuffer          %.1f ms  %.0f rows/s' % (New * 1000, Messages * Tags / New))
+Same = [None if Value != Value else float(Value) for Value in Frame['value'].tolist()] == Columns[3]
+print('same values:', Same)
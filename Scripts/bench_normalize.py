@@ -0,0 +1,40 @@
+#!/usr/bin/python           # Value cleaning: NormalizeValues against the Series.replace + per-row regex apply it replaced
+#usage: python bench_normalize.py [values]
+
+import re
+import sys
+import time
+import random
+import numpy as np
+import pandas as pd
+import MQTT_Database_Lib
+
+Count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+random.seed(5)
+Sentinels = ['NULL', 'ON', 'OFF', 'true', 'false', True, False, '', ' ', '2024-05-01T12:00:00Z']
+Batches = {
+    'all float': [random.uniform(-1000, 1000) for Number in range(Count)],
+    'mixed sentinels': [random.choice(Sentinels) if random.random() < 0.1 else random.uniform(-1000, 1000) for Number in range(Count)],
+}
+
+#the relay's cleaning before NormalizeValues
+def SeriesPath(Values):
+    Series = pd.Series(Values, dtype=object)
+    Series = Series.replace(['NULL', False, True, 'OFF', 'ON', 'true', 'false', "OFF", "ON", '', ' '], [np.nan, 0, 1, 0, 1, 1, 0, 0, 1, None, None])
+    Series = Series.apply(lambda x: np.nan if isinstance(x, str) and re.match(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}', x) else x)
+    return Series.astype(float).to_numpy()
+
+def Best(Function, Values, Repeats=5):
+    Times = []
+    for Repeat in range(Repeats):
+        Begin = time.perf_counter()
+        Result = Function(Values)
+        Times.append(time.perf_counter() - Begin)
+    return min(Times), Result
+
+print('%d values per batch' % Count)
+for Name, Values in Batches.items():
+    Old, Expected = Best(SeriesPath, Values)
+    New, (Array, Nulls) = Best(MQTT_Database_Lib.NormalizeValues, Values)
+    Same = np.array_equal(Expected, Array, equal_nan=True)
+    print('%-16s Series.replace %6.2f ms  NormalizeValues %6.2f ms  same values: %s' % (Name, Old * 1000, New * 1000, Same))
@@ -0,0 +1,49 @@
+#!/usr/bin/python           # Relay/Data payloads: packed records against JSON, from PublishData to the ingest buffer
+#usage: python bench_payload.py [channels]
+
+import sys
+import json
+import time
+import timeit
+import random
+import MQTT_Instrument_Lib
+import MQTT_Database_Lib
+import MQTT_Payload_Lib
+
+Count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+random.seed(8)
+Channels = {'Tag%03d' % Number: {'Type': 'HRegister'} for Number in range(Count)}
+Now = time.time_ns()
+ReturnData = {'Pump': {Tag: {'Value': round(random.uniform(-1000, 1000), 3), 'Time': '', 'TimeNs': Now + Number * 1000, 'Latency': 0.001} for Number, Tag in enumerate(Channels)}}
+ReturnData['Pump']['Tag000']['Value'] = 'NULL'
+ReturnData['Pump']['Tag001']['Value'] = True
+
+class Client:
+    def __init__(self):
+        self.Published = []
+
+    def publish(self, Topic, Payload, **kwargs):
+        self.Published.append((Topic, Payload if isinstance(Payload, bytes) else Payload.encode()))
+
+Results = {}
+for Payload in ('JSON', 'Packed'):
+    InstrConfig = {'EquipmentTags': {'EquipmentName': 'Pump', 'Communication': 'Virtual', 'Payload': Payload}, 'Channels': Channels}
+    Published = Client()
+    MQTT_Instrument_Lib.PublishData(Published, InstrConfig, ReturnData)
+    TagMaps = MQTT_Payload_Lib.TagMaps()
+    for Topic, Raw in Published.Published:
+        if Topic.startswith('Relay/TagMap/'):
+            TagMaps.Update('Pump', Raw)
+    Topic, Raw = [Message for Message in Published.Published if Message[0].startswith('Relay/Data/')][0]
+    def Ingest():
+        Buffer = MQTT_Database_Lib.IngestBuffer()
+        if Topic.endswith(MQTT_Payload_Lib.PackedSuffix):
+            Buffer.AppendColumns('Pump', *TagMaps.Unpack('Pump', Raw))
+        else:
+            Buffer.AppendMessage(json.loads(Raw))
+        return Buffer
+    Encode = min(timeit.repeat(lambda: MQTT_Instrument_Lib.PublishData(Client(), InstrConfig, ReturnData), number=2000, repeat=3)) / 2000
+    Decode = min(timeit.repeat(Ingest, number=2000, repeat=3)) / 2000
+    Results[Payload] = MQTT_Database_Lib.BufferBatch(Ingest())
+    print('%-6s %-26s %6d bytes  encode %6.1f us  decode %6.1f us' % (Payload, Topic, len(Raw), Encode * 1e6, Decode * 1e6))
+print('%d channels, same buffered rows: %s' % (Count, Results['JSON'] == Results['Packed']))
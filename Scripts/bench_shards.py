@@ -0,0 +1,67 @@
+#!/usr/bin/python           # Ingest throughput with the relay's Hash sharding over 1..N worker processes
+#usage: python bench_shards.py [max workers] [messages]
+#every worker sees every Relay/Data message (as with Hash mode on the broker), skips the equipment it doesn't own and
+#parses, buffers, cleans and binary-encodes the rest. the broker and the COPY itself are not part of this
+
+import os
+import sys
+import json
+import time
+import random
+import multiprocessing
+from datetime import datetime
+import MQTT_Database_Lib
+
+MaxWorkers = int(sys.argv[1]) if len(sys.argv) > 1 else min(os.cpu_count() or 1, 8)
+Messages = int(sys.argv[2]) if len(sys.argv) > 2 else 4000
+Zone = datetime.now().astimezone().tzinfo
+TypeOids = (1184, 25, 25, 701)
+
+def RelayData(Messages):
+    Random = random.Random(6)
+    Start = time.time_ns()
+    Payloads = []
+    for Number in range(Messages):
+        Equipment = 'Equipment%d' % (Number % 40)
+        Entries = {'T%d' % Tag: {'Value': round(Random.uniform(-1000, 1000), 3), 'Time': '', 'TimeNs': Start + Number * 1000000} for Tag in range(50)}
+        Payloads.append(('Relay/Data/' + Equipment, json.dumps({Equipment: Entries}).encode()))
+    return Payloads
+
+def Worker(Index, Count, Payloads, Ready, Go, Results):
+    Ready.put(Index)
+    Go.wait()
+    Buffer = MQTT_Database_Lib.IngestBuffer()
+    for Topic, Payload in Payloads:
+        if Count > 1 and MQTT_Database_Lib.ShardIndex(Topic, Count) != Index:
+            continue
+        Buffer.AppendMessage(json.loads(Payload))
+        if len(Buffer) >= 10000:
+            MQTT_Database_Lib.BinaryCopyStream(TypeOids, Zone, MQTT_Database_Lib.BufferBatch(Buffer))
+            Buffer.Clear()
+    if len(Buffer):
+        MQTT_Database_Lib.BinaryCopyStream(TypeOids, Zone, MQTT_Database_Lib.BufferBatch(Buffer))
+    Results.put(time.perf_counter())
+
+def Run(Count, Payloads):
+    Ready, Results, Go = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+    Processes = [multiprocessing.Process(target=Worker, args=(Index, Count, Payloads, Ready, Go, Results)) for Index in range(Count)]
+    for Process in Processes:
+        Process.start()
+    for Process in Processes:
+        Ready.get()
+    Start = time.perf_counter()
+    Go.set()
+    Finished = max(Results.get() for Process in Processes)
+    for Process in Processes:
+        Process.join()
+    return Finished - Start
+
+if __name__ == '__main__':
+    Payloads = RelayData(Messages)
+    Rows = Messages * 50
+    print('%d messages, %d rows from 40 equipment, %d cpus' % (Messages, Rows, os.cpu_count() or 1))
+    Count = 1
+    while Count <= MaxWorkers:
+        Elapsed = Run(Count, Payloads)
+        print('%2d worker(s) %7.1f ms  %9.0f rows/s' % (Count, Elapsed * 1000, Rows / Elapsed))
+        Count *= 2
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#the servers run from Scripts/ and import their libraries as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Scripts'))
@@ -0,0 +1,126 @@
+import math
+import random
+import pytest
+import MQTT_Instrument_Lib as Lib
+
+
+class Response:
+    def __init__(self, Registers):
+        self.registers = Registers
+
+    def isError(self):
+        return False
+
+
+class FakeModbus:
+    def __init__(self, Memory):
+        self.Memory = Memory
+
+    def read_holding_registers(self, Address, Count, Unit):
+        return Response(self.Memory[Address:Address + Count])
+    read_input_registers = read_holding_registers
+
+
+class FakeClient:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+def Memory(Seed):
+    Random = random.Random(Seed)
+    Registers = [Random.randrange(65536) for Register in range(3000)]
+    for Address in range(0, 3000, 97): #NaN floats
+        Registers[Address:Address + 2] = [0x7fc0, 0]
+    for Address in range(50, 3000, 131): #infinite floats
+        Registers[Address:Address + 2] = [0x7f80, 0]
+    return Registers
+
+
+def RandomChannels(Seed):
+    Random = random.Random(Seed)
+    Channels = {}
+    Address = 0
+    for Number in range(400):
+        DataType = Random.choice(list(Lib.BlockTypes))
+        Width = 2 if DataType in ('int32', 'float32') else 1
+        Channels['T%d' % Number] = {'Type': Random.choice(['HRegister', 'IRegister']), 'DataType': DataType, 'Registers': Width, 'IOPoint': Address,
+                                    'Scalar': Random.choice([1, 0.1, 2.5, -3, 0.001]), 'Offset': Random.choice([0, 1, -273.15, 0.5]),
+                                    'Decimal': Random.choice([0, 1, 2, 3]), 'Unit': 1}
+        Address += Width + Random.choice([0, 0, 1])
+    return Channels
+
+
+def Read(Channels, Registers, ByteOrder, WordOrder, BlockDecode):
+    Name = 'M%s%s%s' % (ByteOrder, WordOrder, BlockDecode)
+    Config = {'EquipmentTags': {'Communication': 'ModbusTcpGeneric', 'EquipmentName': Name, 'Connection': {'Unit': 1}, 'SpanGap': 1,
+                                'ByteOrder': ByteOrder, 'WordOrder': WordOrder, 'BlockDecode': BlockDecode}, 'Channels': Channels}
+    Request = {'Read/Write': 'R', 'Channels': {Tag: 0 for Tag in Channels}}
+    return Lib.ModbusTcpGenericR(Request, Config, FakeModbus(Registers), FakeClient())[Name]
+
+
+def Same(Block, Row):
+    if isinstance(Block, float) and isinstance(Row, float) and math.isnan(Block) and math.isnan(Row):
+        return True
+    return Block == Row and type(Block) is type(Row)
+
+
+@pytest.mark.parametrize('Seed', [7, 11, 23])
+@pytest.mark.parametrize('ByteOrder', ['Big', 'Little'])
+@pytest.mark.parametrize('WordOrder', ['Big', 'Little'])
+def test_block_decoder_matches_per_row_decode(Seed, ByteOrder, WordOrder, monkeypatch):
+    Channels = RandomChannels(Seed)
+    Registers = Memory(Seed)
+    Decoded = []
+    DecodeModbusBlocks = Lib.DecodeModbusBlocks
+    def Counted(*args):
+        Values = DecodeModbusBlocks(*args)
+        Decoded.append(len(Values))
+        return Values
+    monkeypatch.setattr(Lib, 'DecodeModbusBlocks', Counted)
+    Blocks = Read(Channels, Registers, ByteOrder, WordOrder, True)
+    assert sum(Decoded) > len(Channels) // 2 #most channels came from the block decoder
+    Rows = Read(Channels, Registers, ByteOrder, WordOrder, False)
+    assert Blocks.keys() == Rows.keys() == Channels.keys()
+    Mismatches = [(Tag, Blocks[Tag]['Value'], Rows[Tag]['Value']) for Tag in Channels if not Same(Blocks[Tag]['Value'], Rows[Tag]['Value'])]
+    assert Mismatches == []
+
+
+class ErrorResponse:
+    def __init__(self, FunctionCode=None):
+        if FunctionCode is not None:
+            self.function_code = FunctionCode
+
+    def isError(self):
+        return True
+
+
+class FlakyModbus(FakeModbus):
+    def __init__(self, Memory, Error):
+        FakeModbus.__init__(self, Memory)
+        self.Error = Error
+        self.Counts = []
+
+    def read_holding_registers(self, Address, Count, Unit):
+        self.Counts.append(Count)
+        if Count > 1:
+            return self.Error
+        return FakeModbus.read_holding_registers(self, Address, Count, Unit)
+
+
+def SpanRead(Error, Name):
+    Channels = {'T%d' % Number: {'Type': 'HRegister', 'DataType': 'uint16', 'Registers': 1, 'IOPoint': Number, 'Unit': 1} for Number in range(3)}
+    Config = {'EquipmentTags': {'Communication': 'ModbusTcpGeneric', 'EquipmentName': Name, 'Connection': {'Unit': 1}}, 'Channels': Channels}
+    Request = {'Read/Write': 'R', 'Channels': {Tag: 0 for Tag in Channels}}
+    Connection = FlakyModbus(list(range(10)), Error)
+    Lib.ModbusTcpGenericR(Request, Config, Connection, FakeClient())
+    Connection.Counts.clear()
+    Lib.ModbusTcpGenericR(Request, Config, Connection, FakeClient())
+    return Connection.Counts
+
+
+def test_timed_out_span_is_tried_again():
+    assert SpanRead(ErrorResponse(), 'SpanTimeout') == [3, 1, 1, 1]
+
+
+def test_rejected_span_is_split_for_good():
+    assert SpanRead(ErrorResponse(0x83), 'SpanRejected') == [1, 1, 1]
@@ -0,0 +1,96 @@
+import math
+import random
+import pytest
+import MQTT_Database_Lib as DB
+
+Start = 1700000000 * 10**9
+
+
+def Signal(Seed, Count=2000):
+    Random = random.Random(Seed)
+    Value = 50.0
+    Times, Values = [], []
+    for Number in range(Count):
+        #a drifting ramp with noise, steps and flat stretches
+        Value += Random.gauss(0, 0.3) + (0.05 if (Number // 300) % 2 else -0.04)
+        if Random.random() < 0.01:
+            Value += Random.choice([-10, 10])
+        Times.append(Start + Number * 100000000 + Random.randrange(1000)) #10 Hz with jitter
+        Values.append(round(Value, 3) if Random.random() > 0.2 else Values[-1] if Values else Value)
+    return Times, Values
+
+
+def Compress(Method, Deviation, Heartbeat, Times, Values, Batch=137):
+    Stage = DB.CompressionStage({('Stack', 'T1'): (Method, Deviation, Heartbeat)})
+    Kept = ([], [], [], [])
+    for First in range(0, len(Times), Batch):
+        Part = slice(First, First + Batch)
+        Count = len(Times[Part])
+        Output = Stage.Filter((Times[Part], ['Stack'] * Count, ['T1'] * Count, Values[Part]))
+        for Column, Rows in zip(Kept, Output):
+            Column.extend(Rows)
+    for Column, Rows in zip(Kept, Stage.Drain()):
+        Column.extend(Rows)
+    Stored = sorted(zip(Kept[0], Kept[3]))
+    assert len(Stored) < len(Times)
+    assert set(Stored) <= set(zip(Times, Values)) #only real samples are stored
+    return Stored
+
+
+#value between stored points on a straight line (swinging door) or held from the last one (deadband)
+def Reconstruct(Stored, Time, Linear):
+    for (Before, Low), (After, High) in zip(Stored, Stored[1:]):
+        if Before <= Time <= After:
+            if not Linear or After == Before:
+                return Low if Time < After else High
+            return Low + (High - Low) * (Time - Before) / (After - Before)
+    return Stored[-1][1]
+
+
+@pytest.mark.parametrize('Seed', [1, 2, 3])
+@pytest.mark.parametrize('Deviation', [0.25, 1.0, 5.0])
+def test_absolute_deadband_error_within_deviation(Seed, Deviation):
+    Times, Values = Signal(Seed)
+    Stored = Compress('Absolute', Deviation, float('inf'), Times, Values)
+    Error = max(abs(Reconstruct(Stored, Time, False) - Value) for Time, Value in zip(Times, Values))
+    assert Error <= Deviation
+
+
+@pytest.mark.parametrize('Seed', [1, 2, 3])
+@pytest.mark.parametrize('Percent', [0.5, 2.0, 10.0])
+def test_percent_deadband_error_within_deviation(Seed, Percent):
+    Times, Values = Signal(Seed)
+    Stored = Compress('Percent', Percent, float('inf'), Times, Values)
+    for Time, Value in zip(Times, Values):
+        Held = Reconstruct(Stored, Time, False)
+        assert abs(Held - Value) <= abs(Held) * Percent / 100.0
+
+
+@pytest.mark.parametrize('Seed', [1, 2, 3])
+@pytest.mark.parametrize('Deviation', [0.25, 1.0, 5.0])
+def test_swinging_door_error_within_deviation(Seed, Deviation):
+    Times, Values = Signal(Seed)
+    Stored = Compress('SwingingDoor', Deviation, float('inf'), Times, Values)
+    assert Stored[0][0] == Times[0] and Stored[-1][0] == Times[-1]
+    Error = max(abs(Reconstruct(Stored, Time, True) - Value) for Time, Value in zip(Times, Values))
+    assert Error <= Deviation + 1e-6 #slopes are worked out in float seconds since the epoch
+
+
+@pytest.mark.parametrize('Method', ['Absolute', 'Percent', 'SwingingDoor'])
+def test_heartbeat_bounds_the_gap_between_stored_rows(Method):
+    Times, Values = Signal(4)
+    Stored = Compress(Method, 1e6, 5, Times, Values)
+    Gaps = [After - Before for (Before, Low), (After, High) in zip(Stored, Stored[1:])]
+    assert max(Gaps) <= 5 * 10**9 + 100000000 + 1000 #the first sample at or past the heartbeat is stored
+
+
+def test_non_numeric_values_pass_through():
+    Stage = DB.CompressionStage({('Stack', 'T1'): ('Absolute', 10.0, float('inf'))})
+    Output = Stage.Filter(([Start, Start + 1, Start + 2, Start + 3], ['Stack'] * 4, ['T1'] * 4, [1.0, 'Fault', float('nan'), 1.5]))
+    assert Output[3][:2] == [1.0, 'Fault'] and math.isnan(Output[3][2]) and Output[3][3] == 1.5
+
+
+def test_unreadable_time_passes_through_and_restarts_the_tag():
+    Stage = DB.CompressionStage({('Stack', 'T1'): ('SwingingDoor', 1.0, float('inf'))})
+    Output = Stage.Filter(([Start, Start + 10**8, 'not a time', Start + 3 * 10**8], ['Stack'] * 4, ['T1'] * 4, [1.0, 1.1, 1.2, 1.3]))
+    assert Output[0] == [Start, Start + 10**8, 'not a time', Start + 3 * 10**8]
@@ -0,0 +1,24 @@
+import json
+import MQTT_Config_Lib
+import MQTT_Database_Lib
+
+
+def Write(Path, Content):
+    Path.write_text(json.dumps(Content))
+    return Path
+
+
+def test_loads_active_equipment_relative_to_the_system_config(tmp_path, capsys):
+    (tmp_path / 'Instruments').mkdir()
+    Write(tmp_path / 'Instruments' / 'pump.json', {'EquipmentTags': {'EquipmentName': 'Pump'},
+                                                   'Channels': {'T1': {'Compression': {'Method': 'SwingingDoor', 'Deviation': 0.5}}}})
+    Write(tmp_path / 'Instruments' / 'spare.json', {'EquipmentTags': {'EquipmentName': 'Spare'}, 'Channels': {}})
+    System = Write(tmp_path / 'System.json', {'SystemTags': {'RootPath': str(tmp_path / 'missing')}, 'Equipment': {
+        'Pump': {'Config': 'Instruments/pump.json'},
+        'Spare': {'Config': 'Instruments/spare.json', 'Active': False},
+        'Broken': {'Config': 'Instruments/broken.json'}}})
+    SystemConfig, EquipmentConfigs = MQTT_Config_Lib.LoadEquipmentConfigs(str(System))
+    assert set(SystemConfig['Equipment']) == {'Pump', 'Spare', 'Broken'}
+    assert list(EquipmentConfigs) == ['Pump']
+    assert 'Error loading config for Broken' in capsys.readouterr().out
+    assert MQTT_Database_Lib.LoadCompressionSettings(str(System)) == {('Pump', 'T1'): ('SwingingDoor', 0.5, float('inf'))}
@@ -0,0 +1,167 @@
+import json
+import time
+import MQTT_Database_Lib as DB
+
+Start = 1700000000 * 10**9
+
+
+class FakeClient:
+    def __init__(self):
+        self.Published = []
+
+    def publish(self, Topic, Payload, **kwargs):
+        self.Published.append((Topic, Payload))
+
+
+def NewWriter(monkeypatch, **Details):
+    Written = []
+    monkeypatch.setattr(DB, 'WriteBatches', lambda engine, Batches, CopyFormat='Binary', Router=None: Written.append(Batches))
+    Config = {'DatabaseTags': {'DatabaseName': 'Test'}, 'DatabaseDetails': dict({'DefaultTable': 'data'}, **Details)}
+    return DB.DatabaseWriter(None, Config, FakeClient()), Written
+
+
+def test_final_flush_with_empty_buffer_only_writes_rollups(monkeypatch):
+    Relay, Written = NewWriter(monkeypatch, Rollups=['1min'])
+    Relay.Buffer.AppendColumns('Pump', [Start, Start + 10**9], ['T1', 'T1'], [1.0, 3.0])
+    Relay.Flush()
+    assert [[Table for Table, Keys, Columns in Batches] for Batches in Written] == [['data']] #the bucket is still open
+    Relay.Flush(Final=True)
+    Tables = [Table for Table, Keys, Columns in Written[1]]
+    assert Tables == ['data_rollup_1min']
+    assert Written[1][0][2][3:7] == ([1.0], [3.0], [2.0], [2])
+
+
+def test_final_flush_with_nothing_buffered_writes_nothing(monkeypatch):
+    Relay, Written = NewWriter(monkeypatch)
+    Relay.Flush(Final=True)
+    assert Written == []
+
+
+class DataError(Exception):
+    pass
+
+
+class OperationalError(Exception):
+    pass
+
+
+def FailingWriter(monkeypatch, Fail, **Details):
+    Written = []
+    def WriteBatches(engine, Batches, CopyFormat='Binary', Router=None):
+        Error = Fail(Batches)
+        if Error is not None:
+            raise Error
+        Written.append(Batches)
+    monkeypatch.setattr(DB, 'WriteBatches', WriteBatches)
+    Config = {'DatabaseTags': {'DatabaseName': 'Test'}, 'DatabaseDetails': dict({'DefaultTable': 'data'}, **Details)}
+    return DB.DatabaseWriter(None, Config, FakeClient()), Written
+
+
+def Poison(Batches):
+    return DataError('invalid input syntax for type timestamp') if 'bad' in Batches[0][2][1] else None
+
+
+def test_batch_error_is_dead_lettered_and_later_batches_still_go_through(monkeypatch, tmp_path):
+    Relay, Written = FailingWriter(monkeypatch, Poison, DeadLetterDirectory=str(tmp_path))
+    Relay.Buffer.AppendColumns('bad', [Start], ['T1'], [1.0])
+    Relay.Flush()
+    Relay.Buffer.AppendColumns('Pump', [Start], ['T1'], [2.0])
+    Relay.Flush()
+    assert [Batches[0][2][1] for Batches in Written] == [['Pump']]
+    assert Relay.Held == [] and Relay.HeldRows == 0
+    assert len(list(tmp_path.iterdir())) == 1
+    assert 'saved to' in Relay.client.Published[0][1]
+
+
+def test_connection_error_holds_batches_for_retry(monkeypatch):
+    Down = [True]
+    Relay, Written = FailingWriter(monkeypatch, lambda Batches: OperationalError('server closed the connection') if Down[0] else None)
+    for Number in range(10):
+        Relay.Buffer.AppendColumns('Pump', [Start + Number], ['T1'], [1.0])
+        Relay.Flush()
+    assert len(Relay.Held) == 10 and Written == []
+    Down[0] = False
+    Relay.Flush()
+    assert len(Written) == 10 and Relay.Held == []
+
+
+def test_unknown_error_gives_up_after_batch_retries(monkeypatch):
+    Relay, Written = FailingWriter(monkeypatch, lambda Batches: RuntimeError('odd') if 'odd' in Batches[0][2][1] else None, BatchRetries=3)
+    Relay.Buffer.AppendColumns('odd', [Start], ['T1'], [1.0])
+    Relay.Flush()
+    Relay.Buffer.AppendColumns('Pump', [Start], ['T1'], [1.0])
+    Relay.Flush()
+    Relay.Flush()
+    assert [Batches[0][2][1] for Batches in Written] == [['Pump']]
+    assert 'dropped' in Relay.client.Published[-1][1]
+
+
+def test_spooled_batch_error_does_not_block_replay(monkeypatch, tmp_path):
+    Down = [True]
+    def Fail(Batches):
+        if Down[0]:
+            return OperationalError('connection refused')
+        return Poison(Batches)
+    Relay, Written = FailingWriter(monkeypatch, Fail, SpoolDirectory=str(tmp_path / 'spool'))
+    for Equipment in ('bad', 'Pump', 'Boiler'):
+        Relay.Buffer.AppendColumns(Equipment, [Start], ['T1'], [1.0])
+        Relay.Flush()
+    assert Relay.Spool.Depth()[0] == 3
+    Down[0] = False
+    Relay.Flush()
+    assert [Batches[0][2][1] for Batches in Written] == [['Pump'], ['Boiler']]
+    assert Relay.Spool.Depth()[0] == 0
+    Relay.Spool.Close()
+
+
+def test_stop_returns_when_backpressure_leaves_the_queue_full(monkeypatch):
+    Relay, Written = FailingWriter(monkeypatch, lambda Batches: OperationalError('database is down'),
+                                   MaxBufferRows=5, QueueSize=3, QueueTimeout=0.2, FlushInterval=0.05, StopTimeout=5)
+    Relay.start()
+    Message = json.dumps({'Pump': {'T%d' % Number: {'Value': 1.0, 'Time': '', 'TimeNs': Start} for Number in range(5)}}).encode()
+    while Relay.Submit(Message, 'Relay/Data/Pump'):
+        pass
+    Begun = time.monotonic()
+    Relay.Stop()
+    assert not Relay.is_alive()
+    assert time.monotonic() - Begun < 2
+
+
+def test_bad_time_is_dropped_with_its_message_and_the_writer_keeps_running(monkeypatch):
+    Relay, Written = NewWriter(monkeypatch, Rollups=['1min'], FlushInterval=0.05)
+    Relay.start()
+    Relay.Submit(json.dumps({'Pump': {'T1': {'Value': 1.0, 'Time': 'not a time'}}}).encode(), 'Relay/Data/Pump')
+    Relay.Submit(json.dumps({'Pump': {'T1': {'Value': 2.0, 'Time': '2024-05-01 12:00:00'}}}).encode(), 'Relay/Data/Pump')
+    time.sleep(0.3)
+    assert Relay.is_alive()
+    Relay.Stop()
+    Raw = [Columns for Batches in Written for Table, Keys, Columns in Batches if Table == 'data']
+    assert [Columns[0] for Columns in Raw] == [['2024-05-01 12:00:00']]
+    assert Relay.Metrics.Counters[('relay_bad_messages_total', ())] == 1
+
+
+def test_a_batch_that_cannot_be_prepared_is_reported_not_fatal(monkeypatch):
+    Relay, Written = NewWriter(monkeypatch, Rollups=['1min'])
+    Relay.Buffer.AppendColumns('Pump', ['not a time'], ['T1'], [1.0]) #skips the message checks
+    Relay.Flush()
+    assert Written == [] and len(Relay.Buffer) == 0
+    assert 'could not be prepared' in Relay.client.Published[0][1]
+
+
+def test_bad_time_never_reaches_compression(monkeypatch):
+    Relay, Written = NewWriter(monkeypatch, FlushInterval=0.05)
+    Relay.Compression = DB.CompressionStage({('Pump', 'T1'): ('Absolute', 0.5, float('inf'))})
+    Relay.start()
+    for Value, Time in ((1.0, '2024-05-01 12:00:00'), (5.0, 'yesterday'), (9.0, '2024-05-01 12:00:01')):
+        Relay.Submit(json.dumps({'Pump': {'T1': {'Value': Value, 'Time': Time}}}).encode(), 'Relay/Data/Pump')
+    time.sleep(0.3)
+    assert Relay.is_alive()
+    Relay.Stop()
+    Raw = [Columns for Batches in Written for Table, Keys, Columns in Batches if Table == 'data']
+    assert [Value for Columns in Raw for Value in Columns[3]] == [1.0, 9.0]
+
+
+def test_oversized_int_is_stored_as_null():
+    Array, Nulls = DB.NormalizeValues([1, 10**400, 'ON', None])
+    assert list(Array[[0, 2]]) == [1.0, 1.0]
+    assert list(Nulls) == [False, True, False, True]
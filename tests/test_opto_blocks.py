@@ -0,0 +1,108 @@
+import json
+import random
+import struct
+import MQTT_Instrument_Lib as Lib
+
+
+#stands in for optommp.O22MMP - a read block reply is the 16 byte MMP header followed by the memory read
+class FakeO22MMP:
+    def __init__(self, Memory, Fail=()):
+        self.Memory = Memory
+        self.Fail = set(Fail) #each fails once
+        self.Reads = []
+
+    def ReadBlock(self, Address, Size):
+        self.Reads.append((Address, Size))
+        assert Size <= 255 #one byte in the request
+        if Address in self.Fail:
+            self.Fail.discard(Address)
+            raise OSError('timed out')
+        return b'\0' * 16 + bytes(self.Memory.get(Address + Offset, 0) for Offset in range(Size))
+
+    def GetAnalogPointValue(self, Module, Channel):
+        return struct.unpack('>f', self.ReadBlock(Lib.OptoAnalogRead + 0x1000 * Module + 0x40 * Channel, 4)[16:])[0]
+
+    def GetDigitalPointState(self, Module, Channel):
+        return struct.unpack('>i', self.ReadBlock(Lib.OptoDigitalRead + 0x1000 * Module + 0x40 * Channel, 4)[16:])[0]
+
+
+class FakeClient:
+    def __init__(self):
+        self.Published = []
+
+    def publish(self, Topic, Payload, **kwargs):
+        self.Published.append((Topic, Payload))
+
+
+def Rack(Seed, Modules=3):
+    Random = random.Random(Seed)
+    Memory = {}
+    def Put(Address, Format, Value):
+        for Offset, Byte in enumerate(struct.pack(Format, Value)):
+            Memory[Address + Offset] = Byte
+    Channels = {}
+    for Module in range(Modules):
+        for Channel in range(16):
+            Kind = Random.choice(['Analog', 'Digital', 'Feature'])
+            Point = 0x1000 * Module + 0x40 * Channel
+            if Kind == 'Analog':
+                Put(Lib.OptoAnalogRead + Point, '>f', Random.uniform(-500, 500))
+            elif Kind == 'Feature':
+                Put(Lib.OptoDigitalRead + Point + 0x10, '>f', Random.uniform(0, 1e5))
+            else:
+                Put(Lib.OptoDigitalRead + Point, '>i', Random.choice([0, 1, -1]))
+            Channels['M%dC%d' % (Module, Channel)] = {'Type': Kind, 'Module': Module, 'Channel': Channel, 'DataType': 'float32', 'Scalar': 1, 'Offset': 0, 'Decimal': 3}
+    Request = {'Read/Write': 'R', 'Channels': {Tag: 0 for Tag in Random.sample(sorted(Channels), len(Channels))}}
+    return Memory, Channels, Request
+
+
+def Read(Memory, Channels, Request, Bulk, Fail=()):
+    Connection = FakeO22MMP(Memory, Fail)
+    Client = FakeClient()
+    Config = {'EquipmentTags': {'EquipmentName': 'Opto', 'OptoBulkRead': Bulk}, 'Channels': Channels}
+    return Lib.OptoR(Request, Config, Connection, Client)['Opto'], Connection, Client
+
+
+def Values(Result):
+    return {Tag: Entry['Value'] for Tag, Entry in Result.items()}
+
+
+def test_block_reads_match_per_point_reads():
+    Memory, Channels, Request = Rack(4)
+    Single, SingleConnection, SingleClient = Read(Memory, Channels, Request, False)
+    Bulk, BulkConnection, BulkClient = Read(Memory, Channels, Request, True)
+    assert len(Single) == len(Channels)
+    assert Values(Bulk) == Values(Single)
+    assert len(SingleConnection.Reads) == len(Channels)
+    assert len(BulkConnection.Reads) <= len(Channels) // 2 #0x40 bytes per point, up to four points a block
+    assert BulkClient.Published == []
+
+
+def test_channels_of_one_block_share_a_stamp():
+    Memory, Channels, Request = Rack(5, Modules=1)
+    Bulk, Connection, Client = Read(Memory, Channels, Request, True)
+    Address = lambda Tag: Lib.OptoPointAddress(Channels[Tag])[0]
+    for Start, Size in Connection.Reads:
+        Stamps = {Bulk[Tag]['TimeNs'] for Tag in Channels if Start <= Address(Tag) < Start + Size}
+        assert len(Stamps) == 1
+
+
+def test_failed_block_falls_back_to_point_reads():
+    Memory, Channels, Request = Rack(6)
+    Single, Connection, Client = Read(Memory, Channels, Request, False)
+    Blocks = Lib.PlanOptoBlocks(tuple(Lib.ChannelSpec(Tag, Channels[Tag]) for Tag in Request['Channels']), {'EquipmentTags': {}})
+    Failed = Blocks[1].Start
+    Bulk, Connection, Client = Read(Memory, Channels, Request, True, Fail=(Failed,))
+    assert Values(Bulk) == Values(Single)
+    assert len(Connection.Reads) == len(Blocks) + len(Blocks[1].Members)
+    assert [Topic for Topic, Payload in Client.Published] == ['Relay/CommIssue/Opto']
+    assert hex(Failed) in json.loads(Client.Published[0][1])
+
+
+def test_channel_without_address_is_read_on_its_own():
+    Memory, Channels, Request = Rack(7, Modules=1)
+    Channels['Broken'] = {'Type': 'Analog', 'DataType': 'float32', 'Scalar': 1, 'Offset': 0, 'Decimal': 3}
+    Request['Channels']['Broken'] = 0
+    Bulk, Connection, Client = Read(Memory, Channels, Request, True)
+    assert 'Broken' not in Bulk and len(Bulk) == len(Channels) - 1
+    assert [Topic for Topic, Payload in Client.Published] == ['Relay/CommIssue/Opto']
@@ -0,0 +1,78 @@
+import json
+import time
+import MQTT_Instrument_Lib as Lib
+
+Config = {'EquipmentTags': {'EquipmentName': 'Pump', 'Communication': 'Virtual', 'Polling': True},
+          'Channels': {'T1': {'Tags': ['Fast']}, 'T2': {'Tags': ['Slow'], 'ReadWrite': 'W'}}}
+
+
+class FakeClient:
+    def __init__(self):
+        self.Published = []
+
+    def publish(self, Topic, Payload, **kwargs):
+        self.Published.append((Topic, json.loads(Payload)))
+
+
+def Run(DataSampling, Seconds=0):
+    Client = FakeClient()
+    Polls = []
+    Scheduler = Lib.PollScheduler(Config, DataSampling, Polls.append, Client)
+    Scheduler.start()
+    time.sleep(Seconds)
+    Scheduler.Stop()
+    Scheduler.join(1)
+    return Client.Published, Polls
+
+
+def test_polling_without_data_sampling_is_reported():
+    Published, Polls = Run({})
+    assert Polls == []
+    assert Published[0][0] == 'Relay/ServerIssue/Pump' and 'no DataSampling classes' in Published[0][1]
+
+
+def test_polling_with_no_matching_channels_is_reported():
+    Published, Polls = Run({'Slow': {'Rate': 1, 'Unit': 'S'}})
+    assert Polls == []
+    assert Published[0][0] == 'Relay/ServerIssue/Pump' and 'no channel matches' in Published[0][1]
+
+
+def test_matching_class_is_polled():
+    Published, Polls = Run({'Fast': {'Rate': 50, 'Unit': 'MS'}}, 0.22)
+    assert Published == []
+    assert 3 <= len(Polls) <= 6
+    assert json.loads(Polls[0]) == {'Read/Write': 'R', 'Channels': {'T1': 0}}
+
+
+def Scheduled(DataSampling, Seconds, Poll=None):
+    Channels = {'A': {'Tags': ['Seven']}, 'B': {'Tags': ['Eleven']}}
+    Polls = []
+    Scheduler = Lib.PollScheduler(dict(Config, Channels=Channels), DataSampling, Poll or Polls.append, FakeClient())
+    Waits = []
+    Wait = Scheduler.Stopped.wait
+    Scheduler.Stopped.wait = lambda Timeout: Waits.append(Timeout) or Wait(Timeout)
+    Scheduler.start()
+    time.sleep(Seconds)
+    Scheduler.Stop()
+    Scheduler.join(1)
+    return Polls, Waits
+
+
+def test_coprime_periods_sleep_until_the_next_due_class():
+    Polls, Waits = Scheduled({'Seven': {'Rate': 70, 'Unit': 'MS'}, 'Eleven': {'Rate': 110, 'Unit': 'MS'}}, 0.5)
+    Counts = [sorted(json.loads(Request)['Channels']) for Request in Polls]
+    assert 6 <= Counts.count(['A']) + Counts.count(['A', 'B']) <= 8
+    assert 4 <= Counts.count(['B']) + Counts.count(['A', 'B']) <= 5
+    assert len(Waits) <= len(Polls) + 2 #one sleep per poll, not one per millisecond of the gcd
+    assert Counts[0] == ['A', 'B']
+
+
+def test_overrun_polls_each_class_once_and_keeps_the_grid():
+    Polls = []
+    def Slow(Request):
+        Polls.append((time.monotonic(), sorted(json.loads(Request)['Channels'])))
+        if len(Polls) == 1:
+            time.sleep(0.25)
+    Scheduled({'Seven': {'Rate': 70, 'Unit': 'MS'}, 'Eleven': {'Rate': 110, 'Unit': 'MS'}}, 0.5, Slow)
+    assert Polls[1][1] == ['A', 'B'] #both classes missed polls while the first one ran, read together straight away
+    assert Polls[1][0] - Polls[0][0] < 0.3
@@ -0,0 +1,158 @@
+import re
+import json
+import math
+from decimal import Decimal
+from datetime import datetime, timezone
+import MQTT_Instrument_Lib as Lib
+
+#query text -> (first column value, postgres type name) of its first row, [] for no rows
+Tables = {
+    'select reading from plant': [(Decimal('12.3456789012345678901'), 'numeric')],
+    'select ratio from plant': [(float('nan'), 'double precision')],
+    'select peak from plant': [(float('inf'), 'double precision')],
+    'select count(*) from plant': [(42, 'bigint')],
+    'select running from plant': [(True, 'boolean')],
+    'select stamp from plant': [(datetime(2024, 5, 1, 12, 0, 0, 250000), 'timestamp without time zone')],
+    'select stamptz from plant': [(datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc), 'timestamp with time zone')],
+    'select label from plant': [('NaN', 'text')],
+    'select missing from plant': [(None, 'double precision')],
+    'select nothing from plant': [],
+}
+Branch = re.compile(r'\(SELECT (\d+) AS channel, q\.c0::text AS result, pg_typeof\(q\.c0\)::text AS type FROM \((.*?)\n\) q\(c0\) LIMIT 1\)', re.S)
+
+
+#what postgres prints for a value cast to text
+def PgText(Value):
+    if Value is None:
+        return None
+    if isinstance(Value, bool):
+        return 'true' if Value else 'false'
+    if isinstance(Value, float) and not math.isfinite(Value):
+        return 'NaN' if Value != Value else 'Infinity' if Value > 0 else '-Infinity'
+    if isinstance(Value, datetime):
+        return Value.isoformat(sep=' ').replace('+00:00', '+00')
+    return str(Value)
+
+
+class Result:
+    def __init__(self, Rows):
+        self.Rows = Rows
+
+    def fetchall(self):
+        return self.Rows
+
+    def fetchone(self):
+        return self.Rows[0] if self.Rows else None
+
+
+class FakeConnection:
+    def __init__(self, Database):
+        self.Database = Database
+        self.Trips = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def Rows(self, Query):
+        if Query not in Tables:
+            raise RuntimeError('column does not exist')
+        return Tables[Query]
+
+    def execute(self, Statement):
+        self.Trips += 1
+        if self.Database.Dead:
+            raise RuntimeError('server closed the connection unexpectedly')
+        Sql = str(Statement)
+        if Sql.startswith('(SELECT'):
+            Rows = []
+            for Position, Query in Branch.findall(Sql):
+                Rows.extend((int(Position), PgText(Value), TypeName) for Value, TypeName in self.Rows(Query)[:1])
+            return Result(Rows)
+        return Result([(Value,) for Value, TypeName in self.Rows(Sql)])
+
+    def rollback(self):
+        if self.Database.Dead:
+            raise RuntimeError('connection already closed')
+
+
+class FakeEngine:
+    def __init__(self, Dead=False):
+        self.Dead = Dead
+        self.Connections = []
+
+    def connect(self):
+        self.Connections.append(FakeConnection(self))
+        return self.Connections[-1]
+
+
+class FakeClient:
+    def __init__(self):
+        self.Published = []
+
+    def publish(self, Topic, Payload, **kwargs):
+        self.Published.append((Topic, json.loads(Payload)))
+
+
+def Read(Queries, Engine, Name):
+    #int32 channels pass the value through untouched, so the types are the driver's own
+    Channels = {Tag: {'QueryText': Query, 'DataType': 'int32'} for Tag, Query in Queries.items()}
+    Config = {'EquipmentTags': {'EquipmentName': Name, 'Communication': 'PostGreSQL'}, 'Channels': Channels}
+    Client = FakeClient()
+    Result = Lib.PostGreSQLR({'Read/Write': 'R', 'Channels': {Tag: 0 for Tag in Channels}}, Config, Engine, Client)[Name]
+    return {Tag: Entry['Value'] for Tag, Entry in Result.items()}, Client
+
+
+def Same(Batched, Single):
+    if isinstance(Batched, float) and Batched != Batched:
+        return isinstance(Single, float) and Single != Single
+    return Batched == Single and type(Batched) is type(Single)
+
+
+def test_batch_keeps_the_types_of_single_queries():
+    Queries = {'Q%d' % Number: Query for Number, Query in enumerate(Tables) if Tables[Query]}
+    Engine = FakeEngine()
+    Batched, Client = Read(Queries, Engine, 'Batch')
+    assert Engine.Connections[0].Trips == 1 and Client.Published == []
+    for Tag, Query in Queries.items():
+        Single, Client = Read({Tag: Query}, FakeEngine(), 'Single')
+        assert Same(Batched[Tag], Single[Tag]), (Query, Batched[Tag], Single[Tag])
+
+
+def test_query_without_rows_fails_its_channel_only():
+    Batched, Client = Read({'A': 'select reading from plant', 'B': 'select nothing from plant'}, FakeEngine(), 'NoRows')
+    assert Batched == {'A': Decimal('12.3456789012345678901')}
+    assert len(Client.Published) == 1 and 'no rows' in Client.Published[0][1]
+
+
+def test_broken_query_is_quarantined():
+    Queries = {'A': 'select reading from plant', 'Bad': 'select nope from plant', 'C': 'select count(*) from plant'}
+    Engine = FakeEngine()
+    Batched, Client = Read(Queries, Engine, 'Broken')
+    assert Batched == {'A': Decimal('12.3456789012345678901'), 'C': 42}
+    assert set(Lib.PostGreSQLQuarantine['Broken']) == {'Bad'}
+    Batched, Client = Read(Queries, Engine, 'Broken')
+    assert Engine.Connections[1].Trips == 2 #the batch without Bad, then Bad on its own
+
+
+def test_dead_connection_fails_the_request_without_quarantine():
+    Queries = {'A': 'select reading from plant', 'B': 'select count(*) from plant'}
+    Engine = FakeEngine(Dead=True)
+    Batched, Client = Read(Queries, Engine, 'Dead')
+    assert Batched == {} and Engine.Connections[0].Trips == 1
+    assert [Topic for Topic, Payload in Client.Published] == ['Relay/CommIssue/Dead'] * 2
+    assert Lib.PostGreSQLQuarantine['Dead'] == {}
+
+
+class RefusingEngine:
+    def connect(self):
+        raise RuntimeError('could not connect to server')
+
+
+def test_failed_connect_is_reported_per_channel():
+    Batched, Client = Read({'A': 'select reading from plant', 'B': 'select count(*) from plant'}, RefusingEngine(), 'Refused')
+    assert Batched == {}
+    assert [Topic for Topic, Payload in Client.Published] == ['Relay/CommIssue/Refused'] * 2
+    assert all('could not connect' in Payload for Topic, Payload in Client.Published)
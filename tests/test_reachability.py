@@ -0,0 +1,103 @@
+import socket
+import struct
+import asyncio
+import types
+import MQTT_Instrument_Lib as Lib
+
+
+def PingConfig(Address, Port, Method='TCP'):
+    return {'EquipmentTags': {'EquipmentName': 'PingTest', 'TargetIP': Address, 'PingMethod': Method,
+                              'PingPort': Port, 'PingTimeout': 1}}
+
+
+def Monitor():
+    Probe = Lib.ReachabilityMonitor.__new__(Lib.ReachabilityMonitor)
+    Probe.Sequence = 0
+    return Probe
+
+
+def test_tcp_listener_up():
+    Listener = socket.socket()
+    Listener.bind(('127.0.0.1', 0))
+    Listener.listen(1)
+    try:
+        async def Check():
+            Probe = Monitor()
+            Probe.loop = asyncio.get_running_loop()
+            return await Probe.Probe(Lib.PingTarget(PingConfig('127.0.0.1', Listener.getsockname()[1])))
+        assert asyncio.run(Check()) is not None
+    finally:
+        Listener.close()
+
+
+def test_tcp_refused_is_up_and_unresolvable_is_down():
+    Closed = socket.socket()
+    Closed.bind(('127.0.0.1', 0))
+    Port = Closed.getsockname()[1]
+    Closed.close()
+
+    async def Check(Address):
+        Probe = Monitor()
+        Probe.loop = asyncio.get_running_loop()
+        return await Probe.Probe(Lib.PingTarget(PingConfig(Address, Port)))
+    assert asyncio.run(Check('127.0.0.1')) is not None
+    assert asyncio.run(Check('host.invalid')) is None
+
+
+def test_echo_checksum():
+    for Sequence in (1, 2, 0x1234, 0xFFFF):
+        Packet = Lib.EchoPacket(Sequence)
+        assert len(Packet) == 8 + len(Lib.EchoPayload)
+        assert Lib.EchoChecksum(Packet) == 0 #a valid checksum sums the packet to zero
+        assert struct.unpack('!H', Packet[6:8])[0] == Sequence
+
+
+class StubSocket:
+    def __init__(self, *args):
+        pass
+
+    def setblocking(self, Flag):
+        pass
+
+    def close(self):
+        pass
+
+
+class StubLoop:
+    def __init__(self, Monitor):
+        self.Monitor = Monitor
+        self.Sent = []
+        self.Received = 0
+
+    async def getaddrinfo(self, Host, Port, family=0):
+        return [(family, 0, 0, '', ('127.0.0.1', 0))]
+
+    async def sock_connect(self, Sock, Address):
+        pass
+
+    async def sock_sendall(self, Sock, Packet):
+        self.Sent.append(Packet)
+
+    #a reply for another probe first (and another target's probe bumping the counter meanwhile), then ours
+    async def sock_recv(self, Sock, Size):
+        self.Received += 1
+        Sequence = struct.unpack('!H', self.Sent[-1][6:8])[0]
+        if self.Received == 1:
+            self.Monitor.Sequence = (self.Monitor.Sequence + 1) & 0xFFFF
+            return struct.pack('!BBHHH', 0, 0, 0, 0, Sequence + 7)
+        return struct.pack('!BBHHH', 0, 0, 0, 0, Sequence) + Lib.EchoPayload
+
+
+def test_echo_matches_its_own_sequence(monkeypatch):
+    monkeypatch.setattr(Lib, 'socket', types.SimpleNamespace(socket=StubSocket, AF_INET=socket.AF_INET, SOCK_DGRAM=socket.SOCK_DGRAM, IPPROTO_ICMP=socket.IPPROTO_ICMP))
+    Probe = Monitor()
+    Probe.loop = StubLoop(Probe)
+    asyncio.run(asyncio.wait_for(Probe.Echo(Lib.PingTarget(PingConfig('127.0.0.1', 0, 'ICMP'))), 1))
+    assert Probe.loop.Received == 2
+    assert Lib.EchoChecksum(Probe.loop.Sent[0]) == 0
+
+
+def test_icmp_by_default_and_tcp_port_from_the_instrument():
+    Target = Lib.PingTarget({'EquipmentTags': {'EquipmentName': 'PingTest', 'TargetIP': '127.0.0.1', 'PortNum': 502}})
+    assert (Target.Method, Target.Port) == ('ICMP', 502)
+    assert Lib.PingTarget({'EquipmentTags': {'EquipmentName': 'PingTest', 'TargetIP': '127.0.0.1'}}).Port == 80
@@ -0,0 +1,51 @@
+import json
+import MQTT_Instrument_Lib as Lib
+
+
+class Response:
+    def __init__(self, Registers):
+        self.registers = Registers
+
+    def isError(self):
+        return False
+
+
+class FakeModbus:
+    def __init__(self):
+        self.Reads = 0
+
+    def read_holding_registers(self, Address, Count, Unit):
+        self.Reads += 1
+        return Response(list(range(Address, Address + Count)))
+
+
+class FakeClient:
+    def __init__(self):
+        self.Published = []
+
+    def publish(self, Topic, Payload, *args, **kwargs):
+        self.Published.append((Topic, json.loads(Payload)))
+
+
+def Select(Name, MaxAge, Tags):
+    Channels = {'T%d' % i: {'Type': 'HRegister', 'DataType': 'int16', 'Registers': 1, 'IOPoint': i, 'Scalar': 1, 'Offset': 0, 'Decimal': 0} for i in range(2)}
+    Config = {'EquipmentTags': {'Communication': 'ModbusTcpGeneric', 'EquipmentName': Name, 'Connection': {'Unit': 1}, 'MaxAge': MaxAge}, 'Channels': Channels}
+    Connection = FakeModbus()
+    Client = FakeClient()
+    for Requested in Tags:
+        Request = json.dumps({'Read/Write': 'R', 'Channels': {Tag: 0 for Tag in Requested}})
+        Lib.InstrumentSelect(Request, Config, Connection, 'Relay/Request/' + Name, Client)
+    return Connection, Client
+
+
+def test_cached_values_are_not_republished_as_data():
+    Connection, Client = Select('CacheOn', 60, [['T0'], ['T0', 'T1'], ['T0']])
+    assert Connection.Reads == 2
+    Data = [(Topic, sorted(Payload['CacheOn'])) for Topic, Payload in Client.Published]
+    assert Data == [('Relay/Data/CacheOn', ['T0']), ('Relay/Cached/CacheOn', ['T0']), ('Relay/Data/CacheOn', ['T1']), ('Relay/Cached/CacheOn', ['T0'])]
+
+
+def test_max_age_zero_always_reads():
+    Connection, Client = Select('CacheOff', 0, [['T0'], ['T0']])
+    assert Connection.Reads == 2
+    assert [Topic for Topic, Payload in Client.Published] == ['Relay/Data/CacheOff'] * 2
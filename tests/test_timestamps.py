@@ -0,0 +1,67 @@
+import time
+import MQTT_Instrument_Lib as Lib
+import MQTT_Database_Lib as DB
+from zoneinfo import ZoneInfo
+
+
+class Response:
+    def __init__(self, Registers):
+        self.registers = Registers
+
+    def isError(self):
+        return False
+
+
+class FakeModbus:
+    def read_holding_registers(self, Address, Count, Unit):
+        time.sleep(0.002)
+        return Response(list(range(Address, Address + Count)))
+
+
+class FakeClient:
+    def publish(self, *args, **kwargs):
+        pass
+
+
+def Poll10Hz(Polls):
+    #channels 0-4 share a span, 5-9 are read one at a time
+    Channels = {'A%d' % i: {'Type': 'HRegister', 'DataType': 'int16', 'Registers': 1, 'IOPoint': i if i < 5 else i * 10,
+                            'Scalar': 1, 'Offset': 0, 'Decimal': 0} for i in range(10)}
+    Config = {'EquipmentTags': {'Communication': 'ModbusTcpGeneric', 'EquipmentName': 'HighSpeed', 'Connection': {'Unit': 1}}, 'Channels': Channels}
+    Request = {'Read/Write': 'R', 'Channels': {Tag: 0 for Tag in Channels}}
+    Results = []
+    Next = time.monotonic()
+    for Number in range(Polls):
+        Results.append(Lib.ModbusTcpGenericR(Request, Config, FakeModbus(), FakeClient())['HighSpeed'])
+        Next += 0.1
+        time.sleep(max(Next - time.monotonic(), 0))
+    return Channels, Results
+
+
+def test_channel_stamps_ordered_and_unique_at_10hz():
+    Channels, Results = Poll10Hz(10)
+    for Tag in Channels:
+        Stamps = [Result[Tag]['TimeNs'] for Result in Results]
+        assert all(Later > Earlier for Earlier, Later in zip(Stamps, Stamps[1:]))
+        assert len(set(Stamps)) == len(Stamps)
+        #roughly 100 ms apart, not the request's one second text
+        assert all(50e6 < Later - Earlier < 150e6 for Earlier, Later in zip(Stamps, Stamps[1:]))
+    First = Results[0]
+    assert First['A0']['TimeNs'] == First['A4']['TimeNs'] #one span read, one stamp
+    assert First['A5']['TimeNs'] > First['A4']['TimeNs'] < First['A6']['TimeNs'] #single reads come after it
+    assert all(Entry['Latency'] >= 0 for Entry in First.values())
+
+
+def test_relay_keeps_stamps_unique_through_copy():
+    Channels, Results = Poll10Hz(5)
+    Buffer = DB.IngestBuffer()
+    for Result in Results:
+        Buffer.AppendMessage({'HighSpeed': Result})
+    Times, Equipment, Tagnums, Values = DB.BufferBatch(Buffer)
+    Zone = ZoneInfo('UTC')
+    Micros = {}
+    for Time, Tagnum in zip(Times, Tagnums):
+        assert type(Time) is int
+        Micros.setdefault(Tagnum, []).append(DB.TimestampMicros(Time, Zone, True))
+    for Stamps in Micros.values():
+        assert Stamps == sorted(set(Stamps))